@@ -9,20 +9,31 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
 
-import main.routing
-
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "danretro.settings")
 
+# Sets Django up, so it has to come before importing anything with models.
+http_application = get_asgi_application()
+
+import main.routing  # noqa: E402
+
+
+def websocket_stack():
+    """Routes websockets to the retro consumer.
+
+    There's no AuthMiddlewareStack: nothing uses scope["user"] or the
+    session, and resolving them cost every connect a thread hop, plus a
+    session query for browsers with a session cookie.
+    """
+    return AllowedHostsOriginValidator(URLRouter(main.routing.websocket_urlpatterns))
+
+
 application = ProtocolTypeRouter(
     {
-        "http": get_asgi_application(),
-        "websocket": AllowedHostsOriginValidator(
-            AuthMiddlewareStack(URLRouter(main.routing.websocket_urlpatterns))
-        ),
+        "http": http_application,
+        "websocket": websocket_stack(),
     }
 )
@@ -47,24 +47,21 @@ elif RETRO_ENV == PROD:
 
 # Application definition
 
+# Nothing uses admin, auth, sessions or messages, so they aren't loaded.
 INSTALLED_APPS = [
-    "daphne",
-    "django.contrib.admin",
-    "django.contrib.auth",
-    "django.contrib.contenttypes",
-    "django.contrib.sessions",
-    "django.contrib.messages",
     # 'django.contrib.staticfiles',
     "main",
 ]
+if RETRO_ENV == DEV:
+    # Makes runserver serve ASGI, websockets included. Importing it sets up
+    # twisted's reactor, which `manage.py serve` leaves to each worker it
+    # forks, so it's only loaded in dev.
+    INSTALLED_APPS.insert(0, "daphne")
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
-    "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
-    "django.contrib.auth.middleware.AuthenticationMiddleware",
-    "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     # 'whitenoise.middleware.WhiteNoiseMiddleware',
 ]
@@ -80,8 +77,6 @@ TEMPLATES = [
             "context_processors": [
                 "django.template.context_processors.debug",
                 "django.template.context_processors.request",
-                "django.contrib.auth.context_processors.auth",
-                "django.contrib.messages.context_processors.messages",
             ],
         },
     },
@@ -93,41 +88,31 @@ WSGI_APPLICATION = "danretro.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
+# Connections are kept open between requests and websocket frames for this
+# many seconds rather than opened for each one. On Postgres with a pooler like
+# pgbouncer in front, 0 leaves pooling to it.
+RETRO_DB_CONN_MAX_AGE = int(os.getenv("RETRO_DB_CONN_MAX_AGE", "600"))
+
 if RETRO_ENV == DEV:
     DATABASES = {
         "default": {
             "ENGINE": "django.db.backends.sqlite3",
             "NAME": BASE_DIR / "db.sqlite3",
+            "CONN_MAX_AGE": RETRO_DB_CONN_MAX_AGE,
+            # Seconds to wait for a lock before "database is locked". Each
+            # connection is also put in WAL mode (see main.db).
+            "OPTIONS": {"timeout": 20},
         }
     }
 elif RETRO_ENV == PROD:
     DATABASES = {
         'default': dj_database_url.config(
-            conn_max_age=600,
+            conn_max_age=RETRO_DB_CONN_MAX_AGE,
             conn_health_checks=True,
         ),
     }
 
 
-# Password validation
-# https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
-
-AUTH_PASSWORD_VALIDATORS = [
-    {
-        "NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator",
-    },
-    {
-        "NAME": "django.contrib.auth.password_validation.MinimumLengthValidator",
-    },
-    {
-        "NAME": "django.contrib.auth.password_validation.CommonPasswordValidator",
-    },
-    {
-        "NAME": "django.contrib.auth.password_validation.NumericPasswordValidator",
-    },
-]
-
-
 # Internationalization
 # https://docs.djangoproject.com/en/4.1/topics/i18n/
 
@@ -160,9 +145,104 @@ STATIC_DIR = BASE_DIR / "static"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
-# This will only work on one instance/replica of the web server. I'm not
-# sure if there are other reasons why it'd be a bad idea to use in (small) prod.
-# TODO Do something better later on.
-CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+# Without REDIS_URL this will only work on one instance/replica of the web
+# server. With it, group messages fan out across processes over Redis pub/sub
+# (see main.layers). `manage.py fake_redis` runs a stand-in server for dev.
+# RETRO_AFFINITY=0 publishes every group message even when all of a retro's
+# participants are on the same process.
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "main.layers.RedisPubSubChannelLayer",
+            "CONFIG": {
+                "url": REDIS_URL,
+                "affinity": os.getenv("RETRO_AFFINITY", "1") == "1",
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {"default": {"BACKEND": "main.layers.InMemoryChannelLayer"}}
 
 ASGI_APPLICATION = "danretro.asgi.application"
+
+# Which websocket consumer to serve retros with. The sync one runs every frame
+# on a worker thread; the async one only leaves the event loop for the ORM.
+RETRO_CONSUMER = os.getenv("RETRO_CONSUMER", "async")
+SYNC = "sync"
+ASYNC = "async"
+if RETRO_CONSUMER not in [SYNC, ASYNC]:
+    raise Exception("Env var RETRO_CONSUMER must be sync or async")
+
+# Per-process cache of retros being worked on (see main.state). Idle retros are
+# evicted least recently used first once either limit is hit.
+RETRO_STATE_CACHE_MAX_RETROS = int(os.getenv("RETRO_STATE_CACHE_MAX_RETROS", "1000"))
+RETRO_STATE_CACHE_MAX_BYTES = int(
+    os.getenv("RETRO_STATE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))
+)
+
+# How many events a retro's log grows by before its state is snapshotted (see
+# main.state). Phase changes always snapshot.
+RETRO_SNAPSHOT_EVERY = int(os.getenv("RETRO_SNAPSHOT_EVERY", "200"))
+
+# RETRO_WRITE_BEHIND=1 commits retros' events and snapshots from a background
+# thread, batched every RETRO_WRITE_BEHIND_MS, instead of before each change is
+# broadcast (see main.writebehind). A crash can lose the last batch.
+RETRO_WRITE_BEHIND = os.getenv("RETRO_WRITE_BEHIND", "0") == "1"
+RETRO_WRITE_BEHIND_MS = float(os.getenv("RETRO_WRITE_BEHIND_MS", "5"))
+
+# How many of each retro's recent broadcasts are kept so reconnecting clients
+# can catch up without a full init.
+RETRO_RESUME_FRAMES = int(os.getenv("RETRO_RESUME_FRAMES", "256"))
+
+# Flow control for clients that ack what they've received (see main.outbound):
+# how many frames may be unacked, and how much can wait for a slow client
+# before it's resynced with an init, or dropped if that didn't help.
+RETRO_OUTBOUND_WINDOW = int(os.getenv("RETRO_OUTBOUND_WINDOW", "64"))
+RETRO_OUTBOUND_MAX_FRAMES = int(os.getenv("RETRO_OUTBOUND_MAX_FRAMES", "256"))
+RETRO_OUTBOUND_MAX_BYTES = int(os.getenv("RETRO_OUTBOUND_MAX_BYTES", str(1024 * 1024)))
+
+# RETRO_WS_DEFLATE=1 has daphne compress websocket frames (permessage-deflate)
+# for clients that offer it. Costs CPU and a compression window per socket.
+RETRO_WS_DEFLATE = os.getenv("RETRO_WS_DEFLATE", "0") == "1"
+
+# Token bucket limits on how fast each connection, and each retro as a whole,
+# can send each type of action, as (per second, burst). Actions over a limit
+# are dropped before any work's done (see main.ratelimit). RETRO_RATE_LIMIT=0
+# turns the limits off.
+RETRO_RATE_LIMIT = os.getenv("RETRO_RATE_LIMIT", "1") == "1"
+_PHASE_CHANGE_LIMITS = {"connection": (1, 5), "retro": (2, 10)}
+RETRO_RATE_LIMITS = {
+    "join": {"connection": (1, 5), "retro": (20, 50)},
+    "start": _PHASE_CHANGE_LIMITS,
+    "addTopic": {"connection": (5, 20), "retro": (50, 200)},
+    "goToGrouping": _PHASE_CHANGE_LIMITS,
+    # Sent while dragging, up to every 50ms or so.
+    "moveTopic": {"connection": (60, 120), "retro": (600, 1200)},
+    "dropTopic": {"connection": (10, 30), "retro": (100, 300)},
+    "goToVoting": _PHASE_CHANGE_LIMITS,
+    "setVotes": {"connection": (5, 20), "retro": (50, 200)},
+    "goToDiscussion": _PHASE_CHANGE_LIMITS,
+    "addAction": {"connection": (5, 20), "retro": (50, 200)},
+    # Every 15 seconds from each open tab (see main.presence).
+    "heartbeat": {"connection": (1, 5), "retro": (50, 100)},
+    # Anything else, which is ignored anyway.
+    "other": {"connection": (5, 20), "retro": (50, 100)},
+}
+
+# Seconds without hearing from a connection, not even its heartbeat, before
+# whoever it is counts as gone (see main.presence).
+RETRO_PRESENCE_TIMEOUT = float(os.getenv("RETRO_PRESENCE_TIMEOUT", "45"))
+
+# Directory to record a trace of everything clients send each retro to, for
+# `manage.py retro_replay` (see main.record). Unset, nothing's recorded.
+RETRO_RECORD_DIR = os.getenv("RETRO_RECORD_DIR")
+
+# How often positions of topics being dragged are relayed to a retro.
+RETRO_DRAG_TICK_HZ = 20
+
+# Worker processes `manage.py serve` forks (see main.serve), 0 for one per
+# CPU, and how many MB of its own memory a worker can use before it's
+# replaced, 0 for no limit.
+RETRO_WORKERS = int(os.getenv("RETRO_WORKERS", "0"))
+RETRO_WORKER_MAX_MB = int(os.getenv("RETRO_WORKER_MAX_MB", "512"))
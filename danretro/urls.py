@@ -13,15 +13,14 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-from django.contrib import admin
 from django.urls import path
 
 from main import views
 
 urlpatterns = [
-    # path('admin/', admin.site.urls),
     path("", views.index),
     path("retros/", views.retros, {"id": None}),
     path("retros/<str:id>", views.retros),
     path("static/<str:path>", views.static),
+    path("metrics", views.metrics),
 ]
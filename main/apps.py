@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+from main.db import tune_sqlite
 
 
 class MainConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "main"
+
+    def ready(self):
+        connection_created.connect(tune_sqlite)
+        if settings.RETRO_WS_DEFLATE:
+            from main.wire import enable_permessage_deflate
+
+            enable_permessage_deflate()
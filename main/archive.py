@@ -0,0 +1,108 @@
+"""Moving retros nobody's using out of the hot tables, and back on demand.
+
+An archived retro is one RetroArchive row holding its latest snapshot and
+its whole event log as zlib compressed JSON:
+
+    {
+        "created": <iso datetime>,
+        "seq": <last event seq>,
+        "snapshot": <main.state.snapshot_data() as of seq>,
+        "events": [[seq, type, data, <iso datetime>], ...],
+    }
+
+and none of its other rows. Restoring puts the rows back with the same ids,
+so the events and votes still refer to the right things, plus a snapshot so
+it loads in two queries. `manage.py archive_retros` picks what to archive.
+RetroSession.open() and views.retros restore.
+
+Retros that may be open anywhere aren't archived: ones open in this
+process, and ones changed or open elsewhere (see Retro.last_seen) within
+ACTIVE_FOR. One archived anyway while it's open, say by a process that
+went quiet for longer than that, is restored by the next action that
+finds its rows gone (see RetroSession.handle()).
+"""
+import json
+import zlib
+from datetime import datetime, timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from main.models import *
+from main.state import RetroState, from_snapshot, retro_states, snapshot_data
+
+# Children first since every foreign key is PROTECT.
+_HOT_MODELS = [RetroEvent, RetroSnapshot, Topic, Cluster, Person, ActionItem]
+
+# Well over main.state.LAST_SEEN_EVERY, so open retros are always this recent.
+ACTIVE_FOR = timedelta(minutes=10)
+
+
+def archive(retro_uuid, active_for=ACTIVE_FOR) -> int | None:
+    """Archives a retro and deletes its rows. Returns the blob's size, or None
+    if there's no such retro or it may still be open somewhere."""
+    if not retro_states.discard(retro_uuid):
+        return None
+    with transaction.atomic():
+        # Locked so no process can add to it while it's archived, on
+        # databases that can. On SQLite one that does makes the deletes fail.
+        retro = Retro.objects.select_for_update().filter(pk=retro_uuid).first()
+        if retro is None or _active_since(retro, timezone.now() - active_for):
+            return None
+        state = RetroState.load(retro_uuid)
+        events = RetroEvent.objects.filter(retro_id=retro_uuid).order_by("seq", "pk")
+        data = {
+            "created": state.retro.created.isoformat(),
+            "seq": state.seq,
+            "snapshot": snapshot_data(state),
+            "events": [[e.seq, e.type, e.data, e.created.isoformat()] for e in events],
+        }
+        blob = zlib.compress(json.dumps(data, separators=(",", ":")).encode(), 9)
+        RetroArchive.objects.create(uuid=retro_uuid, data=blob)
+        for model in _HOT_MODELS:
+            model.objects.filter(retro_id=retro_uuid).delete()
+        Retro.objects.filter(pk=retro_uuid).delete()
+    return len(blob)
+
+
+def _active_since(retro, since):
+    if retro.last_seen is not None and retro.last_seen >= since:
+        return True
+    return RetroEvent.objects.filter(retro_id=retro.pk, created__gte=since).exists()
+
+
+def restore(retro_uuid) -> bool:
+    """Puts an archived retro's rows back. Returns whether the retro exists
+    now, which it also does if someone else restored it first."""
+    archived = RetroArchive.objects.filter(uuid=retro_uuid).first()
+    if archived is None:
+        return Retro.objects.filter(pk=retro_uuid).exists()
+    data = json.loads(zlib.decompress(archived.data))
+    retro = Retro(uuid=retro_uuid, created=datetime.fromisoformat(data["created"]))
+    retro, people, topics, clusters, actions = from_snapshot(retro, data["snapshot"])
+    with transaction.atomic():
+        # Claiming the archive is the first write so that of two restores at
+        # once the second waits for the first, then finds it gone. Locking it
+        # with select_for_update() instead does nothing on SQLite.
+        if not RetroArchive.objects.filter(uuid=retro_uuid).delete()[0]:
+            return Retro.objects.filter(pk=retro_uuid).exists()
+        retro.save(force_insert=True)
+        # Clusters before the topics in them.
+        Cluster.objects.bulk_create(clusters)
+        Topic.objects.bulk_create(topics)
+        Person.objects.bulk_create(people)
+        ActionItem.objects.bulk_create(actions)
+        RetroEvent.objects.bulk_create(
+            RetroEvent(
+                retro=retro,
+                seq=seq,
+                type=type,
+                data=event_data,
+                created=datetime.fromisoformat(created),
+            )
+            for seq, type, event_data, created in data["events"]
+        )
+        RetroSnapshot.objects.create(
+            retro=retro, seq=data["seq"], data=data["snapshot"]
+        )
+    return True
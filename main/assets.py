@@ -0,0 +1,187 @@
+"""The files in static/, read, fingerprinted and compressed once.
+
+Everything is kept in memory, so serving a file is a dict lookup. Each
+file can be fetched by its plain name or a fingerprinted one with a hash of
+its contents, like main.1a2b3c4d5e.js. References to /static/<name> in html
+files are rewritten to the fingerprinted names. That way only the html has
+to be revalidated, with its ETag, and everything else can be cached for a
+year.
+
+Responses are gzipped, or brotli'd when the optional brotli package is
+installed, if the client accepts it and it's smaller.
+
+With DEBUG on, files are reloaded when they change so editing main.js
+doesn't need a restart.
+"""
+import gzip
+import hashlib
+import mimetypes
+import re
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+
+try:
+    import brotli
+except ImportError:  # It's optional.
+    brotli = None
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+class Asset:
+    def __init__(self, name, body: bytes):
+        self.name = name
+        self.body = body
+        self.content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if self.content_type.startswith("text/") or name.endswith(".js"):
+            self.content_type += "; charset=utf-8"
+        digest = hashlib.sha256(body).hexdigest()
+        # By content coding, None for none. Each has its own since the bytes
+        # differ, or caches could hand a gzip response to one that can't
+        # take it.
+        self.etags = {None: f'"{digest[:20]}"'}
+        self.etags.update(
+            (coding, f'"{digest[:20]}-{suffix}"')
+            for coding, suffix in _ETAG_SUFFIXES.items()
+        )
+        stem, dot, ext = name.rpartition(".")
+        self.hashed_name = f"{stem}.{digest[:10]}.{ext}" if dot else name
+        # By content coding, only where they're smaller.
+        self.encoded: dict[str, bytes] = {}
+        for coding, compress in _compressors().items():
+            data = compress(body)
+            if len(data) < len(body):
+                self.encoded[coding] = data
+
+
+_ETAG_SUFFIXES = {"gzip": "gz", "br": "br"}
+
+
+def _compressors():
+    compressors = {"gzip": lambda data: gzip.compress(data, mtime=0)}
+    if brotli is not None:
+        compressors["br"] = brotli.compress
+    return compressors
+
+
+class AssetStore:
+    def __init__(self, directory: Path, reload=False):
+        self.directory = directory
+        self.reload = reload
+        self._lock = threading.Lock()
+        self._mtimes: dict[str, int] = {}
+        self._assets: dict[str, Asset] = {}
+        self._by_hashed_name: dict[str, Asset] = {}
+        self.load()
+
+    def load(self):
+        files = sorted(p for p in self.directory.iterdir() if p.is_file())
+        bodies = {p.name: p.read_bytes() for p in files}
+        assets = {
+            name: Asset(name, body)
+            for name, body in bodies.items()
+            if not name.endswith(".html")
+        }
+        for name, body in bodies.items():
+            if name.endswith(".html"):
+                assets[name] = Asset(name, _link_hashed_names(body, assets))
+        with self._lock:
+            self._mtimes = {p.name: p.stat().st_mtime_ns for p in files}
+            self._assets = assets
+            self._by_hashed_name = {a.hashed_name: a for a in assets.values()}
+
+    def _changed(self):
+        try:
+            mtimes = {
+                p.name: p.stat().st_mtime_ns
+                for p in self.directory.iterdir()
+                if p.is_file()
+            }
+        except OSError:
+            return True
+        return mtimes != self._mtimes
+
+    def get(self, name):
+        """Returns (asset, whether name is its fingerprinted one) or raises Http404."""
+        if self.reload and self._changed():
+            self.load()
+        asset = self._by_hashed_name.get(name)
+        if asset is not None and name != asset.name:
+            return asset, True
+        asset = self._assets.get(name)
+        if asset is None:
+            raise Http404(name)
+        return asset, False
+
+    def serve(self, request, name):
+        asset, hashed = self.get(name)
+        coding = _pick_coding(request.headers.get("Accept-Encoding", ""), asset)
+        headers = {
+            "ETag": asset.etags[coding],
+            "Cache-Control": IMMUTABLE if hashed else REVALIDATE,
+            "Vary": "Accept-Encoding",
+        }
+        if asset.etags[coding] in _etags(request.headers.get("If-None-Match", "")):
+            response = HttpResponseNotModified()
+            for header, value in headers.items():
+                response[header] = value
+            return response
+        body = asset.body
+        if coding is not None:
+            body = asset.encoded[coding]
+            headers["Content-Encoding"] = coding
+        response = HttpResponse(body, content_type=asset.content_type, headers=headers)
+        response["Content-Length"] = str(len(body))
+        return response
+
+
+def _link_hashed_names(html: bytes, assets: dict[str, Asset]) -> bytes:
+    def replace(match):
+        asset = assets.get(match.group(1).decode())
+        if asset is None:
+            return match.group(0)
+        return b"/static/" + asset.hashed_name.encode()
+
+    return re.sub(rb"/static/([\w.-]+)", replace, html)
+
+
+def _etags(header):
+    return {tag.strip().removeprefix("W/") for tag in header.split(",")}
+
+
+def _qvalues(accept_encoding):
+    """The q value of each coding in an Accept-Encoding header."""
+    qvalues = {}
+    for part in accept_encoding.split(","):
+        coding, *params = [p.strip() for p in part.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding.lower()] = q
+    return qvalues
+
+
+def _pick_coding(accept_encoding, asset: Asset):
+    """The accepted coding with the highest q, brotli on a tie, or None."""
+    qvalues = _qvalues(accept_encoding)
+    candidates = [
+        (qvalues.get(coding, qvalues.get("*", 0.0)), coding)
+        for coding in ["br", "gzip"]
+        if coding in asset.encoded
+    ]
+    accepted = [c for c in candidates if c[0] > 0]
+    return max(accepted, key=lambda c: c[0], default=(0, None))[1]
+
+
+assets = AssetStore(settings.STATIC_DIR, reload=settings.DEBUG)
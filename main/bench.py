@@ -0,0 +1,180 @@
+"""Helpers shared by the benchmark management commands.
+
+Benchmarks run against a throwaway test database and drive the consumers
+in-process with channels' WebsocketCommunicator, so they need neither a
+running server nor the dev database.
+"""
+import asyncio
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import re_path
+
+from main import consumers
+from main.routing import RETRO_PATH
+
+CONSUMERS = {
+    "sync": consumers.RetroConsumer,
+    "async": consumers.AsyncRetroConsumer,
+}
+
+
+@contextmanager
+def bench_database(sqlite_file=None):
+    """A throwaway test database for the duration.
+
+    On SQLite that's in memory unless sqlite_file names a file to use.
+    """
+    setup_test_environment()
+    old_name = connection.settings_dict["NAME"]
+    if sqlite_file is not None and connection.vendor == "sqlite":
+        connection.settings_dict["TEST"]["NAME"] = sqlite_file
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def websocket_app(consumer):
+    return URLRouter([re_path(RETRO_PATH, consumer.as_asgi())])
+
+
+class QueryCounter:
+    """Counts the queries made on every connection, from any thread, while on.
+
+    The consumers' database work happens in worker threads with their own
+    connections, so assertNumQueries style capturing on ours sees none of it.
+    Call attach() from such a thread to count a connection that's already
+    open there. New ones are picked up as they connect.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def attach(self, sender=None, connection=connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        connection_created.connect(self.attach)
+        self.attach()
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self.attach)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+
+def latency_summary(seconds):
+    return {
+        "count": len(seconds),
+        "p50_ms": _ms(percentile(seconds, 50)),
+        "p90_ms": _ms(percentile(seconds, 90)),
+        "p99_ms": _ms(percentile(seconds, 99)),
+        "max_ms": _ms(max(seconds, default=None)),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+# The most rss_kb() has said, which peak_rss_kb() is never below.
+_highest_rss_kb = 0
+
+
+def rss_kb():
+    """Current resident set size, falling back to the peak off Linux."""
+    global _highest_rss_kb
+    rss = _proc_status_kb("VmRSS")
+    if rss is None:
+        return peak_rss_kb()
+    _highest_rss_kb = max(_highest_rss_kb, rss)
+    return rss
+
+
+def peak_rss_kb():
+    """Peak resident set size, never below what rss_kb() has said."""
+    peak = _proc_status_kb("VmHWM")
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # It's in bytes on macOS and KB elsewhere.
+        if sys.platform == "darwin":
+            peak //= 1024
+    # The kernel updates the peak lazily, so it can lag the current size.
+    return max(peak, _highest_rss_kb, _proc_status_kb("VmRSS") or 0)
+
+
+def _proc_status_kb(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Client:
+    """One simulated participant talking to the app over a communicator."""
+
+    def __init__(self, app, retro_uuid, headers=None):
+        self.comm = WebsocketCommunicator(
+            app, f"/ws/retro/{retro_uuid}/", headers=headers
+        )
+        self.lost = False
+        self.received = 0
+
+    async def connect(self, timeout=10):
+        connected, _ = await self.comm.connect(timeout)
+        assert connected
+        return await self.recv(timeout)
+
+    async def send(self, msg):
+        await self.comm.send_to(text_data=json.dumps(msg))
+
+    async def recv(self, timeout=10):
+        msg = json.loads(await self.comm.receive_from(timeout))
+        self.received += 1
+        return msg
+
+    async def wait_for(self, match, timeout=10):
+        """Read messages until one satisfies match and return it.
+
+        Returns None and marks the client lost if nothing matches in time,
+        which is how dropped channel layer messages show up.
+        """
+        deadline = time.perf_counter() + timeout
+        while True:
+            try:
+                msg = await self.recv(max(deadline - time.perf_counter(), 0.001))
+            except asyncio.TimeoutError:
+                self.lost = True
+                return None
+            if match(msg):
+                return msg
+
+    async def close(self):
+        if not self.lost:
+            await self.comm.disconnect()
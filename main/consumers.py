@@ -1,207 +1,308 @@
-import json
+import asyncio
 
 from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.consumer import get_handler_name
+from channels.exceptions import ChannelFull
+from channels.generic.websocket import AsyncWebsocketConsumer, WebsocketConsumer
 
-from main.models import *
+from main import metrics
+from main.outbound import TOO_SLOW, Outbound
+from main.record import recorder
+from main.session import (
+    GAP_SECONDS,
+    Outbox,
+    RetroSession,
+    broadcast_event,
+    drag_text,
+    parse_ack,
+    parse_resume,
+)
+from main.wire import pick_codec
 
+# Keeps pending drag flushes and gap checks from being garbage collected
+# mid-sleep.
+_timers: set[asyncio.Task] = set()
 
-def init_msg(retro: Retro):
-    return {
-        "type": "init",
-        "state": retro.state,
-        "people": [people_dict(p) for p in retro.people.all()],
-        "topics": [topic_dict(t) for t in retro.topics.all()],
-        "clusters": [cluster_dict(c) for c in retro.clusters.all()],
-        "actions": [a.text for a in retro.action_items.all()],
-    }
 
+def _start_timer(coro):
+    task = asyncio.create_task(coro)
+    _timers.add(task)
+    task.add_done_callback(_timers.discard)
 
-def people_dict(person: Person):
-    return {
-        "name": person.name,
-        "numVotes": len(person.votes),
-    }
 
+def start_drag_flush(channel_layer, group, state, delay):
+    """Broadcasts the retro's drag positions in delay seconds.
 
-def topic_dict(topic: Topic):
-    return {
-        "text": topic.text,
-        "feeling": topic.feeling,
-        "x": topic.x,
-        "y": topic.y,
-    }
+    Must be called from the event loop.
+    """
+    _start_timer(_flush_drags(channel_layer, group, state, delay))
 
 
-def cluster_dict(cluster: Cluster):
-    return {
-        "id": cluster.pk,
-        "topics": [t.text for t in cluster.topics.all()],  # TODO switch to topic ids
-        "votes": cluster.votes,
-    }
+def start_gap_check(channel_layer, channel):
+    """Has the consumer on channel check for lost broadcasts in GAP_SECONDS,
+    in case no later broadcast comes to notice them by.
+
+    Must be called from the event loop.
+    """
+    _start_timer(_check_gaps(channel_layer, channel))
+
+
+async def _check_gaps(channel_layer, channel):
+    while True:
+        await asyncio.sleep(GAP_SECONDS)
+        try:
+            await channel_layer.send(channel, {"type": "gap.check"})
+            return
+        except ChannelFull:
+            # Try again once the consumer's worked through some.
+            pass
+
+
+async def _flush_drags(channel_layer, group, state, delay):
+    await asyncio.sleep(delay)
+    text = drag_text(state)
+    if text is not None:
+        await channel_layer.group_send(group, broadcast_event(text, changed=False))
 
 
-# TODO Rewrite as async- https://channels.readthedocs.io/en/stable/tutorial/part_3.html#rewrite-the-consumer-to-be-asynchronous
 class RetroConsumer(WebsocketConsumer):
+    # Where what the client sends is recorded, with RETRO_RECORD_DIR set.
+    recording = None
+    # Whether a gap_check() is on the way.
+    checking_gaps = False
+
     def connect(self):
-        self.retro_uuid = self.scope["url_route"]["kwargs"]["retro_id"]
-        self.person_name = None
+        self.session = RetroSession(
+            self.scope["url_route"]["kwargs"]["retro_id"], self.channel_name
+        )
 
-        self.channel_group_name = "retro_%s" % self.retro_uuid
+        self.channel_group_name = "retro_%s" % self.session.retro_uuid
 
         async_to_sync(self.channel_layer.group_add)(
             self.channel_group_name, self.channel_name
         )
 
-        self.accept()
+        self.codec = pick_codec(self.scope["subprotocols"])
+        self.outbound = Outbound()
+        self.accept(self.codec.subprotocol if self.scope["subprotocols"] else None)
 
-        retro = Retro.objects.get(uuid=self.retro_uuid)
-        self.send(text_data=json.dumps(init_msg(retro)))
+        for text in self.session.open(parse_resume(self.scope["query_string"])):
+            self.outbound.put(text)
+        self.recording = recorder.open(self.session.state)
+        self.flush()
 
     def disconnect(self, close_code):
+        if self.recording is not None:
+            self.recording.close()
         async_to_sync(self.channel_layer.group_discard)(
             self.channel_group_name, self.channel_name
         )
-
-    def receive(self, text_data):
-        retro = Retro.objects.get(uuid=self.retro_uuid)
-        person = None
-        if self.person_name:
-            person = retro.people.filter(name=self.person_name).first()
-        action = json.loads(text_data)
-
-        # TODO maybe move this into connect()
-        if action["type"] == "join":
-            # Whether or not the retro is in the initial joining stage, add them
-            # to the list of users.
-            self.person_name = action["name"]
-            retro.people.get_or_create(name=action["name"])
+        for text in self.session.close():
             async_to_sync(self.channel_layer.group_send)(
-                self.channel_group_name, {"type": "join", "name": self.person_name}
+                self.channel_group_name, broadcast_event(text)
             )
-            if retro.state != "joining":
-                # Send init to jump to wherever the retro is up to.
-                self.send(text_data=json.dumps(init_msg(retro)))
-
-        if retro.state == "joining":
-            if action["type"] == "start":
-                retro.state = "brainstorming"
-                retro.save()
-                async_to_sync(self.channel_layer.group_send)(
-                    self.channel_group_name, {"type": "send_init"}
-                )
-        elif retro.state == "brainstorming":
-            if action["type"] == "addTopic":
-                retro.topics.create(text=action["text"], feeling=action["list"])
-                async_to_sync(self.channel_layer.group_send)(
-                    self.channel_group_name,
-                    {
-                        "type": "add_topic",
-                        "list": action["list"],
-                        "text": action["text"],
-                    },
-                )
-            elif action["type"] == "goToGrouping":
-                retro.state = "grouping"
-                retro.set_initial_topic_positions()
-                retro.save()
-                async_to_sync(self.channel_layer.group_send)(
-                    self.channel_group_name, {"type": "send_init"}
-                )
-        elif retro.state == "grouping":
-            if action["type"] == "moveTopic":
-                t = retro.topics.filter(text=action["text"]).first()
-                t.x = action["x"]
-                t.y = action["y"]
-                # TODO:
-                # Once we have a persistent datastore though, we probably won't
-                # want to write every tiny little move to it (assuming we have a
-                # scheme to ensure that all users in a given retro will talk to the
-                # same app/web server). When we get there, we'll split this into 2
-                # actions: while-being-dragged movements, of which there will be
-                # many and which we will replicate to other browsers but not
-                # persist to the db, and done-with-drag movements which we will.
-                async_to_sync(self.channel_layer.group_send)(
-                    self.channel_group_name,
-                    {
-                        "type": "move_topic",
-                        "text": action["text"],
-                        "x": action["x"],
-                        "y": action["y"],
-                    },
-                )
-            elif action["type"] == "goToVoting":
-                for ac in action["clusters"]:
-                    topics = retro.topics.filter(text__in=ac)
-                    cluster = retro.clusters.create()
-                    cluster.topics.set(topics)
-                retro.state = "voting"
-                retro.save()
-                async_to_sync(self.channel_layer.group_send)(
-                    self.channel_group_name, {"type": "send_init"}
-                )
-        elif retro.state == "voting":
-            if action["type"] == "setVotes":
-                person.votes = [int(v) for v in action["votes"]]
-                person.save()
-                async_to_sync(self.channel_layer.group_send)(
-                    self.channel_group_name,
-                    {
-                        "type": "update_votes",
-                    },
-                )
-            elif action["type"] == "goToDiscussion":
-                retro.tally_votes_and_save()
-                retro.state = "discussion"
-                retro.save()
-                async_to_sync(self.channel_layer.group_send)(
-                    self.channel_group_name, {"type": "send_init"}
-                )
-        elif retro.state == "discussion":
-            if action["type"] == "addAction":
-                retro.action_items.create(text=action["text"])
-                # Kind of a hack but just re-init
-                async_to_sync(self.channel_layer.group_send)(
-                    self.channel_group_name, {"type": "send_init"}
-                )
-
-    def join(self, event):
-        self.send(text_data=json.dumps({"type": "join", "name": event["name"]}))
-
-    def send_init(self, event):
-        retro = Retro.objects.get(uuid=self.retro_uuid)
-        self.send(text_data=json.dumps(init_msg(retro)))
-
-    def add_topic(self, event):
-        self.send(
-            text_data=json.dumps(
-                {
-                    "type": "addTopic",
-                    "list": event["list"],
-                    "text": event["text"],
-                }
+
+    def receive(self, text_data=None, bytes_data=None):
+        metrics.received(text_data or bytes_data)
+        action = self.codec.read(text_data, bytes_data)
+        if self.recording is not None:
+            self.recording.action(self.session.state, action)
+        if action.get("type") == "ack":
+            received = parse_ack(action)
+            if received is not None:
+                self.outbound.ack(received)
+                self.flush()
+        elif self.session.allow(action):
+            self.deliver(self.session.handle(action))
+
+    def send(self, text_data=None, bytes_data=None, close=False):
+        metrics.sent(text_data or bytes_data or "")
+        super().send(text_data, bytes_data, close)
+
+    def deliver(self, out: Outbox):
+        for text in out.broadcasts:
+            metrics.BROADCAST_FANOUT.observe(self.session.state.connections)
+            async_to_sync(self.channel_layer.group_send)(
+                self.channel_group_name, broadcast_event(text)
             )
+        for text in out.replies:
+            self.outbound.put(text)
+        self.flush()
+        if out.flush_drags_in is not None:
+            async_to_sync(self.start_drag_flush)(out.flush_drags_in)
+
+    def flush(self):
+        """Sends what the client has room for, first resyncing or dropping it if
+        it's too far behind."""
+        if self.outbound.behind():
+            if self.outbound.resyncing():
+                self.outbound.drop()
+                self.close(TOO_SLOW)
+                return
+            self.outbound.resync(self.session.resync())
+        for text in self.outbound.take():
+            self.send(**self.codec.frame(text))
+
+    async def start_drag_flush(self, delay):
+        start_drag_flush(
+            self.channel_layer, self.channel_group_name, self.session.state, delay
         )
 
-    def move_topic(self, event):
-        self.send(
-            text_data=json.dumps(
-                {
-                    "type": "moveTopic",
-                    "text": event["text"],
-                    "x": event["x"],
-                    "y": event["y"],
-                }
-            )
+    async def start_gap_check(self):
+        start_gap_check(self.channel_layer, self.channel_name)
+
+    def broadcast(self, event):
+        self.session.saw_broadcast(event)
+        if self.session.missed(event):
+            # Whatever was lost, the init has it and this too.
+            self.outbound.resync(self.session.resync())
+        else:
+            self.outbound.put(event["text"])
+            if self.session.gaps and not self.checking_gaps:
+                self.checking_gaps = True
+                async_to_sync(self.start_gap_check)()
+        self.flush()
+
+    def gap_check(self, event):
+        self.checking_gaps = False
+        if self.session.gaps_lost():
+            self.outbound.resync(self.session.resync())
+            self.flush()
+        elif self.session.gaps:
+            self.checking_gaps = True
+            async_to_sync(self.start_gap_check)()
+
+
+class AsyncRetroConsumer(AsyncWebsocketConsumer):
+    """Same protocol as RetroConsumer without tying up a worker thread per frame.
+
+    Only the retro logic leaves the event loop, in a single
+    database_sync_to_async call per frame. Group events are forwarded as is, or
+    transcoded once per process for clients that picked another wire format
+    (see main.wire).
+    """
+
+    recording = None
+    # Whether a gap_check() is on the way.
+    checking_gaps = False
+
+    async def dispatch(self, message):
+        # Unlike AsyncConsumer's, doesn't close old database connections
+        # first, which costs a thread hop per frame and broadcast. Everything
+        # here that uses the database is a database_sync_to_async call, which
+        # does that itself.
+        handler = getattr(self, get_handler_name(message), None)
+        if handler is None:
+            raise ValueError("No handler for message type %s" % message["type"])
+        await handler(message)
+
+    async def connect(self):
+        self.session = RetroSession(
+            self.scope["url_route"]["kwargs"]["retro_id"], self.channel_name
         )
 
-    def update_votes(self, event):
-        retro = Retro.objects.get(uuid=self.retro_uuid)
-        self.send(
-            text_data=json.dumps(
-                {
-                    "type": "updateVotes",
-                    "people": [people_dict(p) for p in retro.people.all()],
-                }
-            )
+        self.channel_group_name = "retro_%s" % self.session.retro_uuid
+
+        await self.channel_layer.group_add(self.channel_group_name, self.channel_name)
+
+        self.codec = pick_codec(self.scope["subprotocols"])
+        self.outbound = Outbound()
+        await self.accept(
+            self.codec.subprotocol if self.scope["subprotocols"] else None
+        )
+
+        resume = parse_resume(self.scope["query_string"])
+        for text in await database_sync_to_async(self._open)(resume):
+            self.outbound.put(text)
+        await self.flush()
+
+    def _open(self, resume):
+        # Starting a recording takes the retro's lock and opens a file, so it
+        # comes along on the same thread hop.
+        frames = self.session.open(resume)
+        self.recording = recorder.open(self.session.state)
+        return frames
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(
+            self.channel_group_name, self.channel_name
         )
+        for text in await database_sync_to_async(self._close)():
+            await self.channel_layer.group_send(
+                self.channel_group_name, broadcast_event(text)
+            )
+
+    def _close(self):
+        if self.recording is not None:
+            self.recording.close()
+        return self.session.close()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        metrics.received(text_data or bytes_data)
+        action = self.codec.read(text_data, bytes_data)
+        if self.recording is not None:
+            self.recording.action(self.session.state, action)
+        if action.get("type") == "ack":
+            received = parse_ack(action)
+            if received is not None:
+                self.outbound.ack(received)
+                await self.flush()
+        elif self.session.allow(action):
+            out = await database_sync_to_async(self.session.handle)(action)
+            await self.deliver(out)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        metrics.sent(text_data or bytes_data or "")
+        await super().send(text_data, bytes_data, close)
+
+    async def deliver(self, out: Outbox):
+        for text in out.broadcasts:
+            metrics.BROADCAST_FANOUT.observe(self.session.state.connections)
+            await self.channel_layer.group_send(
+                self.channel_group_name, broadcast_event(text)
+            )
+        for text in out.replies:
+            self.outbound.put(text)
+        await self.flush()
+        if out.flush_drags_in is not None:
+            start_drag_flush(
+                self.channel_layer,
+                self.channel_group_name,
+                self.session.state,
+                out.flush_drags_in,
+            )
+
+    async def flush(self):
+        if self.outbound.behind():
+            if self.outbound.resyncing():
+                self.outbound.drop()
+                await self.close(TOO_SLOW)
+                return
+            self.outbound.resync(await database_sync_to_async(self.session.resync)())
+        for text in self.outbound.take():
+            await self.send(**self.codec.frame(text))
+
+    async def broadcast(self, event):
+        if self.session.from_elsewhere(event):
+            # The retro's lock can be held for database writes.
+            await database_sync_to_async(self.session.saw_broadcast)(event)
+        if self.session.missed(event):
+            resync = await database_sync_to_async(self.session.resync)()
+            self.outbound.resync(resync)
+        else:
+            self.outbound.put(event["text"])
+            if self.session.gaps and not self.checking_gaps:
+                self.checking_gaps = True
+                start_gap_check(self.channel_layer, self.channel_name)
+        await self.flush()
+
+    async def gap_check(self, event):
+        self.checking_gaps = False
+        if self.session.gaps_lost():
+            resync = await database_sync_to_async(self.session.resync)()
+            self.outbound.resync(resync)
+            await self.flush()
+        elif self.session.gaps:
+            self.checking_gaps = True
+            start_gap_check(self.channel_layer, self.channel_name)
@@ -0,0 +1,16 @@
+"""Database connection setup for the retro workload."""
+
+
+def tune_sqlite(sender, connection, **kwargs):
+    """Sets up each new SQLite connection for many threads writing little and often.
+
+    In WAL mode readers don't block the writer or the other way round, so
+    websocket threads stop tripping over "database is locked". With WAL,
+    synchronous=NORMAL only syncs at checkpoints. A power cut can lose the
+    last few commits but can't corrupt the database.
+    """
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
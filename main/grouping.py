@@ -0,0 +1,98 @@
+"""Which topics are grouped together, kept up to date as topics are dropped.
+
+Topics are grouped by overlapping on the grouping workspace, and groups are
+the connected components of that: a topic overlapping any topic in a group
+is in it. Every topic's box is TOPIC_BOX_WIDTH by TOPIC_BOX_HEIGHT with its
+top left at its x, y, so two overlap when they're at most that far apart on
+both axes (touching counts, like it did in the browser).
+
+Topics are bucketed by position in a grid of box sized cells, so the ones a
+dropped topic can overlap are in the 3x3 cells around it. Only the groups
+the dropped topic left or joined are worked out again.
+"""
+from main.models import TOPIC_BOX_HEIGHT, TOPIC_BOX_WIDTH
+
+
+class GroupingIndex:
+    def __init__(self):
+        self._positions: dict[int, tuple[int, int]] = {}
+        self._cells: dict[tuple[int, int], set[int]] = {}
+        self._overlaps: dict[int, set[int]] = {}
+        self._group_of: dict[int, frozenset[int]] = {}
+        # Goes up whenever groups() changes.
+        self.version = 0
+
+    def __contains__(self, topic_id):
+        return topic_id in self._positions
+
+    def move(self, topic_id, x, y):
+        """Puts a topic at x, y. Returns whether any groups changed."""
+        before = self._group_of.get(topic_id, frozenset([topic_id]))
+        if topic_id in self._positions:
+            self._cell(self._positions[topic_id]).discard(topic_id)
+            for other in self._overlaps[topic_id]:
+                self._overlaps[other].discard(topic_id)
+        self._positions[topic_id] = (x, y)
+        self._cell((x, y)).add(topic_id)
+        overlaps = self._overlaps[topic_id] = set(self._nearby(topic_id))
+        affected = set(before)
+        for other in overlaps:
+            self._overlaps[other].add(topic_id)
+            affected |= self._group_of[other]
+        old_groups = self._groups_of(affected)
+        self._regroup(affected)
+        if self._groups_of(affected) == old_groups:
+            return False
+        self.version += 1
+        return True
+
+    def groups(self) -> list[list[int]]:
+        """Groups of more than one topic, each sorted, in order of first topic."""
+        groups = {g for g in self._group_of.values() if len(g) > 1}
+        return sorted(sorted(g) for g in groups)
+
+    def clusters(self, topic_ids) -> list[list[int]]:
+        """Every one of topic_ids in exactly one cluster, ungrouped ones alone."""
+        clusters = {self._group_of.get(t, frozenset([t])) for t in topic_ids}
+        return sorted(sorted(c) for c in clusters)
+
+    def _cell(self, position):
+        x, y = position
+        key = (x // TOPIC_BOX_WIDTH, y // TOPIC_BOX_HEIGHT)
+        return self._cells.setdefault(key, set())
+
+    def _nearby(self, topic_id):
+        """The topics overlapping this one."""
+        x, y = self._positions[topic_id]
+        cx, cy = x // TOPIC_BOX_WIDTH, y // TOPIC_BOX_HEIGHT
+        for i in range(cx - 1, cx + 2):
+            for j in range(cy - 1, cy + 2):
+                for other in self._cells.get((i, j), ()):
+                    ox, oy = self._positions[other]
+                    if (
+                        other != topic_id
+                        and abs(ox - x) <= TOPIC_BOX_WIDTH
+                        and abs(oy - y) <= TOPIC_BOX_HEIGHT
+                    ):
+                        yield other
+
+    def _groups_of(self, topic_ids):
+        groups = (self._group_of.get(t) for t in topic_ids)
+        return {g for g in groups if g is not None and len(g) > 1}
+
+    def _regroup(self, topic_ids):
+        """Works out the groups of topic_ids again, which must be whole groups."""
+        left = set(topic_ids)
+        while left:
+            start = left.pop()
+            group = {start}
+            todo = [start]
+            while todo:
+                for other in self._overlaps[todo.pop()]:
+                    if other not in group:
+                        group.add(other)
+                        todo.append(other)
+            left -= group
+            group = frozenset(group)
+            for t in group:
+                self._group_of[t] = group
@@ -0,0 +1,271 @@
+import asyncio
+import json
+import logging
+import random
+import string
+import time
+import uuid
+
+from channels import layers
+from channels.exceptions import ChannelFull
+
+from main import metrics
+from main.resp import RespClient, RespError, RespSubscriber, parse_url
+
+logger = logging.getLogger(__name__)
+
+# Seconds between sweeps for expired messages and group memberships.
+CLEAN_EXPIRED_EVERY = 1.0
+
+# Longest wait between attempts to get back to Redis after losing it.
+RECONNECT_MAX_DELAY = 5.0
+
+
+class InMemoryChannelLayer(layers.InMemoryChannelLayer):
+    """channels' in-memory layer, sweeping for expired things at most once a
+    second.
+
+    The original sweeps every channel and group member on each receive(),
+    and every frame, broadcast and connect is one, so a burst of connections
+    costs the square of their number. Messages expire after a minute and
+    memberships after a day, so a second late doesn't matter.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._last_clean = 0.0
+
+    def _clean_expired(self):
+        now = time.monotonic()
+        if now - self._last_clean >= CLEAN_EXPIRED_EVERY:
+            self._last_clean = now
+            super()._clean_expired()
+
+    async def group_send(self, group, message):
+        """Like the original, without a task per member, and counting the
+        messages members that are too far behind miss out on."""
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        self._clean_expired()
+        for channel in list(self.groups.get(group, ())):
+            try:
+                await self.send(channel, message)
+            except ChannelFull:
+                metrics.CHANNEL_FULL.inc()
+
+
+class RedisPubSubChannelLayer(InMemoryChannelLayer):
+    """Channel layer for serving retros from more than one process or machine.
+
+    Channels and group membership live in this process just like with
+    InMemoryChannelLayer. On top of that group messages are published to
+    Redis on "<prefix>group:<group>" and every other process with members in
+    the group delivers them to its own members. Messages for a specific
+    channel that lives in another process go to that process's
+    "<prefix>node:<node>".
+
+    With affinity on, group messages are delivered locally first and only
+    published while some other process has members in the group too.
+    Processes announce themselves on a group's channel when they first join
+    it, and PUBLISH's receiver count tells when they've all left. So a retro
+    whose participants are all routed to the same process never touches
+    Redis.
+
+    If either connection to Redis drops, the layer redials in the background
+    until it's back, then subscribes again and announces itself in all its
+    groups. Broadcasts published elsewhere meanwhile are missed. A publish
+    that finds the connection gone redials and tries once more, then raises
+    ConnectionError.
+    """
+
+    def __init__(
+        self, url="redis://localhost:6379", prefix="retro:", affinity=True, **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.url = url
+        # For logs, which shouldn't have the password.
+        self._address = "%s:%d" % parse_url(url)[:2]
+        self.prefix = prefix
+        self.affinity = affinity
+        self.node = uuid.uuid4().hex[:12]
+        self.stats = {"published": 0, "kept_local": 0, "received": 0}
+        # Groups that other processes might have members in.
+        self._remote_groups: set[str] = set()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._ready: asyncio.Task | None = None
+        self._client: RespClient | None = None
+        self._subscriber: RespSubscriber | None = None
+        self._reconnecting: asyncio.Task | None = None
+
+    async def new_channel(self, prefix="specific"):
+        suffix = "".join(random.choice(string.ascii_letters) for i in range(12))
+        return f"{prefix}.{self.node}!{suffix}"
+
+    async def send(self, channel, message):
+        node = _channel_node(channel)
+        if node is None or node == self.node:
+            return await super().send(channel, message)
+        await self._publish(
+            f"{self.prefix}node:{node}", {"channel": channel, "message": message}
+        )
+
+    async def group_add(self, group, channel):
+        first = group not in self.groups
+        await super().group_add(group, channel)
+        if first:
+            # Assume there are other members elsewhere until a publish says not.
+            self._remote_groups.add(group)
+            await self._connect()
+            try:
+                await self._subscriber.subscribe(self._group_channel(group))
+            except ConnectionError:
+                # Reconnecting subscribes to it along with the rest.
+                return
+            await self._publish(self._group_channel(group), {"join": True})
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        if group not in self.groups:
+            self._remote_groups.discard(group)
+            await self._connect()
+            try:
+                await self._subscriber.unsubscribe(self._group_channel(group))
+            except ConnectionError:
+                # Reconnecting leaves it out.
+                pass
+
+    async def group_send(self, group, message):
+        await super().group_send(group, message)
+        local = group in self.groups
+        if self.affinity and local and group not in self._remote_groups:
+            self.stats["kept_local"] += 1
+            return
+        receivers = await self._publish(
+            self._group_channel(group), {"message": message}
+        )
+        # We're one of the receivers if we have members ourselves.
+        if receivers <= int(local):
+            self._remote_groups.discard(group)
+
+    async def flush(self):
+        await super().flush()
+        self._remote_groups.clear()
+
+    async def close(self):
+        if self._loop is asyncio.get_running_loop():
+            if self._reconnecting is not None:
+                self._reconnecting.cancel()
+            if self._ready is not None:
+                await asyncio.wait([self._ready])
+            await self._close_connections()
+        self._loop = self._ready = self._reconnecting = None
+        self._client = self._subscriber = None
+
+    def _group_channel(self, group):
+        return f"{self.prefix}group:{group}"
+
+    async def _publish(self, redis_channel, payload):
+        payload["node"] = self.node
+        data = json.dumps(payload)
+        try:
+            await self._connect()
+            receivers = await self._client.execute("PUBLISH", redis_channel, data)
+        except ConnectionError:
+            # Lost since it was last used. The second go redials.
+            await self._connect()
+            receivers = await self._client.execute("PUBLISH", redis_channel, data)
+        self.stats["published"] += 1
+        return receivers
+
+    async def _connect(self):
+        # Connections belong to the event loop they were made on, so start
+        # over if we're being used from a new one.
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._client = self._subscriber = None
+            self._ready = None
+        if self._ready is None or self._lost():
+            self._ready = loop.create_task(self._open())
+        await self._ready
+
+    def _lost(self):
+        """Whether the connections failed to open or have dropped since."""
+        if not self._ready.done():
+            return False
+        if self._ready.cancelled() or self._ready.exception() is not None:
+            return True
+        return self._client.lost or self._subscriber.lost
+
+    async def _open(self):
+        await self._close_connections()
+        self._client = await RespClient.connect(self.url, self._on_lost)
+        self._subscriber = await RespSubscriber.connect(
+            self.url, self._on_message, self._on_lost
+        )
+        groups = list(self.groups)
+        await self._subscriber.subscribe(
+            f"{self.prefix}node:{self.node}",
+            *(self._group_channel(g) for g in groups),
+        )
+        # Others may have stopped sending us a group's messages while we were
+        # gone, or joined it without us hearing.
+        self._remote_groups.update(groups)
+        payload = json.dumps({"join": True, "node": self.node})
+        for group in groups:
+            await self._client.execute("PUBLISH", self._group_channel(group), payload)
+
+    async def _close_connections(self):
+        for connection in (self._client, self._subscriber):
+            if connection is not None:
+                await connection.close()
+
+    def _on_lost(self):
+        if self._reconnecting is None or self._reconnecting.done():
+            logger.warning(
+                "Lost connection to Redis at %s, reconnecting", self._address
+            )
+            self._reconnecting = self._loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        delay = 0.1
+        while True:
+            try:
+                await self._connect()
+                if not self._lost():
+                    return
+            except OSError:
+                pass
+            except RespError as e:
+                logger.error("Redis at %s refused us: %s", self._address, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def _on_message(self, redis_channel, data):
+        payload = json.loads(data)
+        if payload["node"] == self.node:
+            return
+        self.stats["received"] += 1
+        if "channel" in payload:
+            deliver = super().send(payload["channel"], payload["message"])
+        else:
+            group = redis_channel[len(self._group_channel("")) :]
+            self._remote_groups.add(group)
+            if "join" in payload:
+                return
+            deliver = super().group_send(group, payload["message"])
+        self._loop.create_task(_ignore_full(deliver))
+
+
+async def _ignore_full(deliver):
+    # Same as InMemoryChannelLayer.group_send, a full channel drops messages.
+    try:
+        await deliver
+    except ChannelFull:
+        metrics.CHANNEL_FULL.inc()
+
+
+def _channel_node(channel):
+    if "!" not in channel:
+        return None
+    return channel.split("!", 1)[0].rpartition(".")[2]
@@ -0,0 +1,64 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Q
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from main.archive import ACTIVE_FOR, archive
+from main.models import Retro
+
+
+class Command(BaseCommand):
+    help = (
+        "Move retros nobody's using into RetroArchive, one compressed row each, "
+        "and delete their other rows. That's finished retros (in discussion) "
+        "with no changes for --finished-hours, and any retro with none for "
+        "--idle-days, or just the given ones. Retros changed or open within "
+        "--active-minutes are left alone. They're restored when next opened."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("retro_uuids", nargs="*")
+        parser.add_argument("--finished-hours", type=float, default=24)
+        parser.add_argument("--idle-days", type=float, default=30)
+        parser.add_argument(
+            "--active-minutes",
+            type=float,
+            default=ACTIVE_FOR.total_seconds() / 60,
+        )
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        uuids = options["retro_uuids"] or _idle_retros(
+            timedelta(hours=options["finished_hours"]),
+            timedelta(days=options["idle_days"]),
+        )
+        archived = total = 0
+        for uuid in uuids:
+            if options["dry_run"]:
+                self.stdout.write(f"Would archive {uuid}")
+                continue
+            size = archive(uuid, timedelta(minutes=options["active_minutes"]))
+            if size is None:
+                self.stdout.write(f"Skipped {uuid}, it's missing or may be open")
+                continue
+            archived += 1
+            total += size
+            self.stdout.write(f"Archived {uuid} in {size} bytes")
+        if not options["dry_run"]:
+            self.stdout.write(f"Archived {archived} retros in {total} bytes")
+
+
+def _idle_retros(finished_for, idle_for):
+    now = timezone.now()
+    retros = Retro.objects.annotate(
+        last_change=Greatest(
+            Coalesce(Max("events__created"), "created"),
+            Coalesce("last_seen", "created"),
+        )
+    ).filter(
+        Q(state="discussion", last_change__lt=now - finished_for)
+        | Q(last_change__lt=now - idle_for)
+    )
+    return list(retros.values_list("uuid", flat=True))
@@ -0,0 +1,59 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.views.static import serve
+
+from main import views
+from main.assets import assets
+
+
+class Command(BaseCommand):
+    help = (
+        "Requests/sec serving static/main.js with django.views.static.serve, "
+        "as it used to be, and from main.assets: a first load, a gzipped one, "
+        "a conditional one answered with 304 and one by fingerprinted name. "
+        "Calls the views directly, so it's the cost of the view alone."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=5000)
+        parser.add_argument("--name", default="main.js")
+
+    def handle(self, *args, **options):
+        name = options["name"]
+        # No checking for changed files, as in production.
+        assets.reload = False
+        asset, _ = assets.get(name)
+        factory = RequestFactory()
+        plain = factory.get(f"/static/{name}")
+        gzipped = factory.get(f"/static/{name}", HTTP_ACCEPT_ENCODING="gzip")
+        cached = factory.get(f"/static/{name}", HTTP_IF_NONE_MATCH=asset.etags[None])
+        scenarios = {
+            "django_serve": lambda: serve(plain, name, settings.STATIC_DIR),
+            "assets": lambda: views.static(plain, name),
+            "assets_gzip": lambda: views.static(gzipped, name),
+            "assets_304": lambda: views.static(cached, name),
+            "assets_hashed": lambda: views.static(gzipped, asset.hashed_name),
+        }
+        results = {}
+        for scenario, view in scenarios.items():
+            results[scenario] = _measure(view, options["requests"])
+        self.stdout.write(json.dumps(results, indent=2))
+
+
+def _measure(view, requests):
+    response = view()
+    start = time.perf_counter()
+    for _ in range(requests):
+        # Read the body too, serve() streams it from the file.
+        b"".join(view())
+    secs = time.perf_counter() - start
+    return {
+        "status": response.status_code,
+        "bytes": len(b"".join(response)),
+        "cache_control": response.get("Cache-Control"),
+        "requests_per_sec": round(requests / secs),
+    }
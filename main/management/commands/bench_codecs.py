@@ -0,0 +1,105 @@
+import json
+import random
+import timeit
+import zlib
+
+from django.core.management.base import BaseCommand
+
+from main import wire
+from main.models import *
+from main.session import init_msg, move_dict, people_dict
+from main.state import RetroState
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the wire formats in main.wire on init, moveTopic and "
+        "updateVotes frames: microseconds to encode from the message, to "
+        "transcode from its JSON text (what consumers do), and bytes on the "
+        "wire with and without deflate."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--people", type=int, default=10)
+        parser.add_argument("--topics", type=int, default=40)
+        parser.add_argument("--runs", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        state = _voting_retro(options["people"], options["topics"])
+        topic = state.topics[0]
+        person = next(iter(state.people.values()))
+        messages = {
+            "init": {**init_msg(state), "epoch": "0123abcd", "seq": 1234},
+            "moveTopic": {"type": "moveTopic", **move_dict(topic, 640, 321)},
+            "updateVotes": {"type": "updateVotes", **people_dict(person), "seq": 9},
+        }
+        encoders = {
+            "json": json.dumps,
+            "compact": lambda msg: json.dumps(wire.pack_compact(msg)),
+        }
+        if wire.msgpack is not None:
+            encoders["msgpack"] = wire.msgpack.packb
+        results = {}
+        for name, msg in messages.items():
+            text = json.dumps(msg)
+            results[name] = {}
+            for codec, encode in encoders.items():
+                data = encode(msg)
+                if isinstance(data, str):
+                    data = data.encode()
+                results[name][codec] = {
+                    "encode_us": _us(lambda: encode(msg), options["runs"]),
+                    # JSON frames are sent as they are.
+                    "transcode_us": None
+                    if codec == "json"
+                    else _us(lambda: encode(json.loads(text)), options["runs"]),
+                    "bytes": len(data),
+                    "deflated_bytes": len(_deflate(data)),
+                }
+        self.stdout.write(json.dumps(results, indent=2))
+
+
+def _us(fn, runs):
+    return round(timeit.timeit(fn, number=runs) / runs * 1e6, 2)
+
+
+def _deflate(data):
+    # Like permessage-deflate without context takeover.
+    compressor = zlib.compressobj(wbits=-15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _voting_retro(num_people, num_topics):
+    """An in-memory retro part way through voting, with everyone connected.
+    Nothing's saved."""
+    rng = random.Random(0)
+    retro = Retro(state="voting")
+    clusters = [Cluster(id=i, retro=retro) for i in range(num_topics // 3)]
+    topics = [
+        Topic(
+            id=i,
+            retro=retro,
+            text=f"Topic number {i} about something that went well or didn't",
+            feeling=rng.choice(["happy", "sad", "confused"]),
+            x=rng.randint(0, GROUPING_WORKSPACE_WIDTH),
+            y=rng.randint(0, GROUPING_WORKSPACE_HEIGHT),
+            cluster_id=clusters[i % len(clusters)].pk,
+        )
+        for i in range(num_topics)
+    ]
+    people = [
+        Person(
+            id=i,
+            retro=retro,
+            name=f"Person {i}",
+            votes=[rng.choice(clusters).pk for _ in range(3)],
+        )
+        for i in range(num_people)
+    ]
+    for p in people:
+        for v in p.votes:
+            clusters[v].votes += 1
+    state = RetroState((retro, people, topics, clusters, [], 0), [])
+    for p in people:
+        state.join(f"channel {p.pk}", p.name)
+    return state
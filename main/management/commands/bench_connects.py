@@ -0,0 +1,86 @@
+import asyncio
+import json
+import time
+
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand
+
+from danretro.asgi import websocket_stack
+from main.bench import Client, QueryCounter, bench_database, latency_summary
+from main.models import Retro
+from main.state import retro_states
+
+# Browsers send an Origin, which AllowedHostsOriginValidator checks against
+# ALLOWED_HOSTS, which the test environment adds "testserver" to.
+HEADERS = [(b"origin", b"http://testserver")]
+
+
+class Command(BaseCommand):
+    help = (
+        "Connects/sec when everyone turns up at once. Every participant of "
+        "--retros retros that nobody has open yet connects at the same time, "
+        "waits for its init, joins and waits for the join to come back, through "
+        "danretro.asgi's websocket stack and settings.RETRO_CONSUMER's "
+        "consumer. Prints the best of --rounds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--retros", type=int, default=10)
+        parser.add_argument("--participants", type=int, default=30)
+        parser.add_argument("--topics", type=int, default=50, help="Per retro.")
+        parser.add_argument("--rounds", type=int, default=3)
+
+    def handle(self, *args, **options):
+        with bench_database():
+            runs = [
+                asyncio.run(storm(websocket_stack(), options))
+                for _ in range(options["rounds"])
+            ]
+        best = max(runs, key=lambda r: r["connects_per_sec"])
+        self.stdout.write(json.dumps(best, indent=2))
+
+
+async def storm(app, options):
+    retros = await database_sync_to_async(_retros)(options)
+    retro_states.clear()
+    clients = [
+        Client(app, retro.uuid, HEADERS)
+        for retro in retros
+        for _ in range(options["participants"])
+    ]
+    with QueryCounter() as queries:
+        start = time.perf_counter()
+        latencies = await asyncio.gather(
+            *(_arrive(c, f"p{i}") for i, c in enumerate(clients))
+        )
+        secs = time.perf_counter() - start
+    await asyncio.gather(*(c.close() for c in clients))
+    connects = [connect for connect, _ in latencies]
+    return {
+        "connections": len(clients),
+        "seconds": round(secs, 3),
+        "connects_per_sec": round(len(clients) / secs, 1),
+        "queries_per_connection": round(queries.count / len(clients), 2),
+        "connect": latency_summary(connects),
+        "connect_and_join": latency_summary([total for _, total in latencies]),
+        "lost": sum(c.lost for c in clients),
+    }
+
+
+async def _arrive(client, name):
+    start = time.perf_counter()
+    await client.connect()
+    connected = time.perf_counter() - start
+    await client.send({"type": "join", "name": name})
+    await client.wait_for(lambda m: m["type"] == "presence" and name in m["joined"])
+    return connected, time.perf_counter() - start
+
+
+def _retros(options):
+    retros = []
+    for _ in range(options["retros"]):
+        retro = Retro.objects.create(state="brainstorming")
+        for i in range(options["topics"]):
+            retro.topics.create(text=f"topic {i}", feeling="happy")
+        retros.append(retro)
+    return retros
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import time
+
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand
+
+from main import metrics
+from main.bench import (
+    CONSUMERS,
+    Client,
+    bench_database,
+    latency_summary,
+    rss_kb,
+    websocket_app,
+)
+from main.models import Retro
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the sync and async retro consumers. Ramps up the number of "
+        "participants in one grouping-phase retro, has each of them drop a topic "
+        "and reports the p99 dropTopic round trip and how many connections one "
+        "process holds before that p99 goes over budget."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--consumer", choices=["sync", "async", "both"], default="both"
+        )
+        parser.add_argument("--max-clients", type=int, default=160)
+        parser.add_argument("--moves", type=int, default=10)
+        parser.add_argument("--p99-budget-ms", type=float, default=100)
+
+    def handle(self, *args, **options):
+        names = list(CONSUMERS)
+        if options["consumer"] != "both":
+            names = [options["consumer"]]
+        results = {}
+        with bench_database():
+            for name in names:
+                runs = []
+                clients = 10
+                while clients <= options["max_clients"]:
+                    runs.append(
+                        asyncio.run(run(CONSUMERS[name], clients, options["moves"]))
+                    )
+                    clients *= 2
+                budget = options["p99_budget_ms"]
+                ok = [r["clients"] for r in runs if _within_budget(r, budget)]
+                results[name] = {
+                    "connections_per_process": max(ok, default=0),
+                    "runs": runs,
+                }
+        self.stdout.write(json.dumps(results, indent=2))
+
+
+def _within_budget(run, budget_ms):
+    return run["lost"] == 0 and run["latency"]["p99_ms"] <= budget_ms
+
+
+async def run(consumer, num_clients, moves):
+    retro, topic_ids = await database_sync_to_async(_grouping_retro)(num_clients)
+    app = websocket_app(consumer)
+    clients = [Client(app, retro.uuid) for _ in range(num_clients)]
+
+    rss_before = rss_kb()
+    channel_full = metrics.CHANNEL_FULL.total()
+    start = time.perf_counter()
+    await asyncio.gather(*(c.connect() for c in clients))
+    connect_secs = time.perf_counter() - start
+    rss_after = rss_kb()
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(
+        *(_drop(c, topic_id, moves) for topic_id, c in zip(topic_ids, clients))
+    )
+    move_secs = time.perf_counter() - start
+    latencies = [lat for lats in latencies for lat in lats]
+
+    await asyncio.gather(*(c.close() for c in clients))
+    return {
+        "clients": num_clients,
+        "connects_per_sec": round(num_clients / connect_secs, 1),
+        "rss_kb_per_connection": round((rss_after - rss_before) / num_clients, 1),
+        "messages_per_sec": round(len(latencies) / move_secs, 1),
+        "lost": sum(c.lost for c in clients),
+        "channel_full": metrics.CHANNEL_FULL.total() - channel_full,
+        "latency": latency_summary(latencies),
+    }
+
+
+async def _drop(client, topic_id, moves):
+    latencies = []
+    for x in range(moves):
+        start = time.perf_counter()
+        await client.send({"type": "dropTopic", "id": topic_id, "x": x, "y": 0})
+        msg = await client.wait_for(lambda m: _shows_drop(m, topic_id, x))
+        if msg is None:
+            break
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _shows_drop(msg, topic_id, x):
+    if msg["type"] == "moveTopic":
+        return msg["id"] == topic_id and msg["x"] == x
+    # Consumers that fall behind resync their client with an init.
+    return msg["type"] == "init" and any(
+        t["id"] == topic_id and t["x"] == x for t in msg["topics"]
+    )
+
+
+def _grouping_retro(num_topics):
+    retro = Retro.objects.create(state="grouping")
+    topics = [
+        retro.topics.create(text=f"topic-{i}", feeling="happy")
+        for i in range(num_topics)
+    ]
+    return retro, [t.pk for t in topics]
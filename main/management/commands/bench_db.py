@@ -0,0 +1,181 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, close_old_connections, connection
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+
+from main.bench import bench_database, latency_summary
+from main.db import tune_sqlite
+from main.metrics import QueryTimer
+from main.models import Retro
+from main.session import RetroSession
+from main.state import retro_states
+from main.writebehind import writer
+
+FEELINGS = ["happy", "sad", "confused"]
+
+# Database setups to compare. "default" is how Django comes: a connection per
+# request or frame and, on SQLite, a rollback journal synced on every commit.
+# "write_behind" is tuned plus RETRO_WRITE_BEHIND (see main.writebehind).
+PROFILES = {
+    "default": {"conn_max_age": 0, "tuned": False, "write_behind": False},
+    "tuned": {
+        "conn_max_age": settings.RETRO_DB_CONN_MAX_AGE,
+        "tuned": True,
+        "write_behind": False,
+    },
+    "write_behind": {
+        "conn_max_age": settings.RETRO_DB_CONN_MAX_AGE,
+        "tuned": True,
+        "write_behind": True,
+    },
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Per-action database time and wall time with the database as Django "
+        "sets it up by default, as tuned in main.db and settings, and tuned with "
+        "write-behind. Plays "
+        "--retros whole retros at once, each on its own thread like consumer "
+        "worker threads, through RetroSession against a throwaway database "
+        "(a file on SQLite, so journaling applies). Reports JSON, including "
+        "how many actions failed with errors like 'database is locked'."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--retros", type=int, default=8)
+        parser.add_argument("--participants", type=int, default=8)
+        parser.add_argument("--topics", type=int, default=3, help="Per participant.")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        results = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            with bench_database(sqlite_file=os.path.join(tmp, "bench.sqlite3")):
+                for name, profile in PROFILES.items():
+                    results[name] = _run(profile, options)
+        self.stdout.write(json.dumps(results, indent=2))
+
+
+def _run(profile, options):
+    connection.settings_dict["CONN_MAX_AGE"] = profile["conn_max_age"]
+    connection_created.disconnect(tune_sqlite)
+    if profile["tuned"]:
+        connection_created.connect(tune_sqlite)
+    elif connection.vendor == "sqlite":
+        # WAL sticks to the file, so undo it.
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=DELETE")
+    connection.close()
+    retro_states.clear()
+    try:
+        retros = [Retro.objects.create() for _ in range(options["retros"])]
+        connection.close()
+        timings: dict[str, list] = {}
+        errors: dict[str, int] = {}
+        threads = [
+            threading.Thread(
+                target=_play,
+                args=(r.uuid, i, options, random.Random(options["seed"] + i)),
+                kwargs={"timings": timings, "errors": errors},
+            )
+            for i, r in enumerate(retros)
+        ]
+        start = time.perf_counter()
+        with override_settings(RETRO_WRITE_BEHIND=profile["write_behind"]):
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            # Counts the time to commit what's still queued.
+            writer.flush()
+        secs = time.perf_counter() - start
+    finally:
+        connection_created.disconnect(tune_sqlite)
+        connection_created.connect(tune_sqlite)
+    return {
+        "conn_max_age": profile["conn_max_age"],
+        "tuned": profile["tuned"],
+        "write_behind": profile["write_behind"],
+        "seconds": round(secs, 3),
+        "errors": errors,
+        "actions": {
+            action: {
+                "queries_per_action": round(sum(q for q, _, _ in t) / len(t), 2),
+                "db": latency_summary([db for _, db, _ in t]),
+                "wall": latency_summary([wall for _, _, wall in t]),
+            }
+            for action, t in timings.items()
+        },
+    }
+
+
+def _play(retro_uuid, index, options, rng, timings, errors):
+    """One retro from joining to action items, on this thread.
+
+    Each action gets its own connection handling the way
+    database_sync_to_async gives it, closing connections past their age.
+    """
+
+    def act(name, fn):
+        close_old_connections()
+        queries = QueryTimer()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(queries):
+                result = fn()
+        except OperationalError:
+            errors[name] = errors.get(name, 0) + 1
+            return None
+        finally:
+            close_old_connections()
+        wall = time.perf_counter() - start
+        timings.setdefault(name, []).append((queries.count, queries.seconds, wall))
+        return result
+
+    sessions = [RetroSession(retro_uuid) for _ in range(options["participants"])]
+    for s in sessions:
+        act("connect", s.open)
+    for i, s in enumerate(sessions):
+        act("join", lambda: s.handle({"type": "join", "name": f"r{index}-p{i}"}))
+    facilitator = sessions[0]
+    act("start", lambda: facilitator.handle({"type": "start"}))
+    for s in sessions:
+        for k in range(options["topics"]):
+            text = f"r{index}-t{k}"
+            act(
+                "addTopic",
+                lambda: s.handle(
+                    {"type": "addTopic", "list": FEELINGS[k % 3], "text": text}
+                ),
+            )
+    act("goToGrouping", lambda: facilitator.handle({"type": "goToGrouping"}))
+    topic_ids = [t.pk for t in facilitator.state.topics]
+    for topic_id in topic_ids:
+        x, y = rng.randint(0, 1000), rng.randint(0, 700)
+        act(
+            "dropTopic",
+            lambda: facilitator.handle(
+                {"type": "dropTopic", "id": topic_id, "x": x, "y": y}
+            ),
+        )
+    act("goToVoting", lambda: facilitator.handle({"type": "goToVoting"}))
+    cluster_ids = [c.pk for c in facilitator.state.clusters]
+    for s in sessions:
+        votes = rng.choices(cluster_ids, k=3)
+        act("setVotes", lambda: s.handle({"type": "setVotes", "votes": votes}))
+    act("goToDiscussion", lambda: facilitator.handle({"type": "goToDiscussion"}))
+    for i, s in enumerate(sessions):
+        act("addAction", lambda: s.handle({"type": "addAction", "text": f"a{i}"}))
+    for s in sessions:
+        s.close()
+    close_old_connections()
+    connection.close()
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.layers import InMemoryChannelLayer, RedisPubSubChannelLayer
+from main.resp import FakeRedis
+from main.session import broadcast_event
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare group fan-out throughput of the in-memory channel layer and "
+        "the Redis pub/sub one, on one node with and without affinity and split "
+        "across two nodes. Uses an in-process fake Redis unless --redis-url is "
+        "given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--groups", type=int, default=10)
+        parser.add_argument("--members", type=int, default=30)
+        parser.add_argument("--messages", type=int, default=100)
+        parser.add_argument("--redis-url")
+
+    def handle(self, *args, **options):
+        results = asyncio.run(self.run(options))
+        self.stdout.write(json.dumps(results, indent=2))
+
+    async def run(self, options):
+        fake = None
+        url = options["redis_url"]
+        if not url:
+            fake = FakeRedis()
+            url = await fake.start()
+        config = {"capacity": options["messages"] + 10}
+
+        def redis(affinity):
+            return RedisPubSubChannelLayer(url=url, affinity=affinity, **config)
+
+        scenarios = {
+            "inmemory": lambda: [InMemoryChannelLayer(**config)],
+            "redis_one_node_affinity": lambda: [redis(True)],
+            "redis_one_node_no_affinity": lambda: [redis(False)],
+            "redis_two_nodes": lambda: [redis(True), redis(True)],
+        }
+        results = {}
+        for name, make_layers in scenarios.items():
+            layers = make_layers()
+            results[name] = await fan_out(
+                layers, options["groups"], options["members"], options["messages"]
+            )
+            for layer in layers:
+                await layer.close()
+        if fake is not None:
+            await fake.close()
+        return results
+
+
+async def fan_out(layers, num_groups, members, messages):
+    """Sends messages to each group from the first layer and times delivery.
+
+    Members are spread round robin across the layers, as if each layer was a
+    separate process.
+    """
+    receivers = []
+    for g in range(num_groups):
+        for m in range(members):
+            layer = layers[m % len(layers)]
+            channel = await layer.new_channel()
+            await layer.group_add(f"retro_{g}", channel)
+            receivers.append((layer, channel))
+    # Let the subscriptions land before anything is published.
+    await asyncio.sleep(0.1)
+
+    event = broadcast_event(
+        json.dumps({"type": "moveTopic", "text": "x" * 100}), changed=False
+    )
+
+    async def send(group):
+        for _ in range(messages):
+            await layers[0].group_send(group, event)
+
+    async def receive(layer, channel):
+        for _ in range(messages):
+            await layer.receive(channel)
+
+    start = time.perf_counter()
+    receiving = [asyncio.create_task(receive(*r)) for r in receivers]
+    await asyncio.gather(*(send(f"retro_{g}") for g in range(num_groups)))
+    done, pending = await asyncio.wait(receiving, timeout=30)
+    secs = time.perf_counter() - start
+    for task in pending:
+        task.cancel()
+
+    delivered = len(done) * messages
+    result = {
+        "sent": num_groups * messages,
+        "deliveries_per_sec": round(delivered / secs, 1),
+        "members_missing_messages": len(pending),
+    }
+    if isinstance(layers[0], RedisPubSubChannelLayer):
+        result["published"] = sum(layer.stats["published"] for layer in layers)
+    return result
@@ -0,0 +1,23 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from main.models import RetroEvent
+
+
+class Command(BaseCommand):
+    help = "Print a retro's event log, one JSON object per line, oldest first."
+
+    def add_arguments(self, parser):
+        parser.add_argument("retro_uuid")
+
+    def handle(self, *args, **options):
+        events = RetroEvent.objects.filter(retro_id=options["retro_uuid"])
+        for e in events.order_by("seq", "pk").iterator():
+            event = {
+                "seq": e.seq,
+                "type": e.type,
+                "data": e.data,
+                "created": e.created.isoformat(),
+            }
+            self.stdout.write(json.dumps(event))
@@ -0,0 +1,24 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from main.resp import FakeRedis
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a stand-in Redis server (pub/sub commands only) so several local "
+        "processes can share main.layers.RedisPubSubChannelLayer."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=6379)
+
+    def handle(self, *args, **options):
+        asyncio.run(self.serve(options["host"], options["port"]))
+
+    async def serve(self, host, port):
+        url = await FakeRedis().start(host, port)
+        self.stdout.write(f"Listening, use REDIS_URL={url}")
+        await asyncio.Event().wait()
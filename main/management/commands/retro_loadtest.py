@@ -0,0 +1,316 @@
+import asyncio
+import json
+import random
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main import metrics
+from main.bench import (
+    CONSUMERS,
+    Client,
+    QueryCounter,
+    bench_database,
+    latency_summary,
+    peak_rss_kb,
+    rss_kb,
+    websocket_app,
+)
+from main.models import Retro
+
+FEELINGS = ["happy", "sad", "confused"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate whole retros over websockets: everyone joins, adds topics, "
+        "drags and drops them, votes and adds action items while the first "
+        "participant moves the retro through its phases. Every retro does each "
+        "step at the same time. Reports messages/sec, per-action round trip "
+        "percentiles, database queries per step and peak RSS as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--consumer", choices=list(CONSUMERS), default=settings.RETRO_CONSUMER
+        )
+        parser.add_argument("--retros", type=int, default=5)
+        parser.add_argument("--participants", type=int, default=10)
+        parser.add_argument("--topics", type=int, default=3, help="Per participant.")
+        parser.add_argument("--moves", type=int, default=20, help="Per topic.")
+        parser.add_argument("--votes", type=int, default=3, help="Per participant.")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--flood",
+            action="store_true",
+            help="Meanwhile have a client in one more retro send addTopic as "
+            "fast as it can. Compare with RETRO_RATE_LIMIT=0.",
+        )
+
+    def handle(self, *args, **options):
+        with bench_database():
+            results = asyncio.run(run(options))
+        self.stdout.write(json.dumps(results, indent=2))
+
+
+async def run(options):
+    rng = random.Random(options["seed"])
+    app = websocket_app(CONSUMERS[options["consumer"]])
+    retros = []
+    for r in range(options["retros"]):
+        retro = await database_sync_to_async(Retro.objects.create)()
+        retros.append(SimulatedRetro(app, retro.uuid, r, options, rng))
+
+    flood = None
+    if options["flood"]:
+        retro = await database_sync_to_async(Retro.objects.create)()
+        flood = Flood(app, retro, options["participants"])
+        await flood.start()
+
+    rss_before = rss_kb()
+    latencies: dict[str, list[float]] = {}
+    queries: dict[str, int] = {}
+    steps = [
+        ("connect", lambda s: s.connect()),
+        ("join", lambda s: s.join()),
+        ("start", lambda s: s.transition("start", "brainstorming")),
+        ("addTopic", lambda s: s.add_topics()),
+        ("goToGrouping", lambda s: s.transition("goToGrouping", "grouping")),
+        ("moveTopic", lambda s: s.move_topics()),
+        ("goToVoting", lambda s: s.go_to_voting()),
+        ("setVotes", lambda s: s.set_votes()),
+        ("goToDiscussion", lambda s: s.transition("goToDiscussion", "discussion")),
+        ("addAction", lambda s: s.add_actions()),
+    ]
+    start = time.perf_counter()
+    with QueryCounter() as counter:
+        # Also count on the thread the consumers' database calls run on.
+        await database_sync_to_async(counter.attach)()
+        for name, step in steps:
+            before = counter.count
+            for result in await asyncio.gather(*(step(s) for s in retros)):
+                for action, seconds in result.items():
+                    latencies.setdefault(action, []).extend(seconds)
+            queries[name] = counter.count - before
+    secs = time.perf_counter() - start
+    if flood is not None:
+        await flood.stop()
+
+    clients = [c for s in retros for c in s.clients]
+    sent = sum(s.sent for s in retros)
+    received = sum(c.received for c in clients)
+    result = {
+        "consumer": options["consumer"],
+        "retros": options["retros"],
+        "participants": options["participants"],
+        "seconds": round(secs, 3),
+        "messages": {
+            "sent": sent,
+            "received": received,
+            "sent_per_sec": round(sent / secs, 1),
+            "received_per_sec": round(received / secs, 1),
+        },
+        "lost": sum(c.lost for c in clients),
+        "latency": {a: latency_summary(s) for a, s in latencies.items()},
+        "queries": {"total": sum(queries.values()), **queries},
+        "rss_kb": {"before": rss_before, "after": rss_kb(), "peak": peak_rss_kb()},
+    }
+    if flood is not None:
+        result["flood"] = {
+            "sent": flood.sent,
+            "rate_limited": metrics.RATE_LIMITED.total(),
+            "topics_added": await database_sync_to_async(flood.retro.topics.count)(),
+        }
+    await asyncio.gather(*(c.close() for c in clients))
+    return result
+
+
+class Flood:
+    """A client sending addTopic to its own retro back to back, never waiting.
+
+    The rest of the retro's participants are there to be broadcast to.
+    """
+
+    BATCH = 20
+
+    def __init__(self, app, retro, participants):
+        self.retro = retro
+        self.clients = [Client(app, retro.uuid) for _ in range(participants)]
+        self.client = self.clients[0]
+        self.sent = 0
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        for client in self.clients:
+            await client.connect()
+        await self.client.send({"type": "start"})
+        self._task = asyncio.create_task(self._flood())
+
+    async def _flood(self):
+        while True:
+            for _ in range(self.BATCH):
+                await self.client.send(
+                    {"type": "addTopic", "list": "sad", "text": f"spam {self.sent}"}
+                )
+                self.sent += 1
+            # Let the consumer and everyone else have a go.
+            await asyncio.sleep(0)
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(*(c.close() for c in self.clients))
+
+
+class SimulatedRetro:
+    """One retro's worth of clients. The first one is the facilitator.
+
+    Each step returns the round trips it measured by action type. A round
+    trip is from sending an action to the sender seeing its effect come back.
+    """
+
+    def __init__(self, app, retro_uuid, index, options, rng):
+        self.clients = [Client(app, retro_uuid) for _ in range(options["participants"])]
+        self.names = [f"r{index}-p{i}" for i in range(len(self.clients))]
+        self.options = options
+        self.rng = rng
+        self.sent = 0
+        # Ids of each client's topics, in client order.
+        self.topic_ids: list[list[int]] = [[] for _ in self.clients]
+        self.cluster_ids: list[int] = []
+        # The last init the facilitator saw.
+        self.init = None
+
+    async def send(self, client, msg):
+        self.sent += 1
+        await client.send(msg)
+
+    async def round_trip(self, client, msg, match):
+        start = time.perf_counter()
+        await self.send(client, msg)
+        reply = await client.wait_for(match)
+        return reply, time.perf_counter() - start
+
+    async def each(self, step):
+        """Runs step(i, client) for every client at once, skipping lost ones."""
+        results = await asyncio.gather(
+            *(step(i, c) for i, c in enumerate(self.clients) if not c.lost)
+        )
+        return [s for seconds in results for s in seconds]
+
+    async def connect(self):
+        async def connect(i, client):
+            start = time.perf_counter()
+            await client.connect()
+            return [time.perf_counter() - start]
+
+        return {"connect": await self.each(connect)}
+
+    async def join(self):
+        async def join(i, client):
+            name = self.names[i]
+            msg = {"type": "join", "name": name}
+            _, secs = await self.round_trip(
+                client, msg, lambda m: m["type"] == "presence" and name in m["joined"]
+            )
+            return [secs]
+
+        return {"join": await self.each(join)}
+
+    async def transition(self, action, state, **fields):
+        """Has the facilitator move the retro on and waits for everyone to see it."""
+
+        def match(m):
+            return m["type"] == "init" and m["state"] == state
+
+        facilitator = self.clients[0]
+        self.init, secs = await self.round_trip(
+            facilitator, {"type": action, **fields}, match
+        )
+        await asyncio.gather(*(c.wait_for(match) for c in self.clients[1:]))
+        return {action: [secs]}
+
+    async def add_topics(self):
+        async def add(i, client):
+            latencies = []
+            for k in range(self.options["topics"]):
+                text = f"{self.names[i]}-t{k}"
+                msg = {"type": "addTopic", "list": FEELINGS[k % 3], "text": text}
+                reply, secs = await self.round_trip(
+                    client, msg, lambda m: m["type"] == "addTopic" and m["text"] == text
+                )
+                if reply is not None:
+                    self.topic_ids[i].append(reply["id"])
+                    latencies.append(secs)
+            return latencies
+
+        return {"addTopic": await self.each(add)}
+
+    async def move_topics(self):
+        drags: list[float] = []
+        drops: list[float] = []
+
+        async def move(i, client):
+            for topic_id in self.topic_ids[i]:
+                for x in range(self.options["moves"]):
+                    msg = {"type": "moveTopic", "id": topic_id, "x": x, "y": x}
+                    reply, secs = await self.round_trip(
+                        client, msg, lambda m: _moved(m, topic_id, x)
+                    )
+                    if reply is None:
+                        return []
+                    drags.append(secs)
+                # Each participant's topics end up grouped together.
+                x, y = 200 + i % 6 * 170, 100 + i // 6 * 60 % 600
+                msg = {"type": "dropTopic", "id": topic_id, "x": x, "y": y}
+                reply, secs = await self.round_trip(
+                    client, msg, lambda m: _moved(m, topic_id, x)
+                )
+                if reply is not None:
+                    drops.append(secs)
+            return []
+
+        await self.each(move)
+        return {"moveTopic": drags, "dropTopic": drops}
+
+    async def go_to_voting(self):
+        latencies = await self.transition("goToVoting", "voting")
+        if self.init is not None:
+            self.cluster_ids = [c["id"] for c in self.init["clusters"]]
+        return latencies
+
+    async def set_votes(self):
+        async def vote(i, client):
+            votes = self.rng.choices(self.cluster_ids, k=self.options["votes"])
+            name = self.names[i]
+            _, secs = await self.round_trip(
+                client,
+                {"type": "setVotes", "votes": votes},
+                lambda m: m["type"] == "updateVotes" and m["name"] == name,
+            )
+            return [secs]
+
+        if not self.cluster_ids:
+            return {}
+        return {"setVotes": await self.each(vote)}
+
+    async def add_actions(self):
+        async def add(i, client):
+            text = f"{self.names[i]}-action"
+            _, secs = await self.round_trip(
+                client,
+                {"type": "addAction", "text": text},
+                lambda m: m["type"] == "init" and text in m["actions"],
+            )
+            return [secs]
+
+        return {"addAction": await self.each(add)}
+
+
+def _moved(msg, topic_id, x):
+    if msg["type"] == "moveTopic":
+        return msg["id"] == topic_id and msg["x"] == x
+    if msg["type"] == "moveTopics":
+        return any(m["id"] == topic_id and m["x"] == x for m in msg["moves"])
+    return False
@@ -0,0 +1,340 @@
+import asyncio
+import json
+import time
+from pathlib import Path
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main import metrics
+from main.bench import (
+    CONSUMERS,
+    Client,
+    QueryCounter,
+    bench_database,
+    latency_summary,
+    peak_rss_kb,
+    rss_kb,
+    websocket_app,
+)
+from main.models import Retro
+from main.record import ACTION, CLOSE, OPEN, read_trace
+
+# How long a replayed action's effect has to come back before it's counted
+# as unanswered.
+ROUND_TRIP_TIMEOUT = 10
+
+PHASES = ["joining", "brainstorming", "grouping", "voting", "discussion"]
+PHASE_CHANGES = {
+    "start": "brainstorming",
+    "goToGrouping": "grouping",
+    "goToVoting": "voting",
+    "goToDiscussion": "discussion",
+}
+# The phase each action does something in. Browsers only offer it then.
+ACTION_PHASES = {
+    "start": "joining",
+    "addTopic": "brainstorming",
+    "goToGrouping": "brainstorming",
+    "moveTopic": "grouping",
+    "dropTopic": "grouping",
+    "goToVoting": "grouping",
+    "setVotes": "voting",
+    "goToDiscussion": "voting",
+    "addAction": "discussion",
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays traces recorded with RETRO_RECORD_DIR (see main.record), all "
+        "at once, each into a new retro seeded with what the recorded one had. "
+        "--speed 2 goes twice as fast as they were recorded and 0 as fast as "
+        "it can, which can run into RETRO_RATE_LIMIT. Reports actions/sec, "
+        "round trips by action type, queries and peak RSS as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("traces", nargs="+", help="Trace files or directories.")
+        parser.add_argument("--speed", type=float, default=1)
+        parser.add_argument(
+            "--copies", type=int, default=1, help="Times to replay each at once."
+        )
+        parser.add_argument(
+            "--consumer", choices=list(CONSUMERS), default=settings.RETRO_CONSUMER
+        )
+
+    def handle(self, *args, **options):
+        traces = [read_trace(path) for path in _trace_paths(options["traces"])]
+        with bench_database():
+            results = asyncio.run(run(traces, options))
+        self.stdout.write(json.dumps(results, indent=2))
+
+
+def _trace_paths(paths):
+    for path in map(Path, paths):
+        if path.is_dir():
+            yield from sorted(path.glob("*.jsonl"))
+        else:
+            yield path
+
+
+async def run(traces, options):
+    app = websocket_app(CONSUMERS[options["consumer"]])
+    replays = []
+    for header, lines in traces:
+        for _ in range(options["copies"]):
+            seeded = await database_sync_to_async(seed)(header)
+            replays.append(
+                Replay(app, header["state"], *seeded, lines, options["speed"])
+            )
+
+    rss_before = rss_kb()
+    start = time.perf_counter()
+    with QueryCounter() as counter:
+        # Also count on the thread the consumers' database calls run on.
+        await database_sync_to_async(counter.attach)()
+        await asyncio.gather(*(r.run(start) for r in replays))
+    # Up to the last thing sent or seen done, so waiting out round trips that
+    # never came back (when the channel layer was too full to take them)
+    # doesn't count.
+    secs = max(r.finished for r in replays) - start
+
+    latencies: dict[str, list[float]] = {}
+    for r in replays:
+        for action, seconds in r.latencies.items():
+            latencies.setdefault(action, []).extend(seconds)
+    sent = sum(r.sent for r in replays)
+    received = sum(r.received for r in replays)
+    return {
+        "consumer": options["consumer"],
+        "traces": len(traces),
+        "copies": options["copies"],
+        "speed": options["speed"],
+        "recorded_seconds": round(
+            max((lines[-1][0] for _, lines in traces if lines), default=0) / 1000, 3
+        ),
+        "seconds": round(secs, 3),
+        "connections": sum(r.opened for r in replays),
+        "actions": {
+            "sent": sent,
+            "received": received,
+            "sent_per_sec": round(sent / secs, 1),
+            "received_per_sec": round(received / secs, 1),
+        },
+        "latency": {a: latency_summary(s) for a, s in sorted(latencies.items())},
+        "unanswered": sum(r.unanswered for r in replays),
+        "rate_limited": metrics.RATE_LIMITED.total(),
+        "queries": {
+            "total": counter.count,
+            "per_action": round(counter.count / max(sent, 1), 2),
+        },
+        "rss_kb": {"before": rss_before, "after": rss_kb(), "peak": peak_rss_kb()},
+    }
+
+
+def seed(header):
+    """A new retro with what a trace started with, and its topic and cluster
+    ids in the order the trace refers to them."""
+    retro = Retro.objects.create(state=header["state"])
+    clusters = [retro.clusters.create(votes=votes) for votes in header["clusters"]]
+    topics = [
+        retro.topics.create(
+            text=text,
+            feeling=feeling,
+            x=x,
+            y=y,
+            cluster=None if cluster is None else clusters[cluster],
+        )
+        for text, feeling, x, y, cluster in header["topics"]
+    ]
+    for name, votes in header["people"]:
+        retro.people.create(name=name, votes=[clusters[v].pk for v in votes])
+    for text in header["actions"]:
+        retro.action_items.create(text=text)
+    return retro.uuid, [t.pk for t in topics], [c.pk for c in clusters]
+
+
+class Replay:
+    """One trace being replayed into its own retro.
+
+    Round trips are timed for actions whose effect always comes back to the
+    sender, from sending to seeing it.
+    """
+
+    def __init__(self, app, phase, retro_uuid, topic_ids, cluster_ids, lines, speed):
+        self.app = app
+        # What phase the retro's in once what's been sent so far is done,
+        # which going by the trace rather than what's come back yet doesn't
+        # depend on how fast it goes.
+        self.phase = phase
+        self.retro_uuid = retro_uuid
+        # The replayed retro's ids in the order the trace refers to them.
+        self.topic_ids = topic_ids
+        self.cluster_ids = cluster_ids
+        self.lines = lines
+        self.speed = speed
+        self.connections: dict[int, ReplayConnection] = {}
+        # Closing waits for round trips, which shouldn't hold up the rest.
+        self.closing: list[asyncio.Task] = []
+        self.opened = 0
+        self.sent = 0
+        self.received = 0
+        self.unanswered = 0
+        self.finished = 0.0
+        self.latencies: dict[str, list[float]] = {}
+
+    async def run(self, start):
+        for ms, connection, kind, *action in self.lines:
+            if self.speed:
+                await asyncio.sleep(
+                    start + ms / 1000 / self.speed - time.perf_counter()
+                )
+            else:
+                await asyncio.sleep(0)
+            if kind == OPEN:
+                c = ReplayConnection(self)
+                await c.connect()
+                self.connections[connection] = c
+                self.opened += 1
+            elif kind == ACTION and connection in self.connections:
+                await self.connections[connection].send(self.with_ids(action[0]))
+                self.sent += 1
+                self.finished = time.perf_counter()
+            elif kind == CLOSE and connection in self.connections:
+                c = self.connections.pop(connection)
+                self.closing.append(asyncio.create_task(c.close()))
+        await asyncio.gather(
+            *self.closing, *(c.close() for c in self.connections.values())
+        )
+
+    def with_ids(self, action):
+        """The action with positions from the trace made into this retro's ids."""
+        if action.get("type") in ("moveTopic", "dropTopic") and "id" in action:
+            return {**action, "id": _at(self.topic_ids, action["id"])}
+        if action.get("type") == "setVotes":
+            return {
+                **action,
+                "votes": [_at(self.cluster_ids, v) for v in action["votes"]],
+            }
+        return action
+
+    def saw(self, msg):
+        """Keeps track of topics and clusters made as it goes."""
+        # Topics and clusters are never deleted, and a lagging connection can
+        # be sent an init from before some were made.
+        if msg["type"] == "init":
+            topic_ids = {t["id"] for t in msg["topics"]}
+            self.topic_ids = sorted(topic_ids.union(self.topic_ids))
+            cluster_ids = {c["id"] for c in msg["clusters"]}
+            self.cluster_ids = sorted(cluster_ids.union(self.cluster_ids))
+        elif msg["type"] == "addTopic" and msg["id"] not in self.topic_ids:
+            self.topic_ids.append(msg["id"])
+
+
+def _at(ids, position):
+    if position is None or position >= len(ids):
+        # Something the recorded retro didn't have either.
+        return -1
+    return ids[position]
+
+
+class ReplayConnection:
+    def __init__(self, replay):
+        self.replay = replay
+        self.client = Client(replay.app, replay.retro_uuid)
+        self.name = None
+        # The phase in the last init this connection got.
+        self.phase = "joining"
+        # (what it's waiting to see, what it sent, when) in the order sent.
+        self.waiting: list[tuple[object, str, float]] = []
+        self._reader: asyncio.Task | None = None
+
+    async def connect(self):
+        self.saw(await self.client.connect())
+        self._reader = asyncio.create_task(self._read())
+
+    async def send(self, action):
+        if action.get("type") == "join":
+            self.name = action.get("name")
+        match = None
+        if ACTION_PHASES.get(action.get("type")) == self.replay.phase:
+            # With the server behind, this connection may not have been told
+            # about the phase yet, so may have its action done before the one
+            # that changed the phase.
+            await self.reached(self.replay.phase)
+            match = _echo(action, self.name)
+            self.replay.phase = PHASE_CHANGES.get(action["type"], self.replay.phase)
+        if match is not None:
+            self.waiting.append((match, action["type"], time.perf_counter()))
+        await self.client.send(action)
+
+    async def reached(self, phase):
+        deadline = time.perf_counter() + ROUND_TRIP_TIMEOUT
+        while PHASES.index(self.phase) < PHASES.index(phase):
+            if time.perf_counter() > deadline:
+                return
+            await asyncio.sleep(0.001)
+
+    async def close(self):
+        deadline = time.perf_counter() + ROUND_TRIP_TIMEOUT
+        while self.waiting and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        self.replay.unanswered += len(self.waiting)
+        self._reader.cancel()
+        await self.client.close()
+
+    async def _read(self):
+        while True:
+            try:
+                msg = await self.client.recv(timeout=3600)
+            except (AssertionError, asyncio.TimeoutError):
+                # Closed.
+                return
+            self.saw(msg)
+
+    def saw(self, msg):
+        if msg["type"] == "init":
+            self.phase = msg["state"]
+        self.replay.received += 1
+        self.replay.saw(msg)
+        now = time.perf_counter()
+        for waiting in self.waiting:
+            match, action_type, sent_at = waiting
+            if match(msg):
+                self.replay.latencies.setdefault(action_type, []).append(now - sent_at)
+                self.replay.finished = max(self.replay.finished, now)
+                self.waiting.remove(waiting)
+                break
+        while self.waiting and now - self.waiting[0][2] > ROUND_TRIP_TIMEOUT:
+            self.replay.unanswered += 1
+            self.waiting.pop(0)
+
+
+def _echo(action, name):
+    """What shows the action's been done, for ones whose sender always sees
+    it, or None. A client that falls behind is sent an init instead of what
+    it missed (see main.outbound), so some look in those too."""
+    t = action.get("type")
+    if t in PHASE_CHANGES:
+        phase = PHASE_CHANGES[t]
+        return lambda m: m["type"] == "init" and m["state"] == phase
+    if t == "addTopic":
+        text = action["text"]
+        return lambda m: (m["type"] == "addTopic" and m["text"] == text) or (
+            m["type"] == "init" and any(t["text"] == text for t in m["topics"])
+        )
+    if t == "dropTopic" and action.get("id", -1) != -1:
+        move = (action["id"], action["x"], action["y"])
+        return lambda m: (
+            m["type"] == "moveTopic" and (m["id"], m["x"], m["y"]) == move
+        ) or (
+            m["type"] == "init"
+            and any((t["id"], t["x"], t["y"]) == move for t in m["topics"])
+        )
+    if t == "setVotes" and name is not None:
+        return lambda m: m["type"] == "updateVotes" and m["name"] == name
+    if t == "addAction":
+        return lambda m: m["type"] == "init" and action["text"] in m["actions"]
+    return None
@@ -0,0 +1,110 @@
+import http.client
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main.serve import Supervisor, memory, preload, process_age
+
+
+class Command(BaseCommand):
+    help = (
+        "Serves the app from --workers daphne processes forked from this one "
+        "once it's loaded everything, with each retro's connections all going "
+        "to the same worker (see main.serve). Doesn't migrate. With --measure, "
+        "prints how long it took to start and how much memory workers use, "
+        "then stops."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="0.0.0.0")
+        parser.add_argument("--port", type=int, default=8000)
+        parser.add_argument(
+            "--workers", type=int, default=settings.RETRO_WORKERS or os.cpu_count()
+        )
+        parser.add_argument(
+            "--socket-dir",
+            help="Where workers' own unix sockets go. Defaults to a temp dir.",
+        )
+        parser.add_argument("--measure", action="store_true")
+
+    def handle(self, *args, **options):
+        loaded = time.perf_counter()
+        if "daphne.server" in sys.modules:
+            raise CommandError(
+                "daphne.server is already imported, so workers would share its "
+                "reactor. Is daphne in INSTALLED_APPS? It's only there with "
+                "RETRO_ENV=dev, for runserver."
+            )
+        application = preload()
+        preload_seconds = time.perf_counter() - loaded
+
+        listener = socket.create_server(
+            (options["host"], options["port"]), backlog=1024
+        )
+        socket_dir = options["socket_dir"] or tempfile.mkdtemp(prefix="retro-")
+        supervisor = Supervisor(
+            application,
+            listener,
+            options["workers"],
+            socket_dir,
+            settings.RETRO_WORKER_MAX_MB * 1024 * 1024,
+        )
+        signal.signal(signal.SIGTERM, supervisor.stop)
+        signal.signal(signal.SIGINT, supervisor.stop)
+        supervisor.start()
+        self.stdout.write(
+            f"Serving on {options['host']}:{options['port']} with "
+            f"{options['workers']} workers, sockets in {socket_dir}"
+        )
+        if options["measure"]:
+            port = listener.getsockname()[1]
+            threading.Thread(
+                target=self.measure,
+                args=[supervisor, port, preload_seconds],
+                daemon=True,
+            ).start()
+        supervisor.run()
+        if not options["socket_dir"]:
+            os.rmdir(socket_dir)
+
+    def measure(self, supervisor, port, preload_seconds):
+        try:
+            while not supervisor.ready():
+                time.sleep(0.005)
+            results = {
+                "workers": len(supervisor.workers),
+                "preload_seconds": round(preload_seconds, 3),
+                # From this process starting to every worker about to accept.
+                "cold_start_seconds": _round(process_age()),
+                "workers_ready_seconds": round(
+                    max(w.ready_at - w.started for w in supervisor.workers), 3
+                ),
+                "first_request_seconds": round(_get(port, "/"), 4),
+                "second_request_seconds": round(_get(port, "/"), 4),
+                "parent": memory(os.getpid()),
+                "worker_memory": [memory(w.pid) for w in supervisor.workers],
+            }
+            self.stdout.write(json.dumps(results, indent=2))
+        finally:
+            supervisor.stop()
+
+
+def _get(port, path):
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("GET", path)
+    conn.getresponse().read()
+    conn.close()
+    return time.perf_counter() - start
+
+
+def _round(seconds):
+    return None if seconds is None else round(seconds, 3)
@@ -0,0 +1,232 @@
+"""Process-wide metrics in the Prometheus text format, served at /metrics.
+
+Hand rolled rather than pulling in prometheus_client since all we need is
+counters, gauges and histograms. Recording is a dict update under the
+metric's own lock, cheap enough to leave on in production.
+
+Metrics are per process. Run more than one and each needs scraping.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any
+
+from channels.layers import get_channel_layer
+from django.db import connection
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+REGISTRY: list["Metric"] = []
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values: dict[tuple, Any] = {}
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.extend(self._samples(label_values, value))
+        return lines
+
+    def _samples(self, label_values, value):
+        return [_sample(self.name, self._label_text(label_values), value)]
+
+    def _label_text(self, label_values, **extra):
+        pairs = list(zip(self.labels, label_values)) + list(extra.items())
+        return ",".join(f'{k}="{v}"' for k, v in pairs)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def total(self):
+        """The sum over all label values."""
+        with self._lock:
+            return sum(self._values.values())
+
+
+class Gauge(Metric):
+    """A value that's looked up when scraped, by calling read()."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, read):
+        super().__init__(name, help)
+        self._values[()] = read
+
+    def _samples(self, label_values, read):
+        return super()._samples(label_values, read())
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # A count per bucket, then +Inf's, then the sum.
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def _samples(self, label_values, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            labels = self._label_text(label_values, le=bound)
+            lines.append(_sample(f"{self.name}_bucket", labels, cumulative))
+        labels = self._label_text(label_values)
+        lines.append(_sample(f"{self.name}_sum", labels, counts[-1]))
+        lines.append(_sample(f"{self.name}_count", labels, cumulative))
+        return lines
+
+
+def _sample(name, labels, value):
+    if labels:
+        return f"{name}{{{labels}}} {value}"
+    return f"{name} {value}"
+
+
+def render():
+    return "\n".join(line for m in REGISTRY for line in m.render()) + "\n"
+
+
+ACTION_SECONDS = Histogram(
+    "retro_action_seconds", "Time to handle one websocket action.", ("action",)
+)
+ACTION_QUERIES = Histogram(
+    "retro_action_queries",
+    "Database queries made handling one websocket action.",
+    ("action",),
+    COUNT_BUCKETS,
+)
+ACTION_DB_SECONDS = Histogram(
+    "retro_action_db_seconds",
+    "Time spent in the database handling one websocket action.",
+    ("action",),
+)
+ACTION_ERRORS = Counter(
+    "retro_action_errors_total", "Actions that raised an exception.", ("action",)
+)
+BROADCAST_FANOUT = Histogram(
+    "retro_broadcast_fanout",
+    "Sockets in this process each broadcast goes out to.",
+    buckets=COUNT_BUCKETS,
+)
+MESSAGES = Counter(
+    "retro_messages_total", "Websocket frames by direction.", ("direction",)
+)
+BYTES = Counter(
+    "retro_bytes_total", "Websocket frame bytes by direction.", ("direction",)
+)
+OUTBOUND_DEPTH = Histogram(
+    "retro_outbound_depth",
+    "Frames waiting for a client, each time one has to wait (see main.outbound).",
+    buckets=COUNT_BUCKETS,
+)
+OUTBOUND_COALESCED = Counter(
+    "retro_outbound_coalesced_total",
+    "Waiting frames dropped for a newer one about the same thing.",
+)
+OUTBOUND_RESYNCS = Counter(
+    "retro_outbound_resyncs_total",
+    "Times a client's waiting frames were replaced with an init.",
+)
+OUTBOUND_DROPPED = Counter(
+    "retro_outbound_dropped_total",
+    "Connections closed for staying too far behind.",
+)
+CHANNEL_FULL = Counter(
+    "retro_channel_full_total",
+    "Messages the channel layer dropped for a consumer too far behind to take them.",
+)
+RATE_LIMITED = Counter(
+    "retro_rate_limited_total",
+    "Actions dropped for going over a connection's or a retro's rate limit.",
+    ("action", "scope"),
+)
+WRITE_BEHIND_LAG = Histogram(
+    "retro_write_behind_lag_seconds",
+    "Time from a change being queued to it being committed (see main.writebehind).",
+)
+WRITE_BEHIND_BATCH = Histogram(
+    "retro_write_behind_batch_writes",
+    "Writes committed together in each write-behind transaction.",
+    buckets=COUNT_BUCKETS,
+)
+WRITE_BEHIND_DROPPED = Counter(
+    "retro_write_behind_dropped_total",
+    "Writes dropped after their write-behind transaction kept failing.",
+)
+
+Gauge(
+    "retro_channel_layer_queued",
+    "Messages waiting in this process's channel layer queues.",
+    lambda: sum(
+        q.qsize() for q in getattr(get_channel_layer(), "channels", {}).values()
+    ),
+)
+
+
+class QueryTimer:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+@contextmanager
+def measure_action(action_type):
+    """Records how long handling an action takes and the queries it makes,
+    whether or not it fails."""
+    queries = QueryTimer()
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(queries):
+            yield
+    except Exception:
+        ACTION_ERRORS.inc(1, action_type)
+        raise
+    finally:
+        ACTION_SECONDS.observe(time.perf_counter() - start, action_type)
+        ACTION_QUERIES.observe(queries.count, action_type)
+        ACTION_DB_SECONDS.observe(queries.seconds, action_type)
+
+
+def received(text):
+    MESSAGES.inc(1, "in")
+    BYTES.inc(len(text), "in")
+
+
+def sent(text):
+    MESSAGES.inc(1, "out")
+    BYTES.inc(len(text), "out")
@@ -0,0 +1,72 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("main", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="actionitem",
+            name="retro",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="action_items",
+                to="main.retro",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="cluster",
+            name="retro",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="clusters",
+                to="main.retro",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="person",
+            name="retro",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="people",
+                to="main.retro",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="person",
+            name="votes",
+            field=models.JSONField(default=list),
+        ),
+        migrations.AlterField(
+            model_name="topic",
+            name="cluster",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="topics",
+                to="main.cluster",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="topic",
+            name="retro",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="topics",
+                to="main.retro",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="topic",
+            index=models.Index(
+                fields=["retro", "id"], name="main_topic_retro_i_ebff5f_idx"
+            ),
+        ),
+    ]
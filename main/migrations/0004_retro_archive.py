@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:15
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("main", "0003_retro_event_log"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RetroArchive",
+            fields=[
+                ("uuid", models.UUIDField(primary_key=True, serialize=False)),
+                ("data", models.BinaryField()),
+                ("archived", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="retro",
+            name="created",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name="retroevent",
+            name="created",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
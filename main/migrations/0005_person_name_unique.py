@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:17
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def delete_duplicate_people(apps, schema_editor):
+    # Racing joins could add the same name twice. Only the first was ever
+    # looked up, so the rest never had votes.
+    Person = apps.get_model("main", "Person")
+    dupes = (
+        Person.objects.values("retro", "name")
+        .annotate(count=Count("id"), first=Min("id"))
+        .filter(count__gt=1)
+    )
+    for d in dupes:
+        Person.objects.filter(retro=d["retro"], name=d["name"]).exclude(
+            id=d["first"]
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("main", "0004_retro_archive"),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_people, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="person",
+            constraint=models.UniqueConstraint(
+                fields=("retro", "name"), name="unique_person_name_per_retro"
+            ),
+        ),
+    ]
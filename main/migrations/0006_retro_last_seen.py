@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("main", "0005_person_name_unique"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="retro",
+            name="last_seen",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,36 +1,64 @@
 from random import randint
+from typing import Iterable
 from uuid import uuid4
 
 from django.db import models
+from django.utils import timezone
 
 
 # Keep these values in sync with the values in the html
 GROUPING_WORKSPACE_HEIGHT = 800
 GROUPING_WORKSPACE_WIDTH = 1400
+# Topics on the workspace are boxes this big, which overlapping ones are grouped
+# by (see main.grouping).
+TOPIC_BOX_WIDTH = 160
+TOPIC_BOX_HEIGHT = 48
+
+
+def random_topic_position():
+    # TODO prevent overlap with the edge of the workspace
+    return randint(0, GROUPING_WORKSPACE_WIDTH), randint(0, GROUPING_WORKSPACE_HEIGHT)
 
 
 class Retro(models.Model):
     uuid = models.UUIDField(primary_key=True, default=uuid4, editable=False)
     state = models.CharField(max_length=20, default="joining")
+    created = models.DateTimeField(default=timezone.now)
+    # When it was last open, give or take main.state.LAST_SEEN_EVERY. Nothing
+    # else records a retro that's open but not changing (see main.archive).
+    last_seen = models.DateTimeField(null=True, blank=True)
+
+    def set_initial_topic_positions(self, topics: Iterable["Topic"] | None = None):
+        if topics is None:
+            topics = self.topics.all()
+        topics = list(topics)
+        for t in topics:
+            t.x, t.y = random_topic_position()
+        Topic.objects.bulk_update(topics, ["x", "y"])
 
-    def set_initial_topic_positions(self):
-        for t in self.topics.all():
-            # TODO prevent overlap with the edge of the workspace
-            t.x = randint(0, GROUPING_WORKSPACE_WIDTH)
-            t.y = randint(0, GROUPING_WORKSPACE_HEIGHT)
-            t.save()
+    def tally_votes_and_save(
+        self,
+        clusters: Iterable["Cluster"] | None = None,
+        people: Iterable["Person"] | None = None,
+    ) -> None:
+        """Recounts cluster votes from scratch.
 
-    def tally_votes_and_save(self) -> None:
+        The counts are normally kept up to date as votes change, see
+        main.state.RetroState.set_votes. This is for repairing them.
+        """
+        if clusters is None:
+            clusters = self.clusters.all()
+        if people is None:
+            people = self.people.all()
         clusters_by_id = {}
-        for c in self.clusters.all():
+        for c in clusters:
             c.votes = 0
             clusters_by_id[c.pk] = c
-        for p in self.people.all():
+        for p in people:
             for v in p.votes:
                 c = clusters_by_id[v]
                 c.votes += 1
-        for c in clusters_by_id.values():
-            c.save()
+        Cluster.objects.bulk_update(clusters_by_id.values(), ["votes"])
 
 
 class Person(models.Model):
@@ -38,6 +66,13 @@ class Person(models.Model):
     name = models.CharField(max_length=200)
     votes = models.JSONField(default=list)  # list of up to 3 cluster ids
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["retro", "name"], name="unique_person_name_per_retro"
+            )
+        ]
+
 
 class Cluster(models.Model):
     retro = models.ForeignKey(Retro, on_delete=models.PROTECT, related_name="clusters")
@@ -54,9 +89,57 @@ class Topic(models.Model):
     x = models.IntegerField(default=0)
     y = models.IntegerField(default=0)
 
+    class Meta:
+        indexes = [models.Index(fields=["retro", "id"])]
+
 
 class ActionItem(models.Model):
     retro = models.ForeignKey(
         Retro, on_delete=models.PROTECT, related_name="action_items"
     )
     text = models.CharField(max_length=500)
+
+
+class RetroEvent(models.Model):
+    """One change to a retro, in the order they happened.
+
+    Events are only ever appended. seq counts up from 1 per retro. See
+    main.state for the event types and what's in their data.
+    """
+
+    retro = models.ForeignKey(Retro, on_delete=models.PROTECT, related_name="events")
+    seq = models.PositiveIntegerField()
+    type = models.CharField(max_length=20)
+    data = models.JSONField()
+    # Not auto_now_add so restoring from an archive can keep the original.
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=["retro", "seq"])]
+
+
+class RetroSnapshot(models.Model):
+    """A retro's whole state as of its event seq.
+
+    Loading starts from the latest one and replays the events after it.
+    """
+
+    retro = models.ForeignKey(Retro, on_delete=models.PROTECT, related_name="snapshots")
+    seq = models.PositiveIntegerField()
+    data = models.JSONField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["retro", "seq"])]
+
+
+class RetroArchive(models.Model):
+    """A retro moved out of the tables above, as one compressed blob.
+
+    See main.archive for what's in it. Retros are restored from here the next
+    time someone opens them.
+    """
+
+    uuid = models.UUIDField(primary_key=True)
+    data = models.BinaryField()
+    archived = models.DateTimeField(auto_now_add=True)
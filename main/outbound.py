@@ -0,0 +1,158 @@
+"""Per-socket queues of frames waiting to go out, for clients on slow links.
+
+Frames don't block on the socket, so without this a slow client's frames
+pile up in daphne's write buffer, or in the channel layer while its
+consumer is busy, and the in-memory channel layer quietly drops them once
+it's full. Instead each consumer puts every frame in an Outbound and sends
+what take() gives it.
+
+Clients ack how many frames they've received (main.js does every so often).
+Once a client has acked at all only RETRO_OUTBOUND_WINDOW frames are let
+out ahead of its acks and the rest wait here. Waiting frames that are
+superseded by newer ones are coalesced: only the latest position of a
+dropped topic, the latest vote count of a person and the latest drag batch
+are kept, and an init replaces everything before it. Clients that never ack
+are sent everything straight away, as before.
+
+A client whose queue still goes over RETRO_OUTBOUND_MAX_FRAMES or
+RETRO_OUTBOUND_MAX_BYTES is resynced: the queue is replaced by a fresh
+init. If it's that far behind again before acking the init it's dropped,
+and its reconnect resumes or inits like any other.
+
+A consumer can still fall behind the channel layer itself, which then
+drops broadcasts for it (counted as retro_channel_full_total). It notices
+from the gap in the broadcasts' numbers and resyncs its client the same
+way (see RetroSession.missed()).
+"""
+import json
+import weakref
+from collections import OrderedDict
+from itertools import count
+
+from django.conf import settings
+
+from main import metrics
+
+# Close code for a client dropped for being too far behind.
+TOO_SLOW = 4008
+
+INIT = "init"
+_INIT_PREFIX = '{"type": "init"'
+# Frames superseded by the next of the same type about the same thing.
+_COALESCED_BY = {"moveTopic": "id", "updateVotes": "name", "moveTopics": None}
+
+_open: "weakref.WeakSet[Outbound]" = weakref.WeakSet()
+
+
+def coalesce_key(text):
+    """What a frame is about, such that a newer frame with the same key makes it
+    redundant, or None if nothing does."""
+    if text.startswith(_INIT_PREFIX):
+        return INIT
+    msg = json.loads(text)
+    if msg["type"] not in _COALESCED_BY:
+        return None
+    field = _COALESCED_BY[msg["type"]]
+    return msg["type"] if field is None else f"{msg['type']}:{msg[field]}"
+
+
+class Outbound:
+    def __init__(self, window=None, max_frames=None, max_bytes=None):
+        self.window = window or settings.RETRO_OUTBOUND_WINDOW
+        self.max_frames = max_frames or settings.RETRO_OUTBOUND_MAX_FRAMES
+        self.max_bytes = max_bytes or settings.RETRO_OUTBOUND_MAX_BYTES
+        self.sent = 0
+        # None until the client first acks.
+        self.acked: int | None = None
+        self.bytes = 0
+        # Waiting frames by coalesce key, or a unique number for ones without.
+        self._queue: OrderedDict[object, str] = OrderedDict()
+        self._unique = count()
+        self._resync: str | None = None
+        # How many frames the client needs to have got to have the last resync.
+        self._resynced_at: int | None = None
+        self.dropped = False
+        _open.add(self)
+
+    def __len__(self):
+        return len(self._queue) + (self._resync is not None)
+
+    def put(self, text):
+        if self.dropped:
+            return
+        self.bytes += len(text)
+        if not self._queue and self._room():
+            self._queue[next(self._unique)] = text
+            return
+        key = coalesce_key(text)
+        if key == INIT:
+            self._clear()
+            self.bytes = len(text)
+        elif key is None:
+            key = next(self._unique)
+        elif key in self._queue:
+            # Coalescing moves it to the back, after anything it might depend
+            # on that's been queued since.
+            self.bytes -= len(self._queue.pop(key))
+            metrics.OUTBOUND_COALESCED.inc()
+        self._queue[key] = text
+        metrics.OUTBOUND_DEPTH.observe(len(self))
+
+    def ack(self, received):
+        self.acked = max(self.acked or 0, min(received, self.sent))
+        if self._resynced_at is not None and self.acked >= self._resynced_at:
+            self._resynced_at = None
+
+    def behind(self):
+        return len(self._queue) > self.max_frames or self.bytes > self.max_bytes
+
+    def resyncing(self):
+        """Whether the client's yet to get the last resync."""
+        return self._resynced_at is not None
+
+    def resync(self, init_text):
+        """Replaces everything waiting with an init, sent regardless of acks."""
+        self._clear()
+        self._resync = init_text
+        self._resynced_at = self.sent + 1
+        metrics.OUTBOUND_RESYNCS.inc()
+
+    def drop(self):
+        """Gives up on the client. Nothing more is queued or sent."""
+        self._clear()
+        self._resync = None
+        self.dropped = True
+        metrics.OUTBOUND_DROPPED.inc()
+
+    def take(self) -> list[str]:
+        """The frames to send now."""
+        texts = []
+        if self._resync is not None:
+            texts.append(self._resync)
+            self._resync = None
+        while self._queue and self._room(len(texts)):
+            text = self._queue.popitem(last=False)[1]
+            self.bytes -= len(text)
+            texts.append(text)
+        self.sent += len(texts)
+        return texts
+
+    def _room(self, taking=0):
+        if self.acked is None:
+            return True
+        return self.sent + taking - self.acked < self.window
+
+    def _clear(self):
+        self._queue.clear()
+        self.bytes = 0
+
+
+def queued_frames():
+    return sum(len(o) for o in list(_open))
+
+
+metrics.Gauge(
+    "retro_outbound_queued_frames",
+    "Frames waiting for slow clients to catch up.",
+    queued_frames,
+)
@@ -0,0 +1,93 @@
+"""Who's connected to a retro right now, kept in memory.
+
+Each connection is tracked by its channel name with who it joined as, when
+it joined and when it was last heard from. A person's present while any of
+their connections is, so several tabs count once. Connections that close
+leave straight away. Ones that go quiet, like a laptop lid closing without
+the socket ever closing, leave once nothing has come from them for
+RETRO_PRESENCE_TIMEOUT seconds. main.js sends a heartbeat every
+HEARTBEAT_SECONDS so idle but open tabs stay.
+
+Changes come back as (joined, left) lists of names, which RetroSession
+broadcasts as presence messages. Like the rate limits this is per process:
+with participants spread across processes each only knows its own.
+"""
+from collections import Counter
+
+from django.conf import settings
+
+# Keep in sync with main.js.
+HEARTBEAT_SECONDS = 15
+
+
+class Connection:
+    __slots__ = ["channel", "name", "since", "last_seen"]
+
+    def __init__(self, channel, name, now):
+        self.channel = channel
+        self.name = name
+        self.since = now
+        self.last_seen = now
+
+
+class Presence:
+    """The connections to one retro. Callers hold the retro's lock."""
+
+    def __init__(self):
+        self._connections: dict[str, Connection] = {}
+        # Connections per name, in the order they arrived.
+        self._names: Counter[str] = Counter()
+        self._next_expiry = 0.0
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def names(self) -> list[str]:
+        return list(self._names)
+
+    def connections(self) -> list[Connection]:
+        return list(self._connections.values())
+
+    def join(self, channel, name, now):
+        """Notes the connection on channel is name, replacing who it was."""
+        left = []
+        old = self._connections.get(channel)
+        if old is not None:
+            if old.name == name:
+                old.last_seen = now
+                return [], []
+            left = self.leave(channel)[1]
+        joined = [] if name in self._names else [name]
+        self._connections[channel] = Connection(channel, name, now)
+        self._names[name] += 1
+        return joined, left
+
+    def leave(self, channel):
+        connection = self._connections.pop(channel, None)
+        if connection is None:
+            return [], []
+        self._names[connection.name] -= 1
+        if self._names[connection.name]:
+            return [], []
+        del self._names[connection.name]
+        return [], [connection.name]
+
+    def seen(self, channel, now):
+        """Notes the connection's still there. Returns False if it isn't known."""
+        connection = self._connections.get(channel)
+        if connection is None:
+            return False
+        connection.last_seen = now
+        return True
+
+    def expire(self, now):
+        """Drops connections that have gone quiet, every so often."""
+        timeout = settings.RETRO_PRESENCE_TIMEOUT
+        if now < self._next_expiry:
+            return [], []
+        self._next_expiry = now + timeout / 3
+        left = []
+        for c in list(self._connections.values()):
+            if now - c.last_seen > timeout:
+                left += self.leave(c.channel)[1]
+        return [], left
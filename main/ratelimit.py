@@ -0,0 +1,52 @@
+"""Token bucket limits on how fast clients can send each type of action.
+
+Every connection, and every retro as a whole, has a bucket per action type
+sized by settings.RETRO_RATE_LIMITS. Consumers check an action against both
+(RetroSession.allow()) before doing anything else with it, so a flooding
+tab costs a dict lookup and a little arithmetic per frame rather than
+database writes and a broadcast to everyone. Frames over the limit are
+dropped and counted in metrics.
+
+A retro's buckets live on its RetroState, so with more than one process
+each process allows the full rate.
+"""
+import threading
+
+from django.conf import settings
+
+
+class TokenBucket:
+    __slots__ = ["rate", "burst", "tokens", "updated"]
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Buckets:
+    """A connection's or a retro's buckets, made as action types turn up."""
+
+    def __init__(self, scope):
+        # "connection" or "retro", which limits in RETRO_RATE_LIMITS apply.
+        self.scope = scope
+        self._lock = threading.Lock()
+        self._buckets: dict[str, TokenBucket] = {}
+
+    def take(self, action_type, now):
+        limits = settings.RETRO_RATE_LIMITS
+        with self._lock:
+            bucket = self._buckets.get(action_type)
+            if bucket is None:
+                rate, burst = limits.get(action_type, limits["other"])[self.scope]
+                bucket = self._buckets[action_type] = TokenBucket(rate, burst, now)
+            return bucket.take(now)
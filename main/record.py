@@ -0,0 +1,251 @@
+"""Recording what clients send retros, to replay as a benchmark.
+
+With RETRO_RECORD_DIR set, the consumers write every action clients send a
+retro to a trace file there, one per retro for each time it's opened in
+this process, named <retro uuid>-<when it started>-<pid>.jsonl. The first
+line is what the retro had in it then. After that each line is
+[ms since the start, connection number, kind, action], where kind is OPEN
+for a connection opening (with no action), ACTION for one it sent and CLOSE
+for it closing. Acks aren't kept since replaying clients make their own.
+
+Topic and cluster ids are written as their position among the retro's
+topics or clusters sorted by id, the order they were made in. That's so
+`manage.py retro_replay` can seed a new retro from the first line and send
+actions that refer to the same topics and clusters in it.
+
+The lines are written to the files from a thread of their own, so recording
+an action never waits on the disk, which for the async consumer would hold
+up every socket on the event loop.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from operator import attrgetter
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+OPEN = "o"
+ACTION = "a"
+CLOSE = "c"
+
+_pk = attrgetter("pk")
+
+
+def contents(state):
+    """What's in a retro, ids as positions, for the first line of a trace."""
+    clusters = sorted(state.clusters, key=_pk)
+    cluster_at = {c.pk: i for i, c in enumerate(clusters)}
+    return {
+        "retro": str(state.retro.uuid),
+        "started": datetime.now(timezone.utc).isoformat(),
+        "state": state.state,
+        "topics": [
+            [t.text, t.feeling, t.x, t.y, cluster_at.get(t.cluster_id)]
+            for t in sorted(state.topics, key=_pk)
+        ],
+        "clusters": [c.votes for c in clusters],
+        "people": [
+            [p.name, [cluster_at[v] for v in p.votes if v in cluster_at]]
+            for p in state.people.values()
+        ],
+        "actions": [a.text for a in state.actions],
+    }
+
+
+def read_trace(path):
+    """Returns a trace file's first line and the list of lines after it."""
+    with open(path) as f:
+        header = json.loads(f.readline())
+        return header, [json.loads(line) for line in f if line.strip()]
+
+
+class _Positions:
+    """Where ids come among some objects sorted by id, kept until there are
+    more of them."""
+
+    def __init__(self):
+        self._count = -1
+        self._positions: dict[int, int] = {}
+
+    def get(self, objects, pk):
+        if len(objects) != self._count:
+            ids = sorted(map(_pk, objects))
+            self._positions = {id: i for i, id in enumerate(ids)}
+            self._count = len(objects)
+        return self._positions.get(pk)
+
+
+class _Writer:
+    """Writes to trace files, in the order asked, from its own thread."""
+
+    def __init__(self):
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def write(self, file, text):
+        self._put(file.write, text)
+
+    def close(self, file):
+        """Closes the file once what's queued for it is written, and waits."""
+        closed = threading.Event()
+
+        def close(_):
+            try:
+                file.close()
+            finally:
+                closed.set()
+
+        self._put(close, None)
+        closed.wait()
+
+    def _put(self, do, arg):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="trace-writer", daemon=True
+                )
+                self._thread.start()
+        self._queue.put((do, arg))
+
+    def _run(self):
+        while True:
+            do, arg = self._queue.get()
+            try:
+                do(arg)
+            except (OSError, ValueError):
+                logger.exception("Couldn't write a trace")
+
+
+_writer = _Writer()
+
+
+class Trace:
+    """One retro's trace file, shared by its connections."""
+
+    def __init__(self, key, path, state):
+        self.key = key
+        self._lock = threading.Lock()
+        self._file = open(path, "w")
+        self._closed = False
+        self._start = time.monotonic()
+        self._topics = _Positions()
+        self._clusters = _Positions()
+        self.connections = 0
+        self.opened = 0
+        with state.lock:
+            first = json.dumps(contents(state)) + "\n"
+        _writer.write(self._file, first)
+
+    def write(self, connection, kind, state=None, action=None):
+        ms = round((time.monotonic() - self._start) * 1000)
+        with self._lock:
+            if self._closed:
+                # Exiting.
+                return
+            line = [ms, connection, kind]
+            if action is not None:
+                line.append(self._positions(state, action))
+            _writer.write(self._file, json.dumps(line) + "\n")
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        _writer.close(self._file)
+
+    def _positions(self, state, action):
+        """The action with its topic and cluster ids as positions."""
+        try:
+            if action.get("type") in ("moveTopic", "dropTopic") and "id" in action:
+                topic = self._topics.get(state.topics, int(action["id"]))
+                return {**action, "id": topic}
+            if action.get("type") == "setVotes":
+                votes = [
+                    self._clusters.get(state.clusters, int(v)) for v in action["votes"]
+                ]
+                return {**action, "votes": votes}
+        except (KeyError, TypeError, ValueError):
+            # The retro will ignore or choke on it too. Kept as is.
+            pass
+        return action
+
+
+class Recording:
+    """What one connection sends, in its retro's trace."""
+
+    def __init__(self, recorder, trace, connection):
+        self.recorder = recorder
+        self.trace = trace
+        self.connection = connection
+
+    def action(self, state, action):
+        if action.get("type") != "ack":
+            self.trace.write(self.connection, ACTION, state, action)
+
+    def close(self):
+        self.trace.write(self.connection, CLOSE)
+        self.recorder.release(self.trace)
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._traces: dict[str, Trace] = {}
+        self._closes_at_exit = False
+
+    def open(self, state) -> Recording | None:
+        """Starts recording a connection to the retro, if RETRO_RECORD_DIR is set."""
+        if not settings.RETRO_RECORD_DIR:
+            return None
+        key = str(state.retro.uuid)
+        with self._lock:
+            trace = self._traces.get(key)
+            if trace is None:
+                try:
+                    trace = Trace(key, _trace_path(key), state)
+                except OSError:
+                    logger.exception("Couldn't start recording retro %s", key)
+                    return None
+                if not self._closes_at_exit:
+                    atexit.register(self.close_all)
+                    self._closes_at_exit = True
+                self._traces[key] = trace
+            trace.connections += 1
+            trace.opened += 1
+            connection = trace.opened - 1
+        trace.write(connection, OPEN)
+        return Recording(self, trace, connection)
+
+    def release(self, trace):
+        with self._lock:
+            trace.connections -= 1
+            if trace.connections:
+                return
+            self._traces.pop(trace.key, None)
+        trace.close()
+
+    def close_all(self):
+        with self._lock:
+            traces, self._traces = list(self._traces.values()), {}
+        for trace in traces:
+            trace.close()
+
+
+def _trace_path(retro_uuid):
+    directory = Path(settings.RETRO_RECORD_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    started = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    return directory / f"{retro_uuid}-{started}-{os.getpid()}.jsonl"
+
+
+recorder = Recorder()
@@ -0,0 +1,285 @@
+"""Just enough of the Redis protocol (RESP2) for main.layers.
+
+There's a pipelined command client, a pub/sub subscriber and FakeRedis, a
+tiny in-process server that speaks the pub/sub subset. The fake is what
+tests, benchmarks and local multi-process runs use when there's no real
+Redis around.
+"""
+import asyncio
+from collections import deque
+from urllib.parse import unquote, urlparse
+
+
+class RespError(Exception):
+    pass
+
+
+def parse_url(url):
+    """Host, port, username, password and database number from a redis:// url
+    like redis://[[user]:password@]host[:port][/db]."""
+    parsed = urlparse(url)
+    db = parsed.path.strip("/") or "0"
+    if not db.isdigit():
+        raise ValueError(f"Redis url {url!r} doesn't end in a database number")
+    return (
+        parsed.hostname or "localhost",
+        parsed.port or 6379,
+        unquote(parsed.username) if parsed.username else None,
+        unquote(parsed.password) if parsed.password is not None else None,
+        int(db),
+    )
+
+
+async def open_connection(url):
+    """Connects to the Redis at url, logging in and selecting the database it
+    names if it does. Raises RespError if Redis says no."""
+    host, port, username, password, db = parse_url(url)
+    reader, writer = await asyncio.open_connection(host, port)
+    setup = []
+    if password is not None:
+        setup.append(["AUTH", *([username] if username else []), password])
+    if db:
+        setup.append(["SELECT", db])
+    try:
+        for command in setup:
+            writer.write(encode_command(*command))
+            await writer.drain()
+            reply = await read_reply(reader)
+            if isinstance(reply, RespError):
+                raise reply
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+def _bulk(value) -> bytes:
+    if isinstance(value, str):
+        value = value.encode()
+    elif isinstance(value, int):
+        value = str(value).encode()
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def encode_command(*args) -> bytes:
+    return b"*%d\r\n" % len(args) + b"".join(_bulk(a) for a in args)
+
+
+def encode_reply(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, RespError):
+        return b"-%s\r\n" % str(value).encode()
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode_reply(v) for v in value)
+    if isinstance(value, str):
+        return b"+%s\r\n" % value.encode()
+    return _bulk(value)
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    """Reads one reply. Errors are returned rather than raised so that
+    pipelined replies stay matched up with their commands."""
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        return RespError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        if int(rest) == -1:
+            return None
+        return (await reader.readexactly(int(rest) + 2))[:-2]
+    if kind == b"*":
+        if int(rest) == -1:
+            return None
+        return [await read_reply(reader) for _ in range(int(rest))]
+    raise RespError(f"Unexpected reply {line!r}")
+
+
+class RespClient:
+    """Pipelined command connection. Replies come back in command order.
+
+    Once the connection drops, pending and later commands fail with
+    ConnectionError and on_lost is called, so the owner can make a new one.
+    """
+
+    def __init__(self, reader, writer, on_lost=None):
+        self._writer = writer
+        self._on_lost = on_lost
+        self._pending: deque[asyncio.Future] = deque()
+        self.lost = False
+        self._reading = asyncio.create_task(self._read_replies(reader))
+
+    @classmethod
+    async def connect(cls, url, on_lost=None):
+        return cls(*await open_connection(url), on_lost)
+
+    async def execute(self, *args):
+        if self.lost:
+            raise ConnectionError("Connection lost")
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(future)
+        self._writer.write(encode_command(*args))
+        await self._writer.drain()
+        reply = await future
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    async def _read_replies(self, reader):
+        try:
+            while True:
+                reply = await read_reply(reader)
+                self._pending.popleft().set_result(reply)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            self.lost = True
+            self._writer.close()
+            while self._pending:
+                self._pending.popleft().set_exception(ConnectionError(str(e)))
+            if self._on_lost is not None:
+                self._on_lost()
+
+    async def close(self):
+        self._reading.cancel()
+        self._writer.close()
+
+
+class RespSubscriber:
+    """Pub/sub connection that calls on_message(channel, data) for each message.
+
+    Once the connection drops on_lost is called. Subscriptions don't carry
+    over to a new connection, so the owner has to subscribe again.
+    """
+
+    def __init__(self, reader, writer, on_message, on_lost=None):
+        self._writer = writer
+        self._on_message = on_message
+        self._on_lost = on_lost
+        self.lost = False
+        self._reading = asyncio.create_task(self._read_messages(reader))
+
+    @classmethod
+    async def connect(cls, url, on_message, on_lost=None):
+        reader, writer = await open_connection(url)
+        return cls(reader, writer, on_message, on_lost)
+
+    async def subscribe(self, *channels):
+        await self._command("SUBSCRIBE", *channels)
+
+    async def unsubscribe(self, *channels):
+        await self._command("UNSUBSCRIBE", *channels)
+
+    async def _command(self, *args):
+        if self.lost:
+            raise ConnectionError("Connection lost")
+        self._writer.write(encode_command(*args))
+        await self._writer.drain()
+
+    async def _read_messages(self, reader):
+        try:
+            while True:
+                reply = await read_reply(reader)
+                if isinstance(reply, list) and reply[0] == b"message":
+                    self._on_message(reply[1].decode(), reply[2])
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self.lost = True
+            self._writer.close()
+            if self._on_lost is not None:
+                self._on_lost()
+
+    async def close(self):
+        self._reading.cancel()
+        self._writer.close()
+
+
+class FakeRedis:
+    """In-process stand-in for a Redis server, pub/sub commands only.
+
+    With a password, connections have to AUTH with it first. SELECT is
+    accepted and noted in selected but, as in Redis, pub/sub ignores it.
+    """
+
+    def __init__(self, password=None):
+        self.password = password
+        self.selected: set[int] = set()
+        self._subscribers: dict[bytes, set[asyncio.StreamWriter]] = {}
+        self._server: asyncio.AbstractServer | None = None
+        self._connections: dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Starts listening and returns the redis:// url to connect to."""
+        self._server = await asyncio.start_server(self._serve, host, port)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"redis://{host}:{port}"
+
+    async def close(self):
+        self._server.close()
+        # Hanging up on clients lets their handlers finish on their own.
+        for writer in self._connections.values():
+            writer.close()
+        await asyncio.gather(*self._connections)
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        subscribed: set[bytes] = set()
+        authed = self.password is None
+        try:
+            while True:
+                command = await read_reply(reader)
+                if not isinstance(command, list) or not command:
+                    break
+                name, args = command[0].upper(), command[1:]
+                if name == b"AUTH":
+                    authed = args[-1].decode() == self.password
+                    reply = encode_reply(
+                        "OK" if authed else RespError("WRONGPASS invalid password")
+                    )
+                elif not authed:
+                    reply = encode_reply(RespError("NOAUTH Authentication required."))
+                else:
+                    reply = self._run(writer, subscribed, name, args)
+                writer.write(reply)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in subscribed:
+                self._subscribers[channel].discard(writer)
+            writer.close()
+            del self._connections[task]
+
+    def _run(self, writer, subscribed, name, args) -> bytes:
+        if name == b"PING":
+            return encode_reply("PONG")
+        if name == b"SELECT":
+            self.selected.add(int(args[0]))
+            return encode_reply("OK")
+        if name == b"PUBLISH":
+            channel, data = args
+            receivers = self._subscribers.get(channel, set())
+            message = encode_reply([b"message", channel, data])
+            for w in receivers:
+                w.write(message)
+            return encode_reply(len(receivers))
+        if name in (b"SUBSCRIBE", b"UNSUBSCRIBE"):
+            replies = []
+            for channel in args:
+                if name == b"SUBSCRIBE":
+                    subscribed.add(channel)
+                    self._subscribers.setdefault(channel, set()).add(writer)
+                else:
+                    subscribed.discard(channel)
+                    self._subscribers.get(channel, set()).discard(writer)
+                kind = name.lower()
+                replies.append(encode_reply([kind, channel, len(subscribed)]))
+            return b"".join(replies)
+        return encode_reply(RespError(f"ERR unknown command '{name.decode()}'"))
@@ -1,9 +1,15 @@
+from django.conf import settings
 from django.urls import re_path
 
 from . import consumers
 
+RETRO_PATH = r"ws/retro/(?P<retro_id>[-A-Za-z0-9]+)/$"
+
+if settings.RETRO_CONSUMER == settings.ASYNC:
+    Consumer = consumers.AsyncRetroConsumer
+else:
+    Consumer = consumers.RetroConsumer
+
 websocket_urlpatterns = [
-    re_path(
-        r"ws/retro/(?P<retro_id>[-A-Za-z0-9]+)/$", consumers.RetroConsumer.as_asgi()
-    ),
+    re_path(RETRO_PATH, Consumer.as_asgi()),
 ]
@@ -0,0 +1,402 @@
+"""Serving from several worker processes, for production (`manage.py serve`).
+
+The parent process sets Django up and imports the ASGI application, then
+forks daphne workers that share what it loaded. Each worker sets up its own
+twisted reactor after the fork, which is why daphne isn't an installed app
+outside dev: importing it sets one up.
+
+The parent accepts every connection itself, peeks at its request line and
+hands the socket to a worker over a unix socket (SCM_RIGHTS), so nothing it
+sends goes through the parent after that. Everything for one retro, its page
+and its websockets, goes to the same worker, picked from the retro's id, so
+its state, presence and rate limits are all in one process and broadcasts to
+it stay in that process's channel layer. Other requests go round robin. A
+keep-alive connection stays with the worker its first request went to.
+
+Each worker also listens on its own unix socket in --socket-dir, which is
+how to get at one worker's /metrics.
+
+Workers that die are started again. Every MEMORY_CHECK_SECONDS each worker's
+unique memory, what it doesn't share with the parent, is checked against
+RETRO_WORKER_MAX_MB and a worker over it is replaced. Stopping a worker
+drops its connections, which reconnect and resume, and writes out anything
+write-behind has queued first.
+
+Migrations aren't run here. Run `manage.py migrate` before starting.
+"""
+import gc
+import logging
+import os
+import re
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+import zlib
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Requests for a retro, which go to its worker.
+RETRO_REQUEST = re.compile(rb"^[A-Z]+ /(?:ws/retro|retros)/([-A-Za-z0-9]+)")
+# How much of a new connection is peeked at for its request line, and how
+# long it has to send that much.
+REQUEST_LINE_MAX = 4096
+REQUEST_LINE_SECONDS = 5
+# How often to look again at connections that sent part of a request line.
+PARTIAL_RETRY_SECONDS = 0.01
+MEMORY_CHECK_SECONDS = 30
+# How long workers get to finish up when stopped before they're killed.
+STOP_SECONDS = 10
+
+
+def worker_for(request_line: bytes, workers: int) -> int | None:
+    """The worker for a retro's request, or None if it's not for a retro."""
+    match = RETRO_REQUEST.match(request_line)
+    if match is None:
+        return None
+    return zlib.crc32(match.group(1).lower()) % workers
+
+
+def preload():
+    """Imports and warms what workers share, before they're forked.
+
+    That includes most of daphne, just not daphne.server, whose import sets
+    up the reactor.
+    """
+    import daphne.http_protocol  # noqa: F401
+    import daphne.ws_protocol  # noqa: F401
+    import twisted.internet.asyncioreactor  # noqa: F401
+    import twisted.internet.endpoints  # noqa: F401
+    from django.template.loader import get_template
+    from django.urls import get_resolver
+
+    from danretro.asgi import application
+
+    get_resolver().resolve("/")
+    get_template("index.html")
+    return application
+
+
+def memory(pid) -> dict[str, int] | None:
+    """Bytes of a process's memory: rss, pss and uss (what's only its own)."""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    kb = {}
+    for line in lines[1:]:
+        name, value = line.split(":", 1)
+        kb[name] = int(value.split()[0])
+    return {
+        "rss": kb["Rss"] * 1024,
+        "pss": kb["Pss"] * 1024,
+        "uss": (kb["Private_Clean"] + kb["Private_Dirty"]) * 1024,
+    }
+
+
+def process_age() -> float | None:
+    """Seconds since this process started, or None if there's no /proc."""
+    try:
+        with open("/proc/self/stat") as f:
+            # The command can have spaces in, but not a ")".
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except OSError:
+        return None
+    return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+
+
+class Worker:
+    def __init__(self, index, socket_path):
+        self.index = index
+        self.socket_path = socket_path
+        self.pid: int | None = None
+        # The parent's end of the socket connections are handed over on.
+        self.control: socket.socket | None = None
+        # Written to once the worker's reactor is about to run.
+        self.ready_fd: int | None = None
+        self.started = 0.0
+        self.ready_at: float | None = None
+
+
+class Supervisor:
+    def __init__(self, application, listener, workers, socket_dir, max_bytes=0):
+        self.application = application
+        self.listener = listener
+        self.max_bytes = max_bytes
+        self.workers = [
+            Worker(i, os.path.join(socket_dir, f"worker-{i}.sock"))
+            for i in range(workers)
+        ]
+        self.selector = selectors.DefaultSelector()
+        # New connections waiting for their request line, and when to give up.
+        self.pending: dict[socket.socket, float] = {}
+        self.partial: list[socket.socket] = []
+        self.turn = 0
+        self.stopping = False
+        self.replaced = 0
+
+    def start(self):
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, self._accept)
+        # Keeps the collector off what's loaded so far, so workers don't copy
+        # the pages it would otherwise write to.
+        connections.close_all()
+        gc.freeze()
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def ready(self):
+        return all(w.ready_at is not None for w in self.workers)
+
+    def run(self):
+        next_check = time.monotonic() + MEMORY_CHECK_SECONDS
+        while not self.stopping:
+            for conn in self.partial:
+                self.selector.register(conn, selectors.EVENT_READ, self._route)
+            timeout = PARTIAL_RETRY_SECONDS if self.partial else 1
+            self.partial = []
+            for key, _ in self.selector.select(timeout):
+                key.data(key.fileobj)
+            now = time.monotonic()
+            self._expire_pending(now)
+            self._reap()
+            if self.max_bytes and now >= next_check:
+                next_check = now + MEMORY_CHECK_SECONDS
+                self._check_memory()
+        self._stop_workers()
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def _spawn(self, worker):
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        ready_r, ready_w = os.pipe()
+        try:
+            os.unlink(worker.socket_path)
+        except FileNotFoundError:
+            pass
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                ours.close()
+                os.close(ready_r)
+                self._close_inherited()
+                code = run_worker(self.application, worker, theirs, ready_w)
+            except BaseException:
+                logger.exception("Worker %s failed", worker.index)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        theirs.close()
+        os.close(ready_w)
+        ours.setblocking(False)
+        worker.pid, worker.control, worker.ready_fd = pid, ours, ready_r
+        worker.started, worker.ready_at = time.monotonic(), None
+        self.selector.register(ready_r, selectors.EVENT_READ, self._worker_ready)
+
+    def _close_inherited(self):
+        """Closes, in a new worker, what it inherited that's the parent's."""
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, signal.SIG_DFL)
+        self.selector.close()
+        self.listener.close()
+        for conn in self.pending:
+            conn.close()
+        for other in self.workers:
+            if other.control is not None:
+                other.control.close()
+            if other.ready_fd is not None:
+                os.close(other.ready_fd)
+
+    def _worker_ready(self, fd):
+        worker = next(w for w in self.workers if w.ready_fd == fd)
+        if os.read(fd, 1):
+            worker.ready_at = time.monotonic()
+            logger.info(
+                "Worker %s (pid %s) ready in %.2fs",
+                worker.index,
+                worker.pid,
+                worker.ready_at - worker.started,
+            )
+        self.selector.unregister(fd)
+        os.close(fd)
+        worker.ready_fd = None
+
+    def _accept(self, listener):
+        try:
+            conn, _ = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.setblocking(False)
+        self.pending[conn] = time.monotonic() + REQUEST_LINE_SECONDS
+        self.selector.register(conn, selectors.EVENT_READ, self._route)
+
+    def _route(self, conn):
+        self.selector.unregister(conn)
+        try:
+            head = conn.recv(REQUEST_LINE_MAX, socket.MSG_PEEK)
+        except BlockingIOError:
+            self.partial.append(conn)
+            return
+        except OSError:
+            head = b""
+        if not head:
+            del self.pending[conn]
+            conn.close()
+            return
+        if b"\n" not in head and len(head) < REQUEST_LINE_MAX:
+            # It's still arriving. Peeking leaves it readable, so waiting on
+            # the selector would spin.
+            self.partial.append(conn)
+            return
+        del self.pending[conn]
+        index = worker_for(head, len(self.workers))
+        if index is None:
+            index = self.turn
+            self.turn = (self.turn + 1) % len(self.workers)
+        self._hand_over(conn, self.workers[index])
+
+    def _hand_over(self, conn, worker):
+        try:
+            if worker.control is None:
+                raise ConnectionError("restarting")
+            socket.send_fds(worker.control, [bytes([conn.family])], [conn.fileno()])
+        except OSError as e:
+            # It's restarting or too far behind to take more. The client can
+            # try again.
+            logger.warning("Dropped a connection for worker %s: %s", worker.index, e)
+        conn.close()
+
+    def _expire_pending(self, now):
+        for conn, deadline in list(self.pending.items()):
+            if now > deadline:
+                if conn in self.partial:
+                    self.partial.remove(conn)
+                else:
+                    self.selector.unregister(conn)
+                del self.pending[conn]
+                conn.close()
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            worker = next((w for w in self.workers if w.pid == pid), None)
+            if worker is None:
+                continue
+            (logger.info if self.stopping else logger.warning)(
+                "Worker %s (pid %s) exited with %s",
+                worker.index,
+                pid,
+                os.waitstatus_to_exitcode(status),
+            )
+            self._forget(worker)
+            if not self.stopping:
+                self._spawn(worker)
+
+    def _forget(self, worker):
+        worker.pid = None
+        worker.control.close()
+        worker.control = None
+        if worker.ready_fd is not None:
+            self.selector.unregister(worker.ready_fd)
+            os.close(worker.ready_fd)
+            worker.ready_fd = None
+
+    def _check_memory(self):
+        for worker in self.workers:
+            if worker.pid is None or worker.ready_at is None:
+                continue
+            used = memory(worker.pid)
+            if used is not None and used["uss"] > self.max_bytes:
+                logger.warning(
+                    "Replacing worker %s (pid %s), using %.0fMB of its own",
+                    worker.index,
+                    worker.pid,
+                    used["uss"] / 1024 / 1024,
+                )
+                self.replaced += 1
+                # _reap() starts another once it's gone. One at a time, so
+                # the others keep serving.
+                os.kill(worker.pid, signal.SIGTERM)
+                return
+
+    def _stop_workers(self):
+        for worker in self.workers:
+            if worker.pid is not None:
+                os.kill(worker.pid, signal.SIGTERM)
+        deadline = time.monotonic() + STOP_SECONDS
+        while any(w.pid is not None for w in self.workers):
+            if time.monotonic() > deadline:
+                for worker in self.workers:
+                    if worker.pid is not None:
+                        os.kill(worker.pid, signal.SIGKILL)
+                deadline = float("inf")
+            self._reap()
+            time.sleep(0.05)
+        for conn in self.pending:
+            conn.close()
+        self.listener.close()
+        for worker in self.workers:
+            try:
+                os.unlink(worker.socket_path)
+            except FileNotFoundError:
+                pass
+
+
+def run_worker(application, worker, control, ready_fd):
+    """Serves connections handed over on control until told to stop."""
+    # Sets up twisted's reactor, in this process only. It picks up the
+    # websocket factory RETRO_WS_DEFLATE swapped in when main loaded.
+    from daphne.server import Server
+    from twisted.internet import reactor
+
+    from main.writebehind import writer
+
+    def adopt(fd, family):
+        try:
+            reactor.adoptStreamConnection(fd, family, server.http_factory)
+        except Exception:
+            logger.exception("Worker %s couldn't take a connection", worker.index)
+        finally:
+            os.close(fd)
+
+    def receive():
+        while True:
+            try:
+                msg, fds, _, _ = socket.recv_fds(control, 1, 1)
+            except OSError:
+                msg, fds = b"", []
+            if not msg:
+                # The parent's gone.
+                reactor.callFromThread(server.stop)
+                return
+            reactor.callFromThread(adopt, fds[0], msg[0])
+
+    def ready():
+        threading.Thread(target=receive, name="handover", daemon=True).start()
+        os.write(ready_fd, b"1")
+        os.close(ready_fd)
+
+    server = Server(
+        application,
+        endpoints=[f"unix:{worker.socket_path}"],
+        ready_callable=ready,
+        verbosity=0,
+    )
+    server.run()
+    writer.flush(STOP_SECONDS)
+    return 0
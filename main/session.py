@@ -0,0 +1,419 @@
+import json
+import time
+from urllib.parse import parse_qs
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import IntegrityError
+
+from main import metrics
+from main.archive import restore
+from main.ratelimit import Buckets
+from main.models import *
+import main.state
+from main.state import RetroState, retro_states
+
+# How long a broadcast can arrive late before it counts as lost, and how many
+# can be skipped over at once before they count as lost straight away (see
+# RetroSession.missed()).
+GAP_SECONDS = 0.5
+GAP_FRAMES = 8
+
+# Every action type clients send. Anything else is counted as "other" in
+# metrics and rate limits so clients can't make up new labels.
+ACTION_TYPES = {
+    "join",
+    "start",
+    "addTopic",
+    "goToGrouping",
+    "moveTopic",
+    "dropTopic",
+    "goToVoting",
+    "setVotes",
+    "goToDiscussion",
+    "addAction",
+    "heartbeat",
+}
+
+
+def action_type(action):
+    action_type = action.get("type")
+    return action_type if action_type in ACTION_TYPES else "other"
+
+
+def init_msg(state: RetroState):
+    by_cluster = state.topics_by_cluster()
+    msg = {
+        "type": "init",
+        "state": state.state,
+        # Who's here now, not everyone who ever joined.
+        "people": [
+            people_dict(state.people.get(name) or Person(name=name))
+            for name in state.presence.names()
+        ],
+        "topics": [topic_dict(t) for t in state.topics],
+        "clusters": [cluster_dict(c, by_cluster.get(c.pk, [])) for c in state.clusters],
+        "actions": [a.text for a in state.actions],
+    }
+    if state.state == "grouping":
+        msg["groups"] = state.grouping.groups()
+    return msg
+
+
+def people_dict(person: Person):
+    return {
+        "name": person.name,
+        "numVotes": len(person.votes),
+    }
+
+
+def presence_msg(joined, left):
+    return {"type": "presence", "joined": joined, "left": left}
+
+
+def topic_dict(topic: Topic):
+    return {
+        "id": topic.pk,
+        "text": topic.text,
+        "feeling": topic.feeling,
+        "x": topic.x,
+        "y": topic.y,
+    }
+
+
+def cluster_dict(cluster: Cluster, topics: list[Topic]):
+    return {
+        "id": cluster.pk,
+        "topicIds": [t.pk for t in topics],
+        # TODO drop once no clients from before topic ids are left
+        "topics": [t.text for t in topics],
+        "votes": cluster.votes,
+    }
+
+
+def init_text(state: RetroState):
+    return state.memo("init", lambda: json.dumps(init_msg(state)))
+
+
+def drag_text(state: RetroState):
+    """Encodes the drag positions since the last flush, or None if there are none.
+
+    These frames aren't numbered for resuming since a drop always follows.
+    This runs on the event loop, so it stays off the retro's lock.
+    """
+    moves = [move_dict(topic, x, y) for topic, x, y in state.take_drags()]
+    if not moves:
+        return None
+    return json.dumps({"type": "moveTopics", "moves": moves})
+
+
+def move_dict(topic: Topic, x, y):
+    # TODO drop text once no clients from before topic ids are left
+    return {"id": topic.pk, "text": topic.text, "x": x, "y": y}
+
+
+def find_topic(state: RetroState, action):
+    """The topic an action is about, by id or, from older clients, by text."""
+    if "id" in action:
+        return state.topics_by_id.get(int(action["id"]))
+    return state.topics_by_text.get(action["text"])
+
+
+def parse_resume(query_string: bytes):
+    """Reads ?resume=<epoch>.<seq> off a websocket url, or returns None."""
+    value = parse_qs(query_string.decode()).get("resume", [""])[0]
+    epoch, _, seq = value.partition(".")
+    if not epoch or not seq.isdigit():
+        return None
+    return epoch, int(seq)
+
+
+def parse_ack(action):
+    """How many frames an ack says the client's received, or None if it doesn't
+    say properly."""
+    received = action.get("received")
+    if isinstance(received, str) and received.isdigit():
+        return int(received)
+    if type(received) is not int or received < 0:
+        return None
+    return received
+
+
+def broadcast_event(text, changed=True):
+    """Channel layer event carrying an already encoded frame for every socket.
+
+    changed says whether it's about a change to the retro, which other
+    processes need to reload.
+    """
+    event = {"type": "broadcast", "text": text}
+    if changed:
+        event["origin"] = main.state.PROCESS_ID
+        # Numbered by RetroState.sequence_frame(), which puts it last.
+        at = text.rfind('"seq":')
+        if at != -1:
+            event["seq"] = int(text[at + 6 : -1])
+    return event
+
+
+class Outbox:
+    """What handling one action produced, already encoded.
+
+    Broadcasts go to the whole retro group and replies to the socket that
+    sent the action. RetroSession.handle numbers the broadcasts. Everything
+    is encoded once here, by the sender, so the receiving consumers only
+    forward text. Consumers send the broadcasts first. If flush_drags_in is
+    set the consumer broadcasts drag_text() that many seconds later.
+    """
+
+    def __init__(self):
+        self.broadcasts: list[str] = []
+        self.replies: list[str] = []
+        self.flush_drags_in: float | None = None
+
+    def broadcast(self, msg):
+        self.broadcasts.append(json.dumps(msg))
+
+
+class RetroSession:
+    """The retro logic for one websocket connection.
+
+    This is all plain blocking code that doesn't know about websockets or
+    channel layers so the sync and async consumers can share it. The async
+    consumer runs each call in one database_sync_to_async hop. The retro itself
+    lives in the process-wide retro_states cache while the session is open.
+    """
+
+    def __init__(self, retro_uuid, channel=None):
+        self.retro_uuid = retro_uuid
+        # Identifies the connection in the retro's presence.
+        self.channel = channel or uuid4().hex
+        self.person_name = None
+        self.state: RetroState | None = None
+        self.rate_limits = Buckets("connection")
+        # The last of this process's numbered broadcasts the socket's been
+        # given, or that its init covers, and the ones before it that haven't
+        # arrived yet since when (see missed()).
+        self.last_seq = 0
+        self.gaps: set[int] = set()
+        self.gap_since: float | None = None
+
+    def open(self, resume=None) -> list[str]:
+        """Starts using the retro and returns the first frames for the socket.
+
+        That's normally an init. A reconnecting client can pass the epoch and
+        frame seq it last saw as resume, and if they're still available gets
+        a resumed frame then just the frames it missed instead.
+        """
+        with metrics.measure_action("connect"):
+            try:
+                self.state = retro_states.acquire(self.retro_uuid)
+            except Retro.DoesNotExist:
+                # Archived, unless it never existed and this raises again.
+                # Another connection may have just restored it.
+                restore(self.retro_uuid)
+                self.state = retro_states.acquire(self.retro_uuid)
+            with self.state.lock:
+                try:
+                    self.state.refresh_if_stale()
+                except Retro.DoesNotExist:
+                    # Archived by another process since we last had it.
+                    restore(self.retro_uuid)
+                    self.state.refresh_if_stale()
+                self.state.note_open()
+                self._caught_up()
+                if resume is not None:
+                    missed = self.state.frames_since(*resume)
+                    if missed is not None:
+                        return [json.dumps({"type": "resumed"}), *missed]
+                return [self.state.stamp_init(init_text(self.state))]
+
+    def resync(self) -> str:
+        """A fresh init for a socket that's fallen too far behind."""
+        with self.state.lock:
+            self.state.refresh_if_stale()
+            self._caught_up()
+            return self.state.stamp_init(init_text(self.state))
+
+    def close(self) -> list[str]:
+        """Stops using the retro. Returns frames to broadcast about leaving."""
+        if self.state is None:
+            return []
+        texts = []
+        with self.state.lock:
+            joined, left = self.state.leave(self.channel)
+            if left:
+                msg = json.dumps(presence_msg(joined, left))
+                texts.append(self.state.sequence_frame(msg))
+        retro_states.release(self.state)
+        self.state = None
+        return texts
+
+    def from_elsewhere(self, event):
+        """Whether a broadcast's about another process changing the retro."""
+        ours = main.state.PROCESS_ID
+        return self.state is not None and event.get("origin", ours) != ours
+
+    def saw_broadcast(self, event):
+        """Takes the retro's lock for broadcasts from_elsewhere()."""
+        if self.from_elsewhere(event):
+            self.state.changed_elsewhere()
+
+    def missed(self, event):
+        """Notes a broadcast's going to the socket. Returns whether some before
+        it never arrived, which is what the channel layer does to consumers
+        that fall too far behind.
+
+        This process numbers its broadcasts under the retro's lock but sends
+        them after, so a few can arrive swapped. Skipped seqs only count as
+        missed if some are still missing GAP_SECONDS after the first, or more
+        than GAP_FRAMES are at once, which is more than are ever in flight.
+        Other processes number theirs separately.
+        """
+        seq = event.get("seq")
+        if seq is None or event.get("origin") != main.state.PROCESS_ID:
+            return False
+        if seq <= self.last_seq:
+            self.gaps.discard(seq)
+        elif seq - self.last_seq - 1 > GAP_FRAMES:
+            return True
+        else:
+            self.gaps.update(range(self.last_seq + 1, seq))
+            self.last_seq = seq
+        if not self.gaps:
+            self.gap_since = None
+            return False
+        if self.gap_since is None:
+            self.gap_since = time.monotonic()
+        return self.gaps_lost()
+
+    def gaps_lost(self):
+        """Whether numbered broadcasts have been missing for GAP_SECONDS. The
+        consumer checks that late too, in case none come after them."""
+        if self.gap_since is None:
+            return False
+        return time.monotonic() - self.gap_since >= GAP_SECONDS
+
+    def _caught_up(self):
+        self.last_seq = self.state.frame_seq
+        self.gaps.clear()
+        self.gap_since = None
+
+    def allow(self, action):
+        """Whether the action's within this connection's and the retro's rate
+        limits (see main.ratelimit). Counts it if not."""
+        if not settings.RETRO_RATE_LIMIT:
+            return True
+        type = action_type(action)
+        now = time.monotonic()
+        # Connection first, so one client going over doesn't use up its retro's.
+        for buckets in [self.rate_limits, self.state.rate_limits]:
+            if not buckets.take(type, now):
+                metrics.RATE_LIMITED.inc(1, type, buckets.scope)
+                return False
+        return True
+
+    def handle(self, action) -> Outbox:
+        with metrics.measure_action(action_type(action)), self.state.lock:
+            try:
+                self.state.refresh_if_stale()
+                out = self._handle(self.state, action)
+            except (IntegrityError, Retro.DoesNotExist):
+                # Another process may have archived it while it's open here,
+                # so writing or reloading it failed. Bring it back, reloading
+                # drops anything half done, and try again.
+                if Retro.objects.filter(pk=self.retro_uuid).exists():
+                    raise
+                if not restore(self.retro_uuid):
+                    raise
+                self.state.stale = True
+                self.state.refresh_if_stale()
+                out = self._handle(self.state, action)
+            joined, left = self.state.seen(self.channel, self.person_name)
+            if joined or left:
+                out.broadcast(presence_msg(joined, left))
+            out.broadcasts = [self.state.sequence_frame(t) for t in out.broadcasts]
+            return out
+
+    def _handle(self, state: RetroState, action) -> Outbox:
+        out = Outbox()
+
+        # TODO maybe move this into connect()
+        if action["type"] == "join":
+            self.person_name = action["name"]
+            # Whatever stage the retro's at they're now here. Their Person row
+            # waits until they vote.
+            joined, left = state.join(self.channel, self.person_name)
+            if joined or left:
+                out.broadcast(presence_msg(joined, left))
+            if action.get("resumed"):
+                # Just saying who's back on a resumed connection.
+                return out
+            if state.state != "joining":
+                # Send init to jump to wherever the retro is up to.
+                out.replies.append(state.stamp_init(init_text(state)))
+
+        if state.state == "joining":
+            if action["type"] == "start":
+                state.set_state("brainstorming")
+                out.broadcasts.append(init_text(state))
+        elif state.state == "brainstorming":
+            if action["type"] == "addTopic":
+                topic = state.add_topic(action["text"], action["list"])
+                out.broadcast(
+                    {
+                        "type": "addTopic",
+                        "id": topic.pk,
+                        "list": action["list"],
+                        "text": action["text"],
+                    }
+                )
+            elif action["type"] == "goToGrouping":
+                with state.transaction():
+                    state.set_initial_topic_positions()
+                    state.set_state("grouping")
+                out.broadcasts.append(init_text(state))
+        elif state.state == "grouping":
+            if action["type"] == "moveTopic":
+                # While-being-dragged movements, of which there are many. These
+                # are coalesced per topic and relayed to other browsers a batch
+                # per tick but never persisted.
+                t = find_topic(state, action)
+                if t is not None:
+                    out.flush_drags_in = state.drag(t, action["x"], action["y"])
+            elif action["type"] == "dropTopic":
+                # Done-with-drag movements, which are relayed right away and
+                # persisted.
+                t = find_topic(state, action)
+                if t is not None:
+                    groups_version = state.grouping.version
+                    state.drop_topic(t, action["x"], action["y"])
+                    out.broadcast(
+                        {"type": "moveTopic", **move_dict(t, action["x"], action["y"])}
+                    )
+                    if state.grouping.version != groups_version:
+                        out.broadcast(
+                            {"type": "groups", "groups": state.grouping.groups()}
+                        )
+            elif action["type"] == "goToVoting":
+                # The clusters are the groups topics have been dropped into.
+                # Clients used to send them, which is ignored now.
+                with state.transaction():
+                    state.make_clusters(state.grouping.clusters(state.topics_by_id))
+                    state.set_state("voting")
+                out.broadcasts.append(init_text(state))
+        elif state.state == "voting":
+            if action["type"] == "setVotes" and self.person_name is not None:
+                person = state.add_person(self.person_name)
+                state.set_votes(person, [int(v) for v in action["votes"]])
+                out.broadcast({"type": "updateVotes", **people_dict(person)})
+            elif action["type"] == "goToDiscussion":
+                # Cluster vote counts are kept up to date by setVotes.
+                state.set_state("discussion")
+                out.broadcasts.append(init_text(state))
+        elif state.state == "discussion":
+            if action["type"] == "addAction":
+                state.add_action(action["text"])
+                # Kind of a hack but just re-init
+                out.broadcasts.append(init_text(state))
+
+        return out
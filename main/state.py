@@ -0,0 +1,663 @@
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from main import metrics
+from main.grouping import GroupingIndex
+from main.models import *
+from main.presence import Presence
+from main.ratelimit import Buckets
+from main.writebehind import writer
+
+
+# Rough per-row cost of a model instance in memory on top of its text, used to
+# keep the cache under RETRO_STATE_CACHE_MAX_BYTES without walking objects.
+ROW_BYTES = 600
+
+# Seconds between updates of an open retro's Retro.last_seen.
+LAST_SEEN_EVERY = 60
+
+# Tags broadcasts so we can tell when another process changed a retro.
+PROCESS_ID = uuid4().hex
+
+
+def _new_process_id():
+    global PROCESS_ID
+    PROCESS_ID = uuid4().hex
+
+
+# Workers forked by main.serve are other processes too.
+os.register_at_fork(after_in_child=_new_process_id)
+
+
+class RetroState:
+    """Authoritative in-memory copy of one retro and everything in it.
+
+    Every change is recorded as an event: appended to the retro's log
+    (RetroEvent) and applied to this copy, so building messages never has to
+    query. Changes that need a primary key, like adding a topic, insert their
+    row first. The rest, like positions, votes and phase changes, are only
+    written to the other tables when a snapshot is taken, at each phase
+    change and every RETRO_SNAPSHOT_EVERY events. Loading starts from the
+    latest snapshot and replays the events after it. With RETRO_WRITE_BEHIND
+    the event and snapshot writes are queued and committed in the background
+    instead (see main.writebehind).
+
+    This only holds while every participant of a retro is served by the same
+    process, which the in-memory channel layer already requires. When
+    participants are spread across processes (see main.layers) each one has
+    its own copy, and a broadcast from another process marks ours stale so
+    it's reloaded before it's next used.
+
+    Callers hold lock while reading or changing it. Every change bumps
+    version, which is what memo() keys its results on.
+
+    Broadcast frames are numbered by frame_seq and the last
+    RETRO_RESUME_FRAMES of them kept so a client that reconnects can be sent
+    just the ones it missed (see frames_since()). The numbers only mean
+    something within one epoch, which is a new one whenever this copy is
+    loaded or another process changes the retro.
+    """
+
+    def __init__(self, contents, events):
+        self.lock = threading.RLock()
+        self.connections = 0
+        self.version = 0
+        self.stale = False
+        self._memo: dict[str, tuple[int, object]] = {}
+        # Where topics are mid-drag, by id. These are only ever relayed, a
+        # batch per tick, and never stored (see drag()). They have their own
+        # lock, never held for I/O, so flushing them doesn't wait on lock.
+        self.drag_lock = threading.Lock()
+        self.drags: dict[int, tuple[Topic, int, int]] = {}
+        self.drag_flush_scheduled = False
+        self.last_drag_flush = 0.0
+        self.epoch = uuid4().hex[:8]
+        self.frame_seq = 0
+        self.recent_frames: deque[tuple[int, str]] = deque()
+        self.recent_frames_bytes = 0
+        # The last stamp_init(): (init text, epoch, frame_seq, stamped text).
+        self._stamped: tuple[str, str, int, str] | None = None
+        self.rate_limits = Buckets("retro")
+        self.presence = Presence()
+        self._last_seen_saved = None
+        # Writes held back until the outermost transaction() ends, with
+        # write-behind on, and whether they need to be flushed then.
+        self._pending: list | None = None
+        self._flush_pending = False
+        self._replay(contents, events)
+
+    def _set_contents(self, retro, people, topics, clusters, actions, seq=0):
+        self.retro = retro
+        self.people = {p.name: p for p in people}
+        self.topics = list(topics)
+        self.topics_by_id = {t.pk: t for t in self.topics}
+        # Only for clients that still refer to topics by text.
+        self.topics_by_text = {}
+        for t in self.topics:
+            self.topics_by_text.setdefault(t.text, t)
+        self.clusters = list(clusters)
+        self.actions = list(actions)
+        # Kept from when topics are first placed for grouping (see
+        # set_initial_topic_positions()) until the clusters are made.
+        self.grouping = GroupingIndex()
+        if retro.state == "grouping":
+            for t in self.topics:
+                self.grouping.move(t.pk, t.x, t.y)
+        # The last event applied and the one the last snapshot was taken at.
+        self.seq = seq
+        self.snapshot_seq = seq
+
+    @staticmethod
+    def _query(retro_uuid):
+        """Loads a retro in a fixed number of queries however big it is.
+
+        Returns the contents for _set_contents() and the events to replay on
+        top. Retros that don't have a snapshot yet are loaded from their rows.
+        """
+        writer.flush()
+        snapshot = (
+            RetroSnapshot.objects.select_related("retro")
+            .filter(retro_id=retro_uuid)
+            .order_by("-seq")
+            .first()
+        )
+        if snapshot is None:
+            retro = Retro.objects.prefetch_related(
+                "people", "topics", "clusters", "action_items"
+            ).get(uuid=retro_uuid)
+            contents = (
+                retro,
+                retro.people.all(),
+                retro.topics.all(),
+                retro.clusters.all(),
+                retro.action_items.all(),
+                0,
+            )
+        else:
+            contents = (*from_snapshot(snapshot.retro, snapshot.data), snapshot.seq)
+        events = RetroEvent.objects.filter(
+            retro_id=retro_uuid, seq__gt=contents[-1]
+        ).order_by("seq", "pk")
+        return contents, list(events)
+
+    @classmethod
+    def load(cls, retro_uuid):
+        return cls(*cls._query(retro_uuid))
+
+    def refresh_if_stale(self):
+        if self.stale:
+            self._replay(*self._query(self.retro.pk))
+            self.stale = False
+
+    def changed_elsewhere(self):
+        """Notes that another process changed the retro.
+
+        Our copy is reloaded before it's next used, and clients can't resume
+        past this point since we never saw the frames for that change.
+        """
+        with self.lock:
+            self.stale = True
+            self.epoch = uuid4().hex[:8]
+            self.recent_frames.clear()
+            self.recent_frames_bytes = 0
+
+    def _replay(self, contents, events):
+        self._set_contents(*contents)
+        for event in events:
+            self._apply(event.type, event.data)
+            self.seq = event.seq
+        self._changed()
+
+    @property
+    def state(self):
+        return self.retro.state
+
+    def topics_by_cluster(self) -> dict[int, list[Topic]]:
+        by_cluster: dict[int, list[Topic]] = {}
+        for t in self.topics:
+            if t.cluster_id is not None:
+                by_cluster.setdefault(t.cluster_id, []).append(t)
+        return by_cluster
+
+    @contextmanager
+    def transaction(self):
+        """Wraps several changes in one database transaction.
+
+        If it rolls back the in-memory copy is reloaded the next time it's
+        used since it may have been partly changed. With write-behind the
+        changes' queued writes are submitted together when it ends.
+        """
+        outermost = self._pending is None
+        if outermost:
+            self._pending = []
+        try:
+            with transaction.atomic():
+                yield
+        except Exception:
+            self.stale = True
+            raise
+        finally:
+            if outermost:
+                pending, self._pending = self._pending, None
+                flush, self._flush_pending = self._flush_pending, False
+        if outermost:
+            if pending:
+                writer.submit(self, pending)
+            if flush:
+                writer.flush()
+
+    def _write(self, write):
+        """Makes a write, a RetroEvent to insert or a function, or with
+        write-behind queues it."""
+        if not settings.RETRO_WRITE_BEHIND:
+            if isinstance(write, RetroEvent):
+                write.save(force_insert=True)
+            else:
+                write()
+        elif self._pending is not None:
+            self._pending.append(write)
+        else:
+            writer.submit(self, [write])
+
+    def memo(self, key, build):
+        """Returns build(), reusing the last result until the retro next changes."""
+        hit = self._memo.get(key)
+        if hit is None or hit[0] != self.version:
+            hit = self._memo[key] = (self.version, build())
+        return hit[1]
+
+    def _changed(self):
+        self.version += 1
+
+    def approx_bytes(self):
+        rows = 1 + len(self.people) + len(self.topics) + len(self.clusters)
+        rows += len(self.actions)
+        text = sum(len(t.text) for t in self.topics)
+        text += sum(len(a.text) for a in self.actions)
+        return rows * ROW_BYTES + text + self.recent_frames_bytes
+
+    def sequence_frame(self, text):
+        """Numbers an encoded broadcast frame and keeps it for resuming."""
+        self.frame_seq += 1
+        text = _with_fields(text, f'"seq":{self.frame_seq}')
+        self.recent_frames.append((self.frame_seq, text))
+        self.recent_frames_bytes += len(text)
+        if len(self.recent_frames) > settings.RETRO_RESUME_FRAMES:
+            self.recent_frames_bytes -= len(self.recent_frames.popleft()[1])
+        return text
+
+    def stamp_init(self, text):
+        """Marks an init frame with where in the numbering it's from.
+
+        Every socket getting the same init before the next broadcast gets the
+        same string, so it's built once and transcoding it is a cache hit.
+        """
+        stamped = self._stamped
+        if (
+            stamped is None
+            or stamped[0] is not text
+            or stamped[1:3] != (self.epoch, self.frame_seq)
+        ):
+            fields = f'"epoch":"{self.epoch}","seq":{self.frame_seq}'
+            stamped = (text, self.epoch, self.frame_seq, _with_fields(text, fields))
+            self._stamped = stamped
+        return stamped[3]
+
+    def frames_since(self, epoch, seq):
+        """The frames after seq, or None if they aren't all still here."""
+        if epoch != self.epoch or seq > self.frame_seq:
+            return None
+        oldest = self.recent_frames[0][0] if self.recent_frames else self.frame_seq + 1
+        if seq + 1 < oldest:
+            return None
+        return [text for s, text in self.recent_frames if s > seq]
+
+    def _record(self, type, **data):
+        """Appends an event to the log and applies it."""
+        self._write(
+            RetroEvent(retro=self.retro, seq=self.seq + 1, type=type, data=data)
+        )
+        self.seq += 1
+        self._apply(type, data)
+        self._changed()
+        if self.seq - self.snapshot_seq >= settings.RETRO_SNAPSHOT_EVERY:
+            self.snapshot()
+
+    def snapshot(self):
+        """Stores the whole retro as of now and brings its rows up to date.
+
+        Older snapshots aren't needed after this and are deleted. The events
+        are kept. What's written is copied now so it can be written later.
+        """
+        retro, seq, state = self.retro, self.seq, self.retro.state
+        data = snapshot_data(self)
+        topics = [
+            Topic(id=t.pk, x=t.x, y=t.y, cluster_id=t.cluster_id) for t in self.topics
+        ]
+        people = [Person(id=p.pk, votes=list(p.votes)) for p in self.people.values()]
+        clusters = [Cluster(id=c.pk, votes=c.votes) for c in self.clusters]
+
+        def write():
+            RetroSnapshot.objects.create(retro=retro, seq=seq, data=data)
+            RetroSnapshot.objects.filter(retro=retro, seq__lt=seq).delete()
+            Retro.objects.filter(pk=retro.pk).update(state=state)
+            Topic.objects.bulk_update(topics, ["x", "y", "cluster"])
+            Person.objects.bulk_update(people, ["votes"])
+            Cluster.objects.bulk_update(clusters, ["votes"])
+
+        with self.transaction():
+            self._write(write)
+        self.snapshot_seq = self.seq
+
+    # Who's connected (see main.presence). These aren't events: presence
+    # isn't stored, and is kept when the retro's reloaded. Each returns who
+    # (joined, left).
+
+    def join(self, channel, name):
+        return self._presence_changed(
+            self.presence.join(channel, name, time.monotonic())
+        )
+
+    def leave(self, channel):
+        return self._presence_changed(self.presence.leave(channel))
+
+    def seen(self, channel, name):
+        """Notes a connection's still there, joining it again if it had been
+        dropped for going quiet, and drops any others that have."""
+        now = time.monotonic()
+        self.note_open(now)
+        joined, left = [], []
+        if name is not None and not self.presence.seen(channel, now):
+            joined, left = self.presence.join(channel, name, now)
+        left += self.presence.expire(now)[1]
+        return self._presence_changed((joined, left))
+
+    def note_open(self, now=None):
+        """Records that the retro's open here in Retro.last_seen, at most
+        every LAST_SEEN_EVERY seconds, so other processes can tell."""
+        now = time.monotonic() if now is None else now
+        saved = self._last_seen_saved
+        if saved is not None and now - saved < LAST_SEEN_EVERY:
+            return
+        self._last_seen_saved = now
+        retro_uuid, last_seen = self.retro.pk, timezone.now()
+        self._write(
+            lambda: Retro.objects.filter(pk=retro_uuid).update(last_seen=last_seen)
+        )
+
+    def _presence_changed(self, change):
+        if change[0] or change[1]:
+            self._changed()
+        return change
+
+    # Changes. Each records an event, whose _apply_<type>() method below
+    # makes the in-memory change both now and when replaying.
+
+    def set_state(self, state):
+        """Changes phase. With write-behind everything's flushed afterwards."""
+        with self.transaction():
+            self._record("set_state", state=state)
+            self.snapshot()
+            self._flush_pending = True
+
+    def add_person(self, name):
+        """The person's row, created when they first do something that's kept
+        against them. Joining only makes them present."""
+        if name not in self.people:
+            person, _ = self.retro.people.get_or_create(name=name)
+            self._record("add_person", id=person.pk, name=name)
+        return self.people[name]
+
+    def add_topic(self, text, feeling):
+        topic = self.retro.topics.create(text=text, feeling=feeling)
+        self._record("add_topic", id=topic.pk, text=text, feeling=feeling)
+        return self.topics_by_id[topic.pk]
+
+    def set_initial_topic_positions(self):
+        positions = [[t.pk, *random_topic_position()] for t in self.topics]
+        self._record("set_positions", positions=positions)
+
+    def drag(self, topic, x, y):
+        """Records where a topic is while it's being dragged.
+
+        Returns how many seconds until the next drag flush if the caller needs
+        to schedule it, or None if one is already scheduled.
+        """
+        with self.drag_lock:
+            self.drags[topic.pk] = (topic, x, y)
+            if self.drag_flush_scheduled:
+                return None
+            self.drag_flush_scheduled = True
+        tick = 1 / settings.RETRO_DRAG_TICK_HZ
+        return max(0, self.last_drag_flush + tick - time.monotonic())
+
+    def take_drags(self):
+        """Returns and forgets the (topic, x, y)s dragged since the last flush.
+
+        Callers needn't hold lock.
+        """
+        with self.drag_lock:
+            drags, self.drags = self.drags, {}
+            self.drag_flush_scheduled = False
+            self.last_drag_flush = time.monotonic()
+        return list(drags.values())
+
+    def drop_topic(self, topic, x, y):
+        self._record("set_positions", positions=[[topic.pk, x, y]])
+
+    def make_clusters(self, topic_refs):
+        """Creates one cluster per list of topic ids.
+
+        Topic texts work too for older clients and take every topic with that
+        text.
+        """
+        by_text: dict[str, list[int]] = {}
+        for t in self.topics:
+            by_text.setdefault(t.text, []).append(t.pk)
+        clusters = Cluster.objects.bulk_create(
+            [Cluster(retro=self.retro) for _ in topic_refs]
+        )
+        topic_ids = []
+        for refs in topic_refs:
+            ids = set()
+            for ref in refs:
+                if isinstance(ref, str):
+                    ids.update(by_text.get(ref, []))
+                elif ref in self.topics_by_id:
+                    ids.add(ref)
+            topic_ids.append(sorted(ids))
+        self._record(
+            "make_clusters",
+            clusters=[[c.pk, ids] for c, ids in zip(clusters, topic_ids)],
+        )
+
+    def set_votes(self, person, votes):
+        """Records a person's votes. Votes for clusters not in this retro are dropped."""
+        cluster_ids = {c.pk for c in self.clusters}
+        votes = [v for v in votes if v in cluster_ids]
+        self._record("set_votes", name=person.name, votes=votes)
+
+    def add_action(self, text):
+        item = self.retro.action_items.create(text=text)
+        self._record("add_action", id=item.pk, text=text)
+
+    # Applying events. Retros loaded from rows rather than a snapshot may
+    # already have what an event creates, so those check first.
+
+    def _apply(self, type, data):
+        getattr(self, f"_apply_{type}")(**data)
+
+    def _apply_set_state(self, state):
+        self.retro.state = state
+
+    def _apply_add_person(self, id, name):
+        if name not in self.people:
+            self.people[name] = Person(id=id, retro=self.retro, name=name)
+
+    def _apply_add_topic(self, id, text, feeling):
+        if id not in self.topics_by_id:
+            topic = Topic(id=id, retro=self.retro, text=text, feeling=feeling)
+            self.topics.append(topic)
+            self.topics_by_id[id] = topic
+            self.topics_by_text.setdefault(text, topic)
+
+    def _apply_set_positions(self, positions):
+        for topic_id, x, y in positions:
+            with self.drag_lock:
+                self.drags.pop(topic_id, None)
+            topic = self.topics_by_id.get(topic_id)
+            if topic is not None:
+                topic.x = x
+                topic.y = y
+                self.grouping.move(topic_id, x, y)
+
+    def _apply_make_clusters(self, clusters):
+        known = {c.pk for c in self.clusters}
+        for cluster_id, topic_ids in clusters:
+            if cluster_id not in known:
+                self.clusters.append(Cluster(id=cluster_id, retro=self.retro))
+            for topic_id in topic_ids:
+                if topic_id in self.topics_by_id:
+                    self.topics_by_id[topic_id].cluster_id = cluster_id
+
+    def _apply_set_votes(self, name, votes):
+        """Moves cluster counts by the difference from the person's old votes."""
+        person = self.people[name]
+        delta = Counter(votes)
+        delta.subtract(person.votes)
+        person.votes = votes
+        for cluster in self.clusters:
+            cluster.votes += delta[cluster.pk]
+
+    def _apply_add_action(self, id, text):
+        if all(a.pk != id for a in self.actions):
+            self.actions.append(ActionItem(id=id, retro=self.retro, text=text))
+
+
+def _with_fields(text, fields):
+    # Adds fields to an encoded JSON object without decoding it.
+    return f"{text[:-1]},{fields}}}"
+
+
+def snapshot_data(state: RetroState):
+    return {
+        "state": state.retro.state,
+        "people": [[p.pk, p.name, p.votes] for p in state.people.values()],
+        "topics": [
+            [t.pk, t.text, t.feeling, t.x, t.y, t.cluster_id] for t in state.topics
+        ],
+        "clusters": [[c.pk, c.votes] for c in state.clusters],
+        "actions": [[a.pk, a.text] for a in state.actions],
+    }
+
+
+def from_snapshot(retro, data):
+    retro.state = data["state"]
+    return (
+        retro,
+        [Person(id=i, retro=retro, name=n, votes=v) for i, n, v in data["people"]],
+        [
+            Topic(id=i, retro=retro, text=t, feeling=f, x=x, y=y, cluster_id=c)
+            for i, t, f, x, y, c in data["topics"]
+        ],
+        [Cluster(id=i, retro=retro, votes=v) for i, v in data["clusters"]],
+        [ActionItem(id=i, retro=retro, text=t) for i, t in data["actions"]],
+    )
+
+
+class RetroStateCache:
+    """LRU of RetroStates with a cap on count and approximate size.
+
+    Only idle retros, ones with no open connections, are ever evicted. Since
+    every change is written through as it happens, or queued with
+    write-behind, evicting just drops the memory.
+    """
+
+    def __init__(self, max_retros, max_bytes):
+        self.max_retros = max_retros
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._states: OrderedDict[str, RetroState] = OrderedDict()
+        self._loading: dict[str, _Load] = {}
+
+    def __len__(self):
+        return len(self._states)
+
+    def acquire(self, retro_uuid) -> RetroState:
+        """Returns the retro's state, loading it if needed, for a new connection.
+
+        Loading happens outside the cache's lock so other retros aren't held
+        up, and connections that arrive while a retro is loading wait for
+        that load instead of making their own.
+        """
+        key = str(retro_uuid)
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None and state.connections > 0:
+                self._use(key, state, 1)
+                return state
+            load = self._loading.get(key)
+            loading = load is None
+            if loading:
+                load = self._loading[key] = _Load()
+            else:
+                load.waiters += 1
+        if not loading:
+            load.done.wait()
+            if load.error is not None:
+                raise load.error
+            return load.state
+        try:
+            state = self._load(key, state)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            load.error = e
+            load.done.set()
+            raise
+        with self._lock:
+            del self._loading[key]
+            self._states[key] = state
+            # The waiters are counted now so it can't be evicted before they
+            # get it.
+            self._use(key, state, 1 + load.waiters)
+        load.state = state
+        load.done.set()
+        return state
+
+    def _load(self, key, cached):
+        if cached is not None:
+            if Retro.objects.filter(pk=key).exists():
+                return cached
+            # It's been archived since (see main.archive).
+            with self._lock:
+                self._states.pop(key, None)
+        return RetroState.load(key)
+
+    def _use(self, key, state, connections):
+        self._states.move_to_end(key)
+        state.connections += connections
+        self._evict()
+
+    def release(self, state: RetroState):
+        with self._lock:
+            state.connections -= 1
+            self._evict()
+
+    def discard(self, retro_uuid):
+        """Forgets an idle retro, for archiving it. Returns False, keeping it,
+        if it has connections or is being loaded for one."""
+        key = str(retro_uuid)
+        with self._lock:
+            state = self._states.get(key)
+            if key in self._loading or (state is not None and state.connections):
+                return False
+            self._states.pop(key, None)
+            return True
+
+    def connections(self):
+        with self._lock:
+            return sum(s.connections for s in self._states.values())
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+
+    def _evict(self):
+        total = sum(s.approx_bytes() for s in self._states.values())
+        for key, state in list(self._states.items()):
+            if len(self._states) <= self.max_retros and total <= self.max_bytes:
+                break
+            if state.connections == 0:
+                total -= state.approx_bytes()
+                del self._states[key]
+
+
+class _Load:
+    """A retro being loaded by RetroStateCache.acquire(), for others to wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.state: RetroState | None = None
+        self.error: BaseException | None = None
+
+
+retro_states = RetroStateCache(
+    settings.RETRO_STATE_CACHE_MAX_RETROS, settings.RETRO_STATE_CACHE_MAX_BYTES
+)
+
+metrics.Gauge(
+    "retro_active_retros", "Retros held in memory.", lambda: len(retro_states)
+)
+metrics.Gauge(
+    "retro_active_connections", "Open websocket connections.", retro_states.connections
+)
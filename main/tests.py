@@ -1,3 +1,1050 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import zlib
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from main.archive import archive, restore
+from main.assets import assets
+from main.bench import Client, websocket_app
+from main.consumers import AsyncRetroConsumer, RetroConsumer
+from main.management.commands.retro_replay import Replay, seed
+from main.grouping import GroupingIndex
+from main import metrics
+from main.layers import InMemoryChannelLayer, RedisPubSubChannelLayer
+from main.models import (
+    TOPIC_BOX_HEIGHT,
+    TOPIC_BOX_WIDTH,
+    Retro,
+    RetroArchive,
+    RetroEvent,
+    Topic,
+)
+import main.state
+from main.outbound import Outbound
+from main.record import read_trace, recorder
+from main.resp import FakeRedis, RespError
+from main.serve import worker_for
+from main.session import (
+    GAP_FRAMES,
+    GAP_SECONDS,
+    RetroSession,
+    broadcast_event,
+    drag_text,
+    init_msg,
+)
+from main.state import RetroState, RetroStateCache
+from main.wire import pack_compact, unpack_compact
+from main.writebehind import writer
+
+
+# Not a TestCase, so the consumers' database threads can see the retro.
+class ConsumersTest(TransactionTestCase):
+    async def play(self, consumer):
+        """What two participants get going from joining to grouping, without
+        what differs from run to run: ids, random positions and epochs."""
+        retro = await database_sync_to_async(Retro.objects.create)()
+        app = websocket_app(consumer)
+        a, b = Client(app, retro.uuid), Client(app, retro.uuid)
+        got = [[await a.connect()], [await b.connect()]]
+        for sender, action in [
+            (a, {"type": "join", "name": "a"}),
+            (b, {"type": "join", "name": "b"}),
+            (a, {"type": "start"}),
+            (b, {"type": "addTopic", "list": "sad", "text": "t"}),
+            (a, {"type": "goToGrouping"}),
+        ]:
+            await sender.send(action)
+            for client, frames in zip([a, b], got):
+                frames.append(await client.recv())
+        await a.close()
+        await b.close()
+        return _without_keys(got, {"id", "x", "y", "epoch"})
+
+    async def test_async_consumer_matches_sync_one(self):
+        sync = await self.play(RetroConsumer)
+        self.assertEqual(
+            [m["type"] for m in sync[1]],
+            ["init", "presence", "presence", "init", "addTopic", "init"],
+        )
+        self.assertEqual(sync[1][-1]["state"], "grouping")
+        self.assertEqual(sync[1][-1]["topics"], [{"text": "t", "feeling": "sad"}])
+        self.assertEqual(await self.play(AsyncRetroConsumer), sync)
+
+    async def test_bad_acks_are_ignored(self):
+        for consumer in [RetroConsumer, AsyncRetroConsumer]:
+            with self.subTest(consumer=consumer.__name__):
+                retro = await database_sync_to_async(Retro.objects.create)()
+                client = Client(websocket_app(consumer), retro.uuid)
+                await client.connect()
+                for received in [None, "many", -1, 2.5, [1]]:
+                    await client.send({"type": "ack", "received": received})
+                await client.send({"type": "ack"})
+                # Still connected.
+                await client.send({"type": "join", "name": "a"})
+                self.assertEqual((await client.recv())["type"], "presence")
+                await client.close()
+
+    async def test_broadcasts_are_encoded_once_and_forwarded_verbatim(self):
+        for consumer in [RetroConsumer, AsyncRetroConsumer]:
+            with self.subTest(consumer=consumer.__name__):
+                retro = await database_sync_to_async(Retro.objects.create)(
+                    state="brainstorming"
+                )
+                app = websocket_app(consumer)
+                clients = [Client(app, retro.uuid) for _ in range(3)]
+                for client in clients:
+                    await client.connect()
+                with mock.patch("json.dumps", wraps=json.dumps) as dumps:
+                    await clients[0].send(
+                        {"type": "addTopic", "list": "happy", "text": "t"}
+                    )
+                    frames = [await c.comm.receive_from(10) for c in clients]
+                encoded = [
+                    call.args[0]
+                    for call in dumps.call_args_list
+                    if call.args[0].get("type") == "addTopic" and "id" in call.args[0]
+                ]
+                self.assertEqual(len(encoded), 1)
+                self.assertEqual(frames, [frames[0]] * 3)
+                self.assertEqual(json.loads(frames[0]), {**encoded[0], "seq": mock.ANY})
+                for client in clients:
+                    await client.close()
+
+
+def _without_keys(value, keys):
+    if isinstance(value, list):
+        return [_without_keys(v, keys) for v in value]
+    if isinstance(value, dict):
+        return {k: _without_keys(v, keys) for k, v in value.items() if k not in keys}
+    return value
+
+
+class InitMsgQueriesTest(TestCase):
+    def make_retro(self, num_clusters):
+        retro = Retro.objects.create(state="voting")
+        for i in range(num_clusters):
+            cluster = retro.clusters.create()
+            for j in range(3):
+                retro.topics.create(text=f"{i}.{j}", feeling="happy", cluster=cluster)
+            retro.people.create(name=f"person {i}", votes=[cluster.pk])
+            retro.action_items.create(text=f"action {i}")
+        return retro
+
+    def test_query_count_does_not_grow_with_retro(self):
+        for num_clusters in [1, 40]:
+            retro = self.make_retro(num_clusters)
+            # No snapshot, so it's the rows plus the (empty) event log.
+            with self.assertNumQueries(7):
+                msg = init_msg(RetroState.load(retro.uuid))
+            self.assertEqual(len(msg["clusters"]), num_clusters)
+            self.assertEqual(len(msg["clusters"][-1]["topics"]), 3)
+
+    def test_loaded_state_needs_no_queries(self):
+        state = RetroState.load(self.make_retro(40).uuid)
+        with self.assertNumQueries(0):
+            init_msg(state)
+
+
+class RetroStateCacheTest(TestCase):
+    def retros(self, n):
+        return [Retro.objects.create().uuid for _ in range(n)]
+
+    def test_evicts_least_recently_used_idle_retros(self):
+        cache = RetroStateCache(max_retros=2, max_bytes=10**9)
+        busy, idle, newer, newest = self.retros(4)
+        busy_state = cache.acquire(busy)
+        cache.release(cache.acquire(idle))
+        cache.release(cache.acquire(newer))
+        # Over the limit, but the only retro that's older is connected.
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(list(cache._states), [str(busy), str(newer)])
+
+        cache.release(cache.acquire(newest))
+        self.assertEqual(list(cache._states), [str(busy), str(newest)])
+        with self.assertNumQueries(0):
+            self.assertIs(cache.acquire(busy), busy_state)
+        self.assertEqual(busy_state.connections, 2)
+
+        # Coming back reloads it.
+        with self.assertNumQueries(7):
+            cache.acquire(idle)
+        self.assertEqual(list(cache._states), [str(busy), str(idle)])
+
+    def test_evicts_down_to_the_byte_ceiling(self):
+        a, b, c = self.retros(3)
+        size = RetroState.load(a).approx_bytes()
+        cache = RetroStateCache(max_retros=100, max_bytes=2 * size)
+        for uuid in [a, b]:
+            cache.release(cache.acquire(uuid))
+        self.assertEqual(len(cache), 2)
+        held = cache.acquire(c)
+        self.assertEqual(list(cache._states), [str(b), str(c)])
+        cache.acquire(a)
+        self.assertEqual(list(cache._states), [str(c), str(a)])
+        # Connected retros stay even over the ceiling.
+        cache.acquire(b)
+        self.assertEqual(len(cache), 3)
+        cache.release(held)
+        self.assertEqual(list(cache._states), [str(a), str(b)])
+
+
+class PhaseTransitionQueriesTest(TestCase):
+    def transition_queries(self, num_topics):
+        retro = Retro.objects.create(state="brainstorming")
+        for i in range(num_topics):
+            retro.topics.create(text=f"topic {i}", feeling="happy")
+        retro.people.create(name="person", votes=[])
+        state = RetroState.load(retro.uuid)
+        pairs = [[f"topic {i}", f"topic {i + 1}"] for i in range(0, num_topics, 2)]
+        with CaptureQueriesContext(connection) as queries:
+            with state.transaction():
+                state.set_initial_topic_positions()
+                state.set_state("grouping")
+            with state.transaction():
+                state.make_clusters(pairs)
+                state.set_state("voting")
+            state.set_votes(state.people["person"], [state.clusters[0].pk])
+            state.set_state("discussion")
+        self.assertEqual(state.clusters[0].votes, 1)
+        self.assertEqual(
+            Retro.objects.get(uuid=retro.uuid).topics.filter(cluster=None).count(), 0
+        )
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_retro(self):
+        self.assertEqual(self.transition_queries(2), self.transition_queries(80))
+
+
+class VotesTest(TestCase):
+    def test_counts_follow_changed_votes(self):
+        retro = Retro.objects.create(state="voting")
+        a, b = retro.clusters.create(), retro.clusters.create()
+        retro.people.create(name="person", votes=[])
+        state = RetroState.load(retro.uuid)
+        person = state.people["person"]
+
+        state.set_votes(person, [a.pk, a.pk, b.pk])
+        state.set_votes(person, [b.pk, b.pk, 12345])
+
+        self.assertEqual(person.votes, [b.pk, b.pk])
+        self.assertEqual([c.votes for c in state.clusters], [0, 2])
+        reloaded = RetroState.load(retro.uuid)
+        self.assertEqual([c.votes for c in reloaded.clusters], [0, 2])
+        state.snapshot()
+        self.assertEqual([c.votes for c in retro.clusters.order_by("pk")], [0, 2])
+
+
+class DragTest(TestCase):
+    def test_flushing_drags_does_not_wait_for_the_retro(self):
+        retro = Retro.objects.create(state="grouping")
+        topic = retro.topics.create(text="t", feeling="sad")
+        state = RetroState.load(retro.uuid)
+        self.assertIsNotNone(state.drag(state.topics[0], 1, 2))
+        self.assertIsNone(state.drag(state.topics[0], 3, 4))
+
+        # Like an action writing to the database on another thread.
+        holding, done = threading.Event(), threading.Event()
+
+        def hold():
+            with state.lock:
+                holding.set()
+                done.wait(5)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        holding.wait(5)
+        try:
+            moves = json.loads(drag_text(state))["moves"]
+        finally:
+            done.set()
+            thread.join()
+        self.assertEqual(moves, [{"id": topic.pk, "text": "t", "x": 3, "y": 4}])
+        self.assertIsNone(drag_text(state))
+
+
+class TopicAddressingTest(TestCase):
+    def setUp(self):
+        retro = Retro.objects.create(state="grouping")
+        self.topics = [retro.topics.create(text=t, feeling="sad") for t in "ab"]
+        self.session = RetroSession(retro.uuid)
+        self.session.open()
+        self.addCleanup(self.session.close)
+
+    def drop(self, **action):
+        out = self.session.handle({"type": "dropTopic", "x": 5, "y": 6, **action})
+        return [json.loads(text) for text in out.broadcasts]
+
+    def moves(self, **action):
+        self.session.handle({"type": "moveTopic", "x": 7, "y": 8, **action})
+        text = drag_text(self.session.state)
+        return text and json.loads(text)["moves"]
+
+    def test_by_id(self):
+        a, b = self.topics
+        moved = {"type": "moveTopic", "id": b.pk, "text": "b", "x": 5, "y": 6}
+        self.assertEqual(self.drop(id=b.pk)[0], {**moved, "seq": mock.ANY})
+        # The id wins over a text naming some other topic.
+        self.assertEqual(
+            self.moves(id=a.pk, text="b"), [{"id": a.pk, "text": "a", "x": 7, "y": 8}]
+        )
+
+    def test_by_text_from_older_clients(self):
+        b = self.topics[1]
+        self.assertEqual(self.drop(text="b")[0]["id"], b.pk)
+        self.assertEqual(
+            self.moves(text="b"), [{"id": b.pk, "text": "b", "x": 7, "y": 8}]
+        )
+
+    def test_unknown_topics_are_ignored(self):
+        self.assertEqual(self.drop(id=0), [])
+        self.assertEqual(self.drop(text="c"), [])
+        self.assertIsNone(self.moves(id=0))
+
+
+class EventLogTest(TestCase):
+    def play(self, state):
+        state.add_person("person")
+        state.set_state("brainstorming")
+        for i in range(4):
+            state.add_topic(f"topic {i}", "sad")
+        state.set_initial_topic_positions()
+        state.set_state("grouping")
+        state.drop_topic(state.topics[0], 5, 6)
+        ids = [t.pk for t in state.topics]
+        state.make_clusters([ids[:2], ids[2:]])
+        state.set_state("voting")
+        state.set_votes(state.people["person"], [state.clusters[1].pk])
+        state.set_state("discussion")
+        state.add_action("action")
+
+    def test_replay_matches_live_state(self):
+        retro = Retro.objects.create()
+        state = RetroState.load(retro.uuid)
+        with self.settings(RETRO_SNAPSHOT_EVERY=3):
+            self.play(state)
+        self.assertEqual(state.seq, 14)
+        self.assertLess(state.snapshot_seq, state.seq)
+        with self.assertNumQueries(2):
+            reloaded = RetroState.load(retro.uuid)
+        self.assertEqual(init_msg(reloaded), init_msg(state))
+        self.assertEqual(reloaded.seq, state.seq)
+
+    def test_replay_onto_rows_without_snapshot(self):
+        retro = Retro.objects.create()
+        state = RetroState.load(retro.uuid)
+        self.play(state)
+        retro.snapshots.all().delete()
+        self.assertEqual(init_msg(RetroState.load(retro.uuid)), init_msg(state))
+
+
+class MetricsTest(TestCase):
+    def test_actions_show_up(self):
+        retro = Retro.objects.create()
+        session = RetroSession(retro.uuid)
+        session.open()
+        session.handle({"type": "join", "name": "person"})
+        session.handle({"type": "made up"})
+        session.close()
+        text = self.client.get("/metrics").content.decode()
+        self.assertIn('retro_action_seconds_count{action="join"}', text)
+        self.assertIn('retro_action_queries_bucket{action="other",le="0"}', text)
+        self.assertIn("retro_active_retros ", text)
+
+    def test_failed_actions_show_up(self):
+        with self.assertRaises(ValueError):
+            with metrics.measure_action("failing"):
+                Retro.objects.count()
+                raise ValueError
+        text = self.client.get("/metrics").content.decode()
+        self.assertIn('retro_action_errors_total{action="failing"} 1', text)
+        self.assertIn('retro_action_seconds_count{action="failing"} 1', text)
+        self.assertIn('retro_action_queries_sum{action="failing"} 1', text)
+
+
+class ResumeTest(TestCase):
+    def setUp(self):
+        self.retro = Retro.objects.create(state="brainstorming")
+        self.session = RetroSession(self.retro.uuid)
+        init = json.loads(self.session.open()[0])
+        self.resume = (init["epoch"], init["seq"])
+        self.addCleanup(self.session.close)
+
+    def add_topics(self, n):
+        for i in range(n):
+            self.session.handle({"type": "addTopic", "list": "sad", "text": str(i)})
+
+    def reconnect(self, resume):
+        session = RetroSession(self.retro.uuid)
+        frames = [json.loads(f) for f in session.open(resume)]
+        session.close()
+        return frames
+
+    def test_gets_just_missed_frames(self):
+        self.add_topics(3)
+        frames = self.reconnect(self.resume)
+        self.assertEqual(frames[0]["type"], "resumed")
+        self.assertEqual([f["text"] for f in frames[1:]], ["0", "1", "2"])
+        self.assertEqual([f["seq"] for f in frames[1:]], [1, 2, 3])
+        self.assertEqual(self.reconnect((self.resume[0], 3)), [{"type": "resumed"}])
+
+    def test_gets_init_when_frames_are_gone(self):
+        with self.settings(RETRO_RESUME_FRAMES=2):
+            self.add_topics(3)
+        self.assertEqual(self.reconnect(self.resume)[0]["type"], "init")
+        self.assertEqual(self.reconnect(("other", 0))[0]["type"], "init")
+        self.session.saw_broadcast({"origin": "another process"})
+        self.assertEqual(self.reconnect((self.resume[0], 3))[0]["type"], "init")
+
+
+class CompactWireFormatTest(TestCase):
+    def test_round_trips_every_message_type(self):
+        retro = Retro.objects.create(state="voting")
+        cluster = retro.clusters.create(votes=1)
+        retro.topics.create(text="topic", feeling="sad", cluster=cluster)
+        retro.people.create(name="person", votes=[cluster.pk])
+        state = RetroState.load(retro.uuid)
+        messages = [
+            {**init_msg(state), "epoch": "abc", "seq": 3},
+            {"type": "presence", "joined": ["person"], "left": [], "seq": 4},
+            {"type": "addTopic", "id": 1, "list": "sad", "text": "x", "seq": 5},
+            {"type": "moveTopic", "id": 1, "x": 2, "y": 3, "seq": 6},
+            {"type": "moveTopics", "moves": [{"id": 1, "x": 2, "y": 3}]},
+            {"type": "updateVotes", "name": "person", "numVotes": 1, "seq": 7},
+            {"type": "groups", "groups": [[1, 2], [3, 4, 5]], "seq": 8},
+            {"type": "resumed"},
+        ]
+        for msg in messages:
+            packed = json.loads(json.dumps(pack_compact(msg)))
+            expected = dict(msg)
+            if msg["type"] == "init":
+                for c in expected["clusters"]:
+                    del c["topics"]
+            self.assertEqual(unpack_compact(packed), expected)
+
+
+class RedisLayerTest(SimpleTestCase):
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), 2)
+
+    async def test_messages_reach_other_processes(self):
+        redis = FakeRedis()
+        url = await redis.start()
+        a, b = RedisPubSubChannelLayer(url=url), RedisPubSubChannelLayer(url=url)
+        try:
+            on_a, on_b = await a.new_channel(), await b.new_channel()
+            await a.group_add("retro", on_a)
+            await b.group_add("retro", on_b)
+            await b.group_send("retro", {"type": "hi"})
+            self.assertEqual(await self.receive(a, on_a), {"type": "hi"})
+            self.assertEqual(await self.receive(b, on_b), {"type": "hi"})
+
+            await b.send(on_a, {"type": "just a"})
+            self.assertEqual(await self.receive(a, on_a), {"type": "just a"})
+        finally:
+            await a.close()
+            await b.close()
+            await redis.close()
+
+    async def test_reconnects_when_redis_restarts(self):
+        redis = FakeRedis()
+        url = await redis.start()
+        a, b = RedisPubSubChannelLayer(url=url), RedisPubSubChannelLayer(url=url)
+        try:
+            on_a, on_b = await a.new_channel(), await b.new_channel()
+            await a.group_add("retro", on_a)
+            await b.group_add("retro", on_b)
+
+            with self.assertLogs("main.layers", "WARNING"):
+                await redis.close()
+                redis = FakeRedis()
+                await redis.start(port=int(url.rpartition(":")[2]))
+                # Redials rather than hanging or failing.
+                await asyncio.wait_for(b.group_send("retro", {"type": "first"}), 2)
+                self.assertEqual(await self.receive(b, on_b), {"type": "first"})
+
+                # And resubscribes in the background.
+                while a._reconnecting is None or not a._reconnecting.done():
+                    await asyncio.sleep(0.01)
+            await b.group_send("retro", {"type": "again"})
+            self.assertEqual(await self.receive(a, on_a), {"type": "again"})
+            self.assertEqual(await self.receive(b, on_b), {"type": "again"})
+            await a.send(on_b, {"type": "back"})
+            self.assertEqual(await self.receive(b, on_b), {"type": "back"})
+        finally:
+            await a.close()
+            await b.close()
+            await redis.close()
+
+    async def test_logs_in_and_selects_the_database(self):
+        redis = FakeRedis(password="p@ss")
+        url = await redis.start()
+        host = url.removeprefix("redis://")
+        a = RedisPubSubChannelLayer(url=f"redis://:p%40ss@{host}/2")
+        b = RedisPubSubChannelLayer(url=f"redis://user:p%40ss@{host}/2")
+        try:
+            on_a = await a.new_channel()
+            await a.group_add("retro", on_a)
+            await b.group_add("retro", await b.new_channel())
+            await b.group_send("retro", {"type": "hi"})
+            self.assertEqual(await self.receive(a, on_a), {"type": "hi"})
+            self.assertEqual(redis.selected, {2})
+        finally:
+            await a.close()
+            await b.close()
+
+        anonymous = RedisPubSubChannelLayer(url=url)
+        try:
+            with self.assertRaisesRegex(RespError, "NOAUTH"):
+                await anonymous.group_send("retro", {"type": "hi"})
+        finally:
+            await anonymous.close()
+            await redis.close()
+
+
+class AssetsTest(TestCase):
+    def test_caching_and_compression(self):
+        js = self.client.get("/static/main.js", HTTP_ACCEPT_ENCODING="gzip, br;q=0")
+        self.assertEqual(js["Content-Encoding"], "gzip")
+        self.assertEqual(js["Cache-Control"], "no-cache")
+        self.assertEqual(gzip.decompress(js.content), assets.get("main.js")[0].body)
+
+        cached = self.client.get(
+            "/static/main.js",
+            HTTP_IF_NONE_MATCH=js["ETag"],
+            HTTP_ACCEPT_ENCODING="gzip",
+        )
+        self.assertEqual(cached.status_code, 304)
+        # Without gzip it's different bytes, so a different tag.
+        plain = self.client.get("/static/main.js", HTTP_IF_NONE_MATCH=js["ETag"])
+        self.assertEqual(plain.status_code, 200)
+        self.assertNotEqual(plain["ETag"], js["ETag"])
+        self.assertEqual(plain["Vary"], "Accept-Encoding")
+
+        retro = Retro.objects.create()
+        html = self.client.get(f"/retros/{retro.uuid}").content.decode()
+        hashed_url = re.search(r'src="(/static/main\.\w+\.js)"', html).group(1)
+        hashed = self.client.get(hashed_url)
+        self.assertEqual(hashed["Cache-Control"], "public, max-age=31536000, immutable")
+        self.assertEqual(hashed.content, assets.get("main.js")[0].body)
+
+        self.assertEqual(self.client.get("/static/nope.js").status_code, 404)
+
+    def test_refused_codings(self):
+        for accept in ["gzip;q=0.0", "gzip; q=0", "*;q=0", "gzip;q=0, *", "identity"]:
+            js = self.client.get("/static/main.js", HTTP_ACCEPT_ENCODING=accept)
+            self.assertNotIn("Content-Encoding", js, accept)
+        for accept in ["*, br;q=0", "GZIP;q=0.5", "br;q=0, gzip;q=1.0"]:
+            js = self.client.get("/static/main.js", HTTP_ACCEPT_ENCODING=accept)
+            self.assertEqual(js["Content-Encoding"], "gzip", accept)
+
+
+class OutboundTest(TestCase):
+    def frame(self, msg):
+        return json.dumps(msg)
+
+    def test_sends_everything_until_client_acks(self):
+        out = Outbound(window=2)
+        for i in range(5):
+            out.put(self.frame({"type": "addTopic", "id": i}))
+        self.assertEqual(len(out.take()), 5)
+
+    def test_holds_back_and_coalesces_past_window(self):
+        out = Outbound(window=2)
+        out.ack(0)
+        sent = []
+        for i in range(3):
+            out.put(self.frame({"type": "moveTopic", "id": 1, "x": i, "seq": i}))
+            sent += out.take()
+            out.put(self.frame({"type": "updateVotes", "name": "a", "seq": 9 + i}))
+            sent += out.take()
+        self.assertEqual([json.loads(t)["seq"] for t in sent], [0, 9])
+        out.ack(2)
+        # Just the latest of each is left.
+        waiting = [json.loads(t) for t in out.take()]
+        self.assertEqual([m["seq"] for m in waiting], [2, 11])
+
+        out.put(self.frame({"type": "presence", "joined": ["b"], "left": []}))
+        out.put(self.frame({"type": "init", "state": "voting"}))
+        out.ack(4)
+        self.assertEqual([json.loads(t)["type"] for t in out.take()], ["init"])
+
+    def test_resyncs_then_drops_slow_client(self):
+        out = Outbound(window=1, max_frames=3)
+        out.ack(0)
+        for i in range(5):
+            out.put(self.frame({"type": "addTopic", "id": i}))
+        out.take()
+        self.assertTrue(out.behind())
+        out.resync(self.frame({"type": "init"}))
+        self.assertFalse(out.behind())
+        self.assertEqual(out.take(), [self.frame({"type": "init"})])
+        self.assertTrue(out.resyncing())
+        out.ack(2)
+        self.assertFalse(out.resyncing())
+
+        out.resync(self.frame({"type": "init"}))
+        out.drop()
+        out.put(self.frame({"type": "presence", "joined": ["c"], "left": []}))
+        self.assertEqual(out.take(), [])
+
+
+class ChannelFullTest(TestCase):
+    async def test_full_channels_drop_and_count(self):
+        layer = InMemoryChannelLayer(capacity=1)
+        await layer.group_add("retro", "slow")
+        full = metrics.CHANNEL_FULL.total()
+        for i in range(3):
+            await layer.group_send("retro", {"type": "broadcast", "i": i})
+        self.assertEqual(metrics.CHANNEL_FULL.total() - full, 2)
+        self.assertEqual((await layer.receive("slow"))["i"], 0)
+
+    def test_gaps_in_broadcasts_are_noticed(self):
+        retro = Retro.objects.create(state="brainstorming")
+        sender, slow = RetroSession(retro.uuid), RetroSession(retro.uuid)
+        jumpy = RetroSession(retro.uuid)
+        for session in [sender, slow, jumpy]:
+            session.open()
+        events = []
+        for i in range(GAP_FRAMES + 2):
+            out = sender.handle({"type": "addTopic", "list": "sad", "text": str(i)})
+            events += [broadcast_event(text) for text in out.broadcasts]
+        self.assertEqual([e["seq"] for e in events[:6]], [1, 2, 3, 4, 5, 6])
+        # More skipped than can be in flight.
+        self.assertTrue(jumpy.missed(events[-1]))
+
+        now = 100.0
+        with mock.patch("main.session.time.monotonic", side_effect=lambda: now):
+            self.assertFalse(slow.missed(events[0]))
+            # Sent by two threads in the other order.
+            self.assertFalse(slow.missed(events[2]))
+            self.assertFalse(slow.missed(events[1]))
+            # 4 never arrives.
+            self.assertFalse(slow.missed(events[4]))
+            now += GAP_SECONDS
+            self.assertTrue(slow.missed(events[5]))
+        init = json.loads(slow.resync())
+        self.assertEqual(len(init["topics"]), GAP_FRAMES + 2)
+        # The init covers them all.
+        self.assertFalse(slow.missed(events[3]))
+        self.assertFalse(slow.missed({**events[1], "origin": "another process"}))
+        self.assertFalse(slow.missed(broadcast_event("{}", changed=False)))
+        self.assertFalse(slow.missed(broadcast_event('{"type": "moveTopic"}')))
+        for session in [sender, slow, jumpy]:
+            session.close()
+
+
+class ArchiveTest(TestCase):
+    def archive_now(self, retro):
+        # Counting it as idle although it was just used.
+        call_command(
+            "archive_retros", retro.uuid, "--active-minutes", "0", stdout=io.StringIO()
+        )
+
+    def test_archived_retro_is_restored_on_demand(self):
+        retro = Retro.objects.create(state="brainstorming")
+        session = RetroSession(retro.uuid)
+        session.open()
+        session.handle({"type": "join", "name": "a"})
+        for i in range(3):
+            session.handle({"type": "addTopic", "text": f"t{i}", "list": "happy"})
+        session.handle({"type": "goToGrouping"})
+        state = session.state
+        session.close()
+        before = init_msg(state)
+        events = list(RetroEvent.objects.values_list("seq", "type", "created"))
+
+        self.archive_now(retro)
+        self.assertFalse(Retro.objects.exists())
+        self.assertFalse(Topic.objects.exists())
+        self.assertFalse(RetroEvent.objects.exists())
+        self.assertEqual(RetroArchive.objects.count(), 1)
+
+        # The page brings it back, and connecting finds it.
+        self.assertEqual(self.client.get(f"/retros/{retro.uuid}").status_code, 200)
+        self.assertFalse(RetroArchive.objects.exists())
+        session = RetroSession(retro.uuid)
+        self.assertEqual(json.loads(session.open()[0])["topics"], before["topics"])
+        self.assertEqual(init_msg(session.state), before)
+        self.assertEqual(
+            list(RetroEvent.objects.values_list("seq", "type", "created")), events
+        )
+        session.close()
+
+        # So does connecting without the page.
+        self.archive_now(retro)
+        session = RetroSession(retro.uuid)
+        session.open()
+        self.assertEqual(init_msg(session.state), before)
+
+    def test_restoring_twice_at_once(self):
+        retro = Retro.objects.create(state="brainstorming")
+        retro.topics.create(text="t", feeling="sad")
+        archive(retro.uuid, active_for=timedelta(0))
+        decompress = zlib.decompress
+        raced = []
+
+        def race(blob):
+            # Someone else restores it between reading and claiming the archive.
+            if not raced:
+                raced.append(True)
+                self.assertTrue(restore(retro.uuid))
+            return decompress(blob)
+
+        with mock.patch("main.archive.zlib.decompress", side_effect=race):
+            self.assertTrue(restore(retro.uuid))
+        self.assertEqual(Topic.objects.count(), 1)
+        self.assertTrue(restore(retro.uuid))
+        self.assertFalse(restore("3F2504E0-4F89-11D3-9A0C-0305E82C3301"))
+
+    def test_picks_finished_and_idle_retros(self):
+        old = timezone.now() - timedelta(days=2)
+        finished = Retro.objects.create(state="discussion", created=old)
+        Retro.objects.create(state="voting", created=old)
+        Retro.objects.create(state="discussion")
+        call_command("archive_retros", stdout=io.StringIO())
+        self.assertEqual(
+            list(RetroArchive.objects.values_list("uuid", flat=True)), [finished.uuid]
+        )
+
+    def test_skips_recently_active_retros(self):
+        old = timezone.now() - timedelta(days=2)
+        changed = Retro.objects.create(state="discussion", created=old)
+        changed.events.create(seq=1, type="state", data={})
+        seen = Retro.objects.create(state="discussion", created=old)
+        session = RetroSession(seen.uuid)
+        session.open()
+        session.close()
+        self.assertIsNotNone(Retro.objects.get(pk=seen.uuid).last_seen)
+        # Not open in this process, but maybe in another.
+        self.assertIsNone(archive(changed.uuid))
+        self.assertIsNone(archive(seen.uuid))
+        call_command("archive_retros", stdout=io.StringIO())
+        self.assertFalse(RetroArchive.objects.exists())
+
+    def test_unknown_retros_are_not_archived(self):
+        self.assertIsNone(archive("3F2504E0-4F89-11D3-9A0C-0305E82C3301"))
+
+
+# Not a TestCase: foreign keys are only checked on commit.
+class ArchiveWhileOpenTest(TransactionTestCase):
+    def test_open_retros_are_skipped_or_brought_back(self):
+        retro = Retro.objects.create(state="brainstorming")
+        session = RetroSession(retro.uuid)
+        session.open()
+        self.addCleanup(session.close)
+        session.handle({"type": "join", "name": "a"})
+        self.assertIsNone(archive(retro.uuid))
+        self.assertFalse(RetroArchive.objects.exists())
+
+        # As if another process that doesn't have it open archived it.
+        self.archive_elsewhere(retro)
+        out = session.handle({"type": "addTopic", "text": "t", "list": "sad"})
+        self.assertEqual(json.loads(out.broadcasts[0])["text"], "t")
+        self.assertEqual(list(Topic.objects.values_list("text", flat=True)), ["t"])
+        self.assertFalse(RetroArchive.objects.exists())
+
+        # Or when another process changed it, so it's reloaded first.
+        self.archive_elsewhere(retro)
+        session.state.changed_elsewhere()
+        out = session.handle({"type": "addTopic", "text": "u", "list": "sad"})
+        self.assertEqual(json.loads(out.broadcasts[0])["text"], "u")
+        self.assertEqual(Topic.objects.count(), 2)
+
+        # Or connecting, to our copy that needs reloading.
+        self.archive_elsewhere(retro)
+        session.state.changed_elsewhere()
+        other = RetroSession(retro.uuid)
+        self.assertEqual(len(json.loads(other.open()[0])["topics"]), 2)
+        other.close()
+
+    def archive_elsewhere(self, retro):
+        # As if a process that doesn't have it open, and hasn't heard from
+        # this one for a while, archived it.
+        with mock.patch.object(main.state.retro_states, "discard", return_value=True):
+            self.assertIsNotNone(archive(retro.uuid, active_for=timedelta(0)))
+        self.assertFalse(Retro.objects.exists())
+
+
+class RateLimitTest(TestCase):
+    @override_settings(
+        RETRO_RATE_LIMITS={
+            "addTopic": {"connection": (0, 3), "retro": (0, 5)},
+            "other": {"connection": (0, 1), "retro": (0, 1)},
+        }
+    )
+    def test_limits_per_connection_then_per_retro(self):
+        retro = Retro.objects.create(state="brainstorming")
+        a, b = RetroSession(retro.uuid), RetroSession(retro.uuid)
+        a.open()
+        b.open()
+        add = {"type": "addTopic", "text": "t", "list": "sad"}
+        self.assertEqual([a.allow(add) for _ in range(4)], [True] * 3 + [False])
+        # b has its own 3 but the retro only has 2 left.
+        self.assertEqual([b.allow(add) for _ in range(3)], [True] * 2 + [False])
+        self.assertTrue(a.allow({"type": "madeUp"}))
+        self.assertFalse(b.allow({"type": "alsoMadeUp"}))
+        a.close()
+        b.close()
+
+
+class PresenceTest(TestCase):
+    def broadcasts(self, session, action):
+        return [json.loads(t) for t in session.handle(action).broadcasts]
+
+    def test_people_are_whoever_is_connected(self):
+        retro = Retro.objects.create(state="voting")
+        cluster = retro.clusters.create()
+        tab1, tab2, other = [RetroSession(retro.uuid) for _ in range(3)]
+        for session in [tab1, tab2, other]:
+            session.open()
+        joined = self.broadcasts(tab1, {"type": "join", "name": "a"})
+        self.assertEqual([m["joined"] for m in joined], [["a"]])
+        self.assertEqual(self.broadcasts(tab2, {"type": "join", "name": "a"}), [])
+        self.broadcasts(other, {"type": "join", "name": "b"})
+        self.assertEqual(
+            [p["name"] for p in init_msg(tab1.state)["people"]], ["a", "b"]
+        )
+        # Nobody's done anything worth keeping yet.
+        self.assertFalse(retro.people.exists())
+        self.assertFalse(RetroEvent.objects.exists())
+
+        self.broadcasts(other, {"type": "setVotes", "votes": [cluster.pk]})
+        self.assertEqual(list(retro.people.values_list("name", flat=True)), ["b"])
+
+        state = tab1.state
+        self.assertEqual(tab1.close(), [])
+        [left] = tab2.close()
+        self.assertEqual(json.loads(left)["left"], ["a"])
+        self.assertEqual(init_msg(state)["people"], [{"name": "b", "numVotes": 1}])
+        other.close()
+
+    def test_quiet_connections_leave(self):
+        retro = Retro.objects.create()
+        quiet, chatty = RetroSession(retro.uuid), RetroSession(retro.uuid)
+        for session, name in [(quiet, "quiet"), (chatty, "chatty")]:
+            session.open()
+            session.handle({"type": "join", "name": name})
+        state = chatty.state
+        for present in state.presence.connections():
+            present.last_seen -= 60
+        state.presence._next_expiry = 0
+        [msg] = self.broadcasts(chatty, {"type": "heartbeat"})
+        self.assertEqual((msg["joined"], msg["left"]), ([], ["quiet"]))
+        # It's back as soon as it's heard from.
+        [msg] = self.broadcasts(quiet, {"type": "heartbeat"})
+        self.assertEqual((msg["joined"], msg["left"]), (["quiet"], []))
+        quiet.close()
+        chatty.close()
+
+
+class GroupingTest(TestCase):
+    def test_overlapping_topics_are_grouped(self):
+        index = GroupingIndex()
+        for topic_id in range(1, 5):
+            index.move(topic_id, topic_id * 1000, 0)
+        self.assertEqual(index.groups(), [])
+        self.assertTrue(index.move(2, 1000 + TOPIC_BOX_WIDTH, TOPIC_BOX_HEIGHT))
+        # 3 overlaps 2 but not 1, and it's still one group.
+        self.assertTrue(index.move(3, 1000 + 2 * TOPIC_BOX_WIDTH, 0))
+        self.assertEqual(index.groups(), [[1, 2, 3]])
+        self.assertFalse(index.move(4, 3000, 500))
+        # Taking 2 out of the middle splits them.
+        self.assertTrue(index.move(2, 0, 700))
+        self.assertEqual(index.groups(), [])
+        self.assertEqual(index.clusters([1, 2, 3, 4]), [[1], [2], [3], [4]])
+
+    def test_voting_uses_the_server_groups(self):
+        retro = Retro.objects.create(state="brainstorming")
+        session = RetroSession(retro.uuid)
+        session.open()
+        session.handle({"type": "join", "name": "person"})
+        for i in range(3):
+            session.handle({"type": "addTopic", "text": f"t{i}", "list": "sad"})
+        session.handle({"type": "goToGrouping"})
+        a, b, c = [t.pk for t in session.state.topics]
+        for topic_id, x in [(a, 0), (b, 500), (c, 1000)]:
+            session.handle({"type": "dropTopic", "id": topic_id, "x": x, "y": 0})
+        out = session.handle({"type": "dropTopic", "id": c, "x": 10, "y": 10})
+        groups = json.loads(out.broadcasts[-1])
+        self.assertEqual(groups["groups"], [[a, c]])
+        # Someone joining now sees them.
+        late = RetroSession(retro.uuid)
+        self.assertEqual(json.loads(late.open()[0])["groups"], [[a, c]])
+
+        session.handle({"type": "goToVoting", "clusters": [[a, b, c]]})
+        clusters = init_msg(RetroState.load(retro.uuid))["clusters"]
+        self.assertEqual([c["topicIds"] for c in clusters], [[a, c], [b]])
+        late.close()
+        session.close()
+
+
+# Not a TestCase: the writer commits on its own connection, which wouldn't see
+# rows inside the test's transaction.
+@override_settings(RETRO_WRITE_BEHIND=True)
+class WriteBehindTest(TransactionTestCase):
+    def setUp(self):
+        # Long enough that nothing's committed unless it's flushed.
+        interval, writer.interval = writer.interval, 60
+        self.addCleanup(setattr, writer, "interval", interval)
+
+    def test_writes_wait_for_a_flush(self):
+        retro = Retro.objects.create()
+        state = RetroState.load(retro.uuid)
+        state.add_person("person")
+        self.assertEqual(RetroEvent.objects.count(), 0)
+
+        state.set_state("brainstorming")
+        self.assertEqual(RetroEvent.objects.count(), 2)
+        self.assertEqual(Retro.objects.get(uuid=retro.uuid).state, "brainstorming")
+
+        for i in range(3):
+            state.add_topic(f"topic {i}", "sad")
+        self.assertEqual(RetroEvent.objects.count(), 2)
+        reloaded = RetroState.load(retro.uuid)
+        self.assertEqual(init_msg(reloaded), init_msg(state))
+        self.assertEqual(
+            list(RetroEvent.objects.order_by("pk").values_list("seq", flat=True)),
+            [1, 2, 3, 4, 5],
+        )
+
+
+# Not a TestCase, so the connecting threads can see the retro.
+class ConnectStormTest(TransactionTestCase):
+    def test_connections_share_one_load_and_init(self):
+        retro, other = Retro.objects.create(), Retro.objects.create()
+        other_session = RetroSession(other.uuid)
+        other_session.open()
+        load = RetroState.load
+        loads = []
+        loading = threading.Event()
+        finish = threading.Event()
+
+        def slow_load(uuid):
+            loads.append(uuid)
+            loading.set()
+            finish.wait(5)
+            return load(uuid)
+
+        sessions = [RetroSession(retro.uuid) for _ in range(8)]
+        frames = []
+
+        def connect(session):
+            frames.extend(session.open())
+            connections.close_all()
+
+        with mock.patch.object(RetroState, "load", side_effect=slow_load):
+            threads = [threading.Thread(target=connect, args=[s]) for s in sessions]
+            for t in threads:
+                t.start()
+            loading.wait(5)
+            # Other retros don't wait for it.
+            start = time.monotonic()
+            sessions.append(RetroSession(other.uuid))
+            sessions[-1].open()
+            self.assertLess(time.monotonic() - start, 1)
+            finish.set()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(sessions[0].state.connections, 8)
+        self.assertEqual(len(frames), 8)
+        # The very same string, so it's encoded and transcoded once.
+        self.assertEqual(len({id(f) for f in frames}), 1)
+        for session in [other_session, *sessions]:
+            session.close()
+
+
+class ServeTest(TestCase):
+    def test_a_retros_page_and_websockets_go_to_one_worker(self):
+        uuid = "3F2504E0-4F89-11D3-9A0C-0305E82C3301"
+        page = worker_for(f"GET /retros/{uuid} HTTP/1.1\r\n".encode(), 8)
+        ws = worker_for(f"GET /ws/retro/{uuid.lower()}/ HTTP/1.1\r\n".encode(), 8)
+        self.assertEqual(page, ws)
+        self.assertIsNone(worker_for(b"GET / HTTP/1.1\r\n", 8))
+        self.assertIsNone(worker_for(b"POST /retros/ HTTP/1.1\r\n", 8))
+        spread = {worker_for(f"GET /retros/r{i} ".encode(), 8) for i in range(100)}
+        self.assertEqual(spread, set(range(8)))
+
+    def test_forked_workers_tag_broadcasts_as_their_own(self):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.write(write, main.state.PROCESS_ID.encode())
+            os._exit(0)
+        os.close(write)
+        child = os.read(read, 100).decode()
+        os.close(read)
+        os.waitpid(pid, 0)
+        self.assertNotEqual(child, main.state.PROCESS_ID)
+
+
+class RecordReplayTest(TestCase):
+    def test_traces_replay_against_a_seeded_retro(self):
+        retro = Retro.objects.create(state="grouping")
+        topics = [retro.topics.create(text=f"t{i}", feeling="sad") for i in range(3)]
+        state = RetroState.load(retro.uuid)
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(RETRO_RECORD_DIR=directory):
+                recording = recorder.open(state)
+                drop = {"type": "dropTopic", "id": topics[2].pk, "x": 5, "y": 6}
+                recording.action(state, drop)
+                recording.action(state, {"type": "ack", "received": 3})
+                recording.close()
+            [path] = os.listdir(directory)
+            header, lines = read_trace(os.path.join(directory, path))
+
+        self.assertEqual(header["state"], "grouping")
+        self.assertEqual([t[0] for t in header["topics"]], ["t0", "t1", "t2"])
+        self.assertEqual([line[2] for line in lines], ["o", "a", "c"])
+        # Ids are where the topic comes in the retro, not its row's id.
+        self.assertEqual(lines[1][3], {**drop, "id": 2})
+
+        replayed = seed(header)
+        replay = Replay(None, header["state"], *replayed, lines, speed=0)
+        action = replay.with_ids(lines[1][3])
+        self.assertNotEqual(action["id"], topics[2].pk)
+        self.assertEqual(Topic.objects.get(pk=action["id"]).text, "t2")
+
+
+class BenchCommandsTest(SimpleTestCase):
+    # Each in its own process, since they set up their own test database.
+    COMMANDS = [
+        ["bench_assets", "--requests", "2"],
+        ["bench_codecs", "--people", "2", "--topics", "3", "--runs", "2"],
+        ["bench_connects", "--retros", "1", "--participants", "2", "--rounds", "1"],
+        ["bench_consumers", "--max-clients", "10", "--moves", "1"],
+        ["bench_db", "--retros", "1", "--participants", "1", "--topics", "1"],
+        ["bench_layers", "--groups", "1", "--members", "2", "--messages", "3"],
+    ]
+
+    def test_they_run(self):
+        for command in self.COMMANDS:
+            with self.subTest(command=command[0]):
+                done = subprocess.run(
+                    [sys.executable, "manage.py", *command],
+                    cwd=settings.BASE_DIR,
+                    capture_output=True,
+                    text=True,
+                    timeout=120,
+                )
+                self.assertEqual(done.returncode, 0, done.stderr)
+                self.assertTrue(json.loads(done.stdout))
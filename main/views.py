@@ -1,10 +1,9 @@
-import os.path
-
-from django.conf import settings
-from django.http import HttpResponse, HttpResponseRedirect
-from django.shortcuts import get_object_or_404, render
-from django.views.static import serve
+from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.shortcuts import render
 
+from main.archive import restore
+from main.assets import assets
+from main.metrics import render as render_metrics
 from main.models import Retro
 
 
@@ -16,14 +15,15 @@ def retros(request, id):
     if request.method == "POST":
         r = Retro.objects.create()
         return HttpResponseRedirect(f"/retros/{r.uuid}")
-    get_object_or_404(Retro, uuid=id)  # just make sure it exists
-    return static(request, "retro.html")
+    # Just make sure it exists, bringing it back if it's been archived.
+    if not Retro.objects.filter(uuid=id).exists() and not restore(id):
+        raise Http404(id)
+    return assets.serve(request, "retro.html")
+
+
+def metrics(request):
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4")
 
 
 def static(request, path):
-    full_path = os.path.normpath(settings.STATIC_DIR / path)
-    # Probably not necessary as at least basic requests with .. in the path
-    # don't even get in here, but leaving it just in case.
-    if ".." in full_path:
-        raise Exception("Invalid path")
-    return serve(request, os.path.basename(full_path), os.path.dirname(full_path))
+    return assets.serve(request, path)
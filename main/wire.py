@@ -0,0 +1,174 @@
+"""Wire formats a client can pick with a websocket subprotocol.
+
+Frames are built once as JSON text (see main.session) and that's what
+travels through the channel layer. A consumer whose client asked for
+something else transcodes each frame as it sends it. Every socket in a
+process gets the same text for a broadcast, so transcoding is cached and
+happens once per frame rather than once per socket.
+
+retro.json, the default, is the JSON as is.
+
+retro.compact is JSON too but each message is an array of its field
+values in a fixed order, [type, value, ...], so keys aren't repeated
+for every person, topic and cluster. COMPACT_FIELDS is the order. The
+copy of it in static/main.js has to match.
+
+retro.msgpack is MessagePack of the same objects as retro.json, in binary
+frames, if the msgpack package is installed.
+
+Separately from all that, RETRO_WS_DEFLATE turns on permessage-deflate,
+compression done by the websocket layer itself, which browsers support
+without any help from main.js.
+"""
+import json
+from functools import lru_cache
+
+from autobahn.websocket.compress import (
+    PerMessageDeflateOffer,
+    PerMessageDeflateOfferAccept,
+)
+
+try:
+    import msgpack
+except ImportError:  # It's optional.
+    msgpack = None
+
+# Field order per message type. A (name, fields) pair is a list of objects
+# each packed the same way. Missing fields are packed as null.
+COMPACT_FIELDS: dict[str, list] = {
+    "init": [
+        "state",
+        ("people", ["name", "numVotes"]),
+        ("topics", ["id", "text", "feeling", "x", "y"]),
+        ("clusters", ["id", "topicIds", "votes"]),
+        "actions",
+        "epoch",
+        "seq",
+        "groups",
+    ],
+    "presence": ["joined", "left", "seq"],
+    "addTopic": ["id", "list", "text", "seq"],
+    "moveTopic": ["id", "x", "y", "seq"],
+    "moveTopics": [("moves", ["id", "x", "y"])],
+    "updateVotes": ["name", "numVotes", "seq"],
+    "groups": ["groups", "seq"],
+    "resumed": [],
+}
+
+
+def pack_compact(msg):
+    fields = COMPACT_FIELDS.get(msg.get("type"))
+    if fields is None:
+        return msg
+    return [msg["type"], *_pack(fields, msg)]
+
+
+def _pack(fields, obj):
+    values = []
+    for field in fields:
+        if isinstance(field, tuple):
+            name, item_fields = field
+            values.append([_pack(item_fields, item) for item in obj[name]])
+        else:
+            values.append(obj.get(field))
+    return values
+
+
+def unpack_compact(msg):
+    if not isinstance(msg, list):
+        return msg
+    return _unpack(COMPACT_FIELDS[msg[0]], msg[1:], {"type": msg[0]})
+
+
+def _unpack(fields, values, obj):
+    for field, value in zip(fields, values):
+        if isinstance(field, tuple):
+            name, item_fields = field
+            obj[name] = [_unpack(item_fields, v, {}) for v in value]
+        elif value is not None:
+            obj[field] = value
+    return obj
+
+
+class Codec:
+    """How frames are sent to and read from clients that picked subprotocol.
+
+    transcode turns a decoded JSON frame into what's sent, None meaning the
+    JSON text is sent as is. decode reads binary frames from the client.
+    """
+
+    def __init__(self, subprotocol, binary=False, transcode=None, decode=json.loads):
+        self.subprotocol = subprotocol
+        self.binary = binary
+        self.transcode = transcode
+        self.decode = decode
+
+    def frame(self, text):
+        """Keyword arguments for the consumer's send() to send a JSON frame."""
+        if self.transcode is None:
+            return {"text_data": text}
+        data = _transcode(self, text)
+        return {"bytes_data": data} if self.binary else {"text_data": data}
+
+    def read(self, text_data=None, bytes_data=None):
+        """Decodes a received frame. Text frames are always JSON."""
+        if text_data is not None:
+            return json.loads(text_data)
+        return self.decode(bytes_data)
+
+
+@lru_cache(maxsize=1024)
+def _transcode(codec: Codec, text):
+    return codec.transcode(json.loads(text))
+
+
+JSON = Codec("retro.json")
+COMPACT = Codec("retro.compact", transcode=lambda msg: json.dumps(pack_compact(msg)))
+CODECS = {c.subprotocol: c for c in [JSON, COMPACT]}
+if msgpack is not None:
+    MSGPACK = Codec(
+        "retro.msgpack", binary=True, transcode=msgpack.packb, decode=msgpack.unpackb
+    )
+    CODECS[MSGPACK.subprotocol] = MSGPACK
+
+
+def pick_codec(subprotocols) -> Codec:
+    """The first of the client's subprotocols that we speak, or plain JSON."""
+    for subprotocol in subprotocols:
+        if subprotocol in CODECS:
+            return CODECS[subprotocol]
+    return JSON
+
+
+def _accept_deflate(offers):
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(offer)
+    return None
+
+
+def enable_permessage_deflate():
+    """Has daphne compress frames for clients that offer permessage-deflate.
+
+    Daphne has no option for it, so this swaps in a websocket factory that
+    turns it on. It has to run before the server starts. daphne.server isn't
+    imported for it, since that sets up twisted's reactor (see main.serve).
+    """
+    import sys
+
+    from daphne import ws_protocol
+
+    if not getattr(ws_protocol.WebSocketFactory, "deflate", False):
+
+        class DeflateWebSocketFactory(ws_protocol.WebSocketFactory):
+            deflate = True
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.setProtocolOptions(perMessageCompressionAccept=_accept_deflate)
+
+        ws_protocol.WebSocketFactory = DeflateWebSocketFactory
+    # It imports the factory by name, so needs it swapping too if it's loaded.
+    server = sys.modules.get("daphne.server")
+    if server is not None:
+        server.WebSocketFactory = ws_protocol.WebSocketFactory
@@ -0,0 +1,138 @@
+"""Writing a retro's events and snapshots in the background, batched.
+
+With RETRO_WRITE_BEHIND=1, RetroState hands the writes for a change to the
+writer here instead of making them itself, so the change is applied and
+broadcast without waiting on the database. One thread commits whatever has
+been queued, every RETRO_WRITE_BEHIND_MS, in a single transaction with the
+events bulk inserted. There's one queue for the whole process, so each
+retro's writes are committed in the order they were made.
+
+Rows whose ids go out to clients (people, topics, clusters and action
+items) are still inserted straight away. Phase changes flush, so the
+clients told about one know it's stored, and so does exiting. A crash can
+lose whatever was still queued, which clients may already have seen.
+
+A batch that fails is retried, then dropped and its retros reloaded from
+what did get stored. Other processes only read from the database, so with
+participants spread across processes (see main.layers) one can reload a
+retro before another's writes to it are committed.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from main import metrics
+from main.models import RetroEvent
+
+logger = logging.getLogger(__name__)
+
+# Tries at committing a batch before it's dropped, backing off from this.
+ATTEMPTS = 3
+RETRY_SECONDS = 0.05
+
+
+class WriteBehind:
+    def __init__(self, interval):
+        self.interval = interval
+        self._cond = threading.Condition()
+        # (when it was queued, the state it's for, its writes)
+        self._queue: list[tuple[float, object, list]] = []
+        self._queued = 0
+        self._done = 0
+        self._flushing = False
+        self._thread: threading.Thread | None = None
+
+    def __len__(self):
+        with self._cond:
+            return sum(len(writes) for _, _, writes in self._queue)
+
+    def submit(self, state, writes):
+        """Queues writes for a RetroState to be committed together.
+
+        Each is a RetroEvent to insert or a function making the write.
+        """
+        with self._cond:
+            self._queue.append((time.monotonic(), state, writes))
+            self._queued += 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="write-behind", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.flush)
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Waits until everything queued so far is committed or dropped."""
+        with self._cond:
+            target = self._queued
+            if self._done >= target:
+                return True
+            self._flushing = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._done >= target, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue)
+                # Gives a batch the interval to build up unless someone's waiting.
+                self._cond.wait_for(lambda: self._flushing, self.interval)
+                batch, self._queue = self._queue, []
+                self._flushing = False
+            self._commit(batch)
+            with self._cond:
+                self._done += len(batch)
+                self._cond.notify_all()
+            close_old_connections()
+
+    def _commit(self, batch):
+        writes = sum(len(w) for _, _, w in batch)
+        for attempt in range(1, ATTEMPTS + 1):
+            try:
+                with transaction.atomic():
+                    _write(w for _, _, batch_writes in batch for w in batch_writes)
+                break
+            except Exception:
+                logger.exception(
+                    "Write-behind batch of %s writes failed, try %s", writes, attempt
+                )
+                close_old_connections()
+                time.sleep(RETRY_SECONDS * 2**attempt)
+        else:
+            metrics.WRITE_BEHIND_DROPPED.inc(writes)
+            for _, state, _ in batch:
+                state.stale = True
+            return
+        now = time.monotonic()
+        metrics.WRITE_BEHIND_BATCH.observe(writes)
+        for queued_at, _, _ in batch:
+            metrics.WRITE_BEHIND_LAG.observe(now - queued_at)
+
+
+def _write(writes):
+    """Makes writes in order, inserting runs of events in one query."""
+    events = []
+    for w in writes:
+        if isinstance(w, RetroEvent):
+            events.append(w)
+            continue
+        if events:
+            RetroEvent.objects.bulk_create(events)
+            events = []
+        w()
+    if events:
+        RetroEvent.objects.bulk_create(events)
+
+
+writer = WriteBehind(settings.RETRO_WRITE_BEHIND_MS / 1000)
+
+metrics.Gauge(
+    "retro_write_behind_queued",
+    "Writes waiting for the write-behind thread to commit them.",
+    lambda: len(writer),
+)
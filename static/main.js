@@ -3,33 +3,190 @@ const retroId = window.location.pathname.split('/')[2]
 
 let userName = null
 
-const ws = new WebSocket(
-  'ws://' + window.location.host + '/ws/retro/' + retroId + '/'
-)
+let ws = null
+
+// Where we're up to in the retro's broadcasts, so that after a dropped
+// connection the server can send just what we missed instead of an init.
+let epoch = null
+let initSeq = 0
+let lastSeq = 0
+const seenSeqs = new Set()
+let reconnectDelayMs = 500
+
+// How many frames this connection has had. Acked every so often so the
+// server can hold back frames while we're behind (see main/outbound.py).
+let framesReceived = 0
+let ackTimer = null
+
+// Who's connected, from the init and presence messages after it.
+let present = []
+
+// So the server knows this tab's still here even when nobody's doing
+// anything. Keep in sync with HEARTBEAT_SECONDS in main/presence.py.
+const HEARTBEAT_MS = 15000
+setInterval(function () {
+  if (ws.readyState === WebSocket.OPEN) {
+    ws.send(JSON.stringify({ type: 'heartbeat' }))
+  }
+}, HEARTBEAT_MS)
+
+function connect () {
+  framesReceived = 0
+  let url = 'ws://' + window.location.host + '/ws/retro/' + retroId + '/'
+  if (epoch !== null) {
+    url += '?resume=' + epoch + '.' + lastSeq
+  }
+  ws = new WebSocket(url, ['retro.compact', 'retro.json'])
+  ws.onopen = function (e) {
+    reconnectDelayMs = 500
+    if (userName) {
+      // Tell the server who this is again without announcing a new join.
+      ws.send(JSON.stringify({ type: 'join', name: userName, resumed: true }))
+    }
+  }
+  ws.onmessage = onMessage
+  ws.onclose = function (e) {
+    console.error('Socket closed, reconnecting in ' + reconnectDelayMs + 'ms')
+    setTimeout(connect, reconnectDelayMs)
+    reconnectDelayMs = Math.min(reconnectDelayMs * 2, 30000)
+  }
+}
 
-ws.onmessage = function (e) {
-  const action = JSON.parse(e.data)
+function ack () {
+  clearTimeout(ackTimer)
+  ackTimer = null
+  if (ws.readyState === WebSocket.OPEN) {
+    ws.send(JSON.stringify({ type: 'ack', received: framesReceived }))
+  }
+}
+
+function countFrame () {
+  framesReceived += 1
+  if (framesReceived % 16 === 0) {
+    ack()
+  } else if (ackTimer === null) {
+    ackTimer = setTimeout(ack, 250)
+  }
+}
+
+// Returns whether the action was already seen, noting it as seen if not.
+// Numbered actions can arrive out of order and, around a reconnect, twice.
+function alreadySeen (action) {
+  if (action.type === 'init') {
+    if (action.epoch !== undefined) {
+      // A new connection's numbering.
+      epoch = action.epoch
+      lastSeq = action.seq
+      seenSeqs.clear()
+    }
+    if (action.seq !== undefined) {
+      // The init already covers everything up to its seq.
+      initSeq = action.seq
+      lastSeq = Math.max(lastSeq, action.seq)
+      for (const seq of seenSeqs) {
+        if (seq <= initSeq) {
+          seenSeqs.delete(seq)
+        }
+      }
+    }
+    return false
+  }
+  if (action.seq === undefined) {
+    return false
+  }
+  if (action.seq <= initSeq || seenSeqs.has(action.seq)) {
+    return true
+  }
+  seenSeqs.add(action.seq)
+  lastSeq = Math.max(lastSeq, action.seq)
+  return false
+}
+
+// How the server packs each message type as an array with retro.compact.
+// Keep in sync with COMPACT_FIELDS in main/wire.py.
+const COMPACT_FIELDS = {
+  init: [
+    'state',
+    ['people', ['name', 'numVotes']],
+    ['topics', ['id', 'text', 'feeling', 'x', 'y']],
+    ['clusters', ['id', 'topicIds', 'votes']],
+    'actions',
+    'epoch',
+    'seq',
+    'groups'
+  ],
+  presence: ['joined', 'left', 'seq'],
+  addTopic: ['id', 'list', 'text', 'seq'],
+  moveTopic: ['id', 'x', 'y', 'seq'],
+  moveTopics: [['moves', ['id', 'x', 'y']]],
+  updateVotes: ['name', 'numVotes', 'seq'],
+  groups: ['groups', 'seq'],
+  resumed: []
+}
+
+function unpackCompact (msg) {
+  if (!Array.isArray(msg)) {
+    return msg
+  }
+  return unpackFields(COMPACT_FIELDS[msg[0]], msg.slice(1), { type: msg[0] })
+}
+
+function unpackFields (fields, values, obj) {
+  fields.forEach(function (field, i) {
+    if (Array.isArray(field)) {
+      obj[field[0]] = values[i].map(v => unpackFields(field[1], v, {}))
+    } else if (values[i] !== null) {
+      obj[field] = values[i]
+    }
+  })
+  return obj
+}
+
+function onMessage (e) {
+  countFrame()
+  let action = JSON.parse(e.data)
+  if (ws.protocol === 'retro.compact') {
+    action = unpackCompact(action)
+  }
   console.log('Got action from server:')
   console.log(action)
+  if (alreadySeen(action)) {
+    return
+  }
   if (action.type === 'init') {
     init(action)
-  } else if (action.type === 'join') {
-    document.querySelector('#participants').value += (action.name + '\n')
+  } else if (action.type === 'presence') {
+    present = present.filter(name => !action.left.includes(name))
+    for (const name of action.joined) {
+      if (!present.includes(name)) {
+        present.push(name)
+      }
+    }
+    showParticipants()
   } else if (action.type === 'addTopic') {
     const listEl = document.querySelector('#' + action.list + '-list')
     listEl.value += (action.text + '\n')
   } else if (action.type === 'moveTopic') {
     moveTopicActionHandler(action)
+  } else if (action.type === 'groups') {
+    colourGroups(action.groups)
+  } else if (action.type === 'moveTopics') {
+    for (const move of action.moves) {
+      moveTopicActionHandler(move)
+    }
   } else if (action.type === 'updateVotes') {
     updateVotesActionHandler(action)
   }
 }
 
-ws.onclose = function (e) {
-  console.error('Chat socket closed unexpectedly')
+connect()
+
+function showParticipants () {
+  document.querySelector('#participants').value = present.map(name => name + '\n').join('')
 }
 
 function init (action) {
+  present = action.people.map(person => person.name)
   let state = action.state
   if (!userName) {
     state = 'joining'
@@ -44,10 +201,11 @@ function init (action) {
   }
 
   if (state === 'joining') {
-    for (const person of action.people) {
-      document.querySelector('#participants').value += (person.name + '\n')
-    }
+    showParticipants()
   } else if (state === 'brainstorming') {
+    for (const feeling of ['happy', 'sad', 'confused']) {
+      document.querySelector(`#${feeling}-list`).value = ''
+    }
     for (const topic of action.topics) {
       const listEl = document.querySelector(`#${topic.feeling}-list`)
       listEl.value += (topic.text + '\n')
@@ -159,11 +317,23 @@ const workspaceCoords = getCoords(workspace)
 
 const divsByTopic = {}
 
+// The server groups topics whose boxes overlap, so they're all the same size.
+// Keep in sync with TOPIC_BOX_WIDTH and TOPIC_BOX_HEIGHT in main/models.py.
+const topicBoxWidth = 160
+const topicBoxHeight = 48
+
 function initGrouping (action) {
+  // Inits come again on reconnects and resyncs, so start over.
+  workspace.innerHTML = ''
+  for (const topicId in divsByTopic) {
+    delete divsByTopic[topicId]
+  }
   for (const topic of action.topics) {
     const divEl = document.createElement('div')
     divEl.className = 'topic-box'
-    divEl.style.cssText = 'border: 2px solid black; display: inline-block;'
+    divEl.style.cssText = 'border: 2px solid black; display: inline-block; box-sizing: border-box; overflow: hidden; font-size: small;'
+    divEl.style.width = topicBoxWidth + 'px'
+    divEl.style.height = topicBoxHeight + 'px'
     divEl.style.position = 'absolute'
     divEl.style.left = (workspaceCoords.left + topic.x) + 'px'
     divEl.style.top = (workspaceCoords.top + topic.y) + 'px'
@@ -173,9 +343,10 @@ function initGrouping (action) {
     const textEl = document.createTextNode(topic.text)
     divEl.appendChild(textEl)
     workspace.appendChild(divEl)
-    divsByTopic[topic.text] = divEl
-    updateClustering(divEl)
+    divEl.dataset.topicId = topic.id
+    divsByTopic[topic.id] = divEl
   }
+  colourGroups(action.groups || [])
 }
 
 function getCoords (elem) {
@@ -224,77 +395,28 @@ function dragenterHandler (event) {
   event.preventDefault()
 }
 
-// Track clusters locally. We'll upload them when we're done with clustering.
-const clustersByTopic = {}
-let nextCluster = 0
-
-function updateClustering (div) {
-  let overlapDiv = null
-  for (const div2 of Object.values(divsByTopic)) {
-    if (div2 !== div && elementsOverlap(div, div2)) {
-      overlapDiv = div2
-      break
-    }
-  }
-  const draggedTopic = div.innerText
-  if (overlapDiv) {
-    const overlapTopic = overlapDiv.innerText
-    const existingCluster = clustersByTopic[overlapTopic]
-    if (existingCluster !== undefined) {
-      clustersByTopic[draggedTopic] = existingCluster
-    } else {
-      clustersByTopic[draggedTopic] = nextCluster
-      clustersByTopic[overlapTopic] = nextCluster
-      nextCluster++
-    }
-  } else {
-    if (clustersByTopic[draggedTopic] !== undefined) {
-      delete clustersByTopic[draggedTopic]
-      const topicsByCluster = getTopicByCluster(clustersByTopic)
-      for (const cluster in topicsByCluster) {
-        if (topicsByCluster[cluster].length <= 1) {
-          for (const topic of topicsByCluster[cluster]) {
-            delete clustersByTopic[topic]
-          }
-        }
-      }
-    }
-  }
-
+// Groups of topic ids from the server, which works them out as topics are
+// dropped. Each gets its own border colour.
+function colourGroups (groups) {
   const clusterColors = [
     'blue',
     'red',
-    'dark green',
+    'darkgreen',
     'yellow',
     'purple',
     'orange'
   ]
-  let nextColor = 0
-  const colorsByCluster = {}
-  const topicsByCluster = getTopicByCluster(clustersByTopic)
-  for (const cluster in topicsByCluster) {
-    colorsByCluster[cluster] = clusterColors[nextColor]
-    nextColor = (nextColor + 1) % clusterColors.length
-  }
-  for (const topic in divsByTopic) {
-    const cluster = clustersByTopic[topic]
-    if (cluster === undefined) {
-      divsByTopic[topic].style.borderColor = 'black'
-    } else {
-      divsByTopic[topic].style.borderColor = colorsByCluster[cluster]
+  const colorsByTopic = {}
+  groups.forEach(function (group, i) {
+    for (const topic of group) {
+      colorsByTopic[topic] = clusterColors[i % clusterColors.length]
     }
+  })
+  for (const topic in divsByTopic) {
+    divsByTopic[topic].style.borderColor = colorsByTopic[topic] || 'black'
   }
 }
 
-// TODO unit test this
-function elementsOverlap (el1, el2) {
-  const rect1 = el1.getBoundingClientRect()
-  const rect2 = el2.getBoundingClientRect()
-  const verticalOverlap = !(rect1.bottom < rect2.top || rect2.bottom < rect1.top)
-  const horizontalOverlap = !(rect1.right < rect2.left || rect2.right < rect1.left)
-  return verticalOverlap && horizontalOverlap
-}
-
 function dragoverHandler (event) {
   event.preventDefault()
 
@@ -307,27 +429,28 @@ function dragoverHandler (event) {
   beingDragged.style.left = pageCoords.left + 'px'
   beingDragged.style.top = pageCoords.top + 'px'
 
-  updateClustering(beingDragged)
-
-  const topic = beingDragged.textContent
+  const topic = beingDragged.dataset.topicId
   const x = pageCoords.left - workspaceCoords.left
   const y = pageCoords.top - workspaceCoords.top
   // console.log(`workspaceCoords:`)
   // console.log(workspaceCoords)
   // console.log(`server coords: ${x}, ${y}`)
-  debouncedSendTopicPosition(topic, x, y) // TODO we may want to use some kind of id rather than the topic string
+  debouncedSendTopicPosition('moveTopic', topic, x, y)
 }
 
-function sendTopicPosition (topic, x, y) {
+// moveTopic is for positions while dragging, which the server only relays
+// (batched, at most 20 times a second), and dropTopic is for where it ends
+// up, which the server also saves.
+function sendTopicPosition (type, topic, x, y) {
   ws.send(JSON.stringify({
-    type: 'moveTopic',
-    text: topic,
+    type,
+    id: Number(topic),
     x,
     y
   }))
 }
 
-const debouncedSendTopicPosition = debounce(sendTopicPosition, 250)
+const debouncedSendTopicPosition = debounce(sendTopicPosition, 50)
 
 function debounce (func, waitMs) {
   let timeout
@@ -344,16 +467,15 @@ function debounce (func, waitMs) {
 };
 
 function moveTopicActionHandler (action) {
-  if (beingDragged && action.text === beingDragged.textContent) {
+  if (beingDragged && String(action.id) === beingDragged.dataset.topicId) {
     // This is an echo of the drag being done locally so ignore it.
   } else {
-    const div = divsByTopic[action.text]
+    const div = divsByTopic[action.id]
     if (div) {
-      div.style.left = action.x + 'px'
-      div.style.top = action.y + 'px'
-      updateClustering(div)
+      div.style.left = (workspaceCoords.left + action.x) + 'px'
+      div.style.top = (workspaceCoords.top + action.y) + 'px'
     } else {
-      console.error('Got a move action for an unknown topic: {action.text}')
+      console.error(`Got a move action for an unknown topic: ${action.id}`)
     }
   }
 }
@@ -363,69 +485,54 @@ function dropHandler (event) {
 
   // TODO Prevent drops outside the workspace
 
-  updateClustering(beingDragged)
-
   const screenX = (event.x - mouseXOffset)
   const screenY = (event.y - mouseYOffset)
   const pageCoords = screenToPageCoords(screenX, screenY)
-  const topic = beingDragged.textContent
-  sendTopicPosition(topic, pageCoords.left, pageCoords.top) // TODO we may want to use some kind of id rather than the topic string
+  const topic = beingDragged.dataset.topicId
+  const x = pageCoords.left - workspaceCoords.left
+  const y = pageCoords.top - workspaceCoords.top
+  sendTopicPosition('dropTopic', topic, x, y)
 
   beingDragged = null
 }
 
 document.querySelector('#go-to-voting').onclick = function (e) {
-  assignAllTopicsACluster()
-  const topicsByCluster = getTopicByCluster(clustersByTopic)
-  ws.send(JSON.stringify({
-    type: 'goToVoting',
-    clusters: Object.values(topicsByCluster)
-  }))
-}
-
-function assignAllTopicsACluster () {
-  const allTopics = Object.keys(divsByTopic)
-  const topicsInClusters = []
-  for (const topic in clustersByTopic) {
-    topicsInClusters.push(topic)
-  }
-  const topicsWithoutCluster = allTopics.filter(x => !topicsInClusters.includes(x))
-  for (const topic of topicsWithoutCluster) {
-    clustersByTopic[topic] = nextCluster++
-  }
-}
-
-function getTopicByCluster (clustersByTopic) {
-  const topicByCluster = {}
-  for (const topic in clustersByTopic) {
-    const cluster = clustersByTopic[topic]
-    if (!topicByCluster[cluster]) {
-      topicByCluster[cluster] = []
-    }
-    topicByCluster[cluster].push(topic)
-  }
-  return topicByCluster
+  // The server makes the clusters from the groups it's been keeping.
+  ws.send(JSON.stringify({ type: 'goToVoting' }))
 }
 
 // Voting view code
 
 const votes = []
 
+function topicTextsById (action) {
+  const texts = {}
+  for (const topic of action.topics) {
+    texts[topic.id] = topic.text
+  }
+  return texts
+}
+
 function initVoting (action) {
+  const texts = topicTextsById(action)
   const topicsByClusterId = {}
   for (const cluster of action.clusters) {
     topicsByClusterId[cluster.id] = []
-    for (const topicText of cluster.topics) {
-      topicsByClusterId[cluster.id].push(topicText)
+    for (const topicId of cluster.topicIds) {
+      topicsByClusterId[cluster.id].push(texts[topicId])
     }
   }
 
+  // Inits come again on reconnects and resyncs, so start over.
+  votes.length = 0
   const votingClusters = document.querySelector('#voting-clusters')
+  votingClusters.innerHTML = ''
   for (const cid in topicsByClusterId) {
     votingClusters.appendChild(createVotingClusterUi(cid, topicsByClusterId[cid]))
   }
 
   const peopleContainer = document.querySelector('#voting-people')
+  peopleContainer.innerHTML = ''
   for (const person of action.people) {
     const div = document.createElement('div')
     div.appendChild(document.createTextNode(person.name))
@@ -511,6 +618,10 @@ function createVotingClusterUi (clusterId, topics) {
 function updateVoteStatuses (people) {
   for (const person of people) {
     const span = document.querySelector('#vote-status-' + person.name)
+    if (span === null) {
+      // Joined after voting started.
+      continue
+    }
     if (person.numVotes === 3) {
       span.innerText = 'All votes in'
     } else {
@@ -520,7 +631,7 @@ function updateVoteStatuses (people) {
 }
 
 function updateVotesActionHandler (action) {
-  updateVoteStatuses(action.people)
+  updateVoteStatuses([{ name: action.name, numVotes: action.numVotes }])
 }
 
 // Discussion view
@@ -529,8 +640,9 @@ function initDiscussion (initAction) {
   const clustersContainer = document.querySelector('#discussion-clusters')
   clustersContainer.innerHTML = ''
   initAction.clusters.sort((a, b) => b.votes - a.votes)
+  const texts = topicTextsById(initAction)
   for (const c of initAction.clusters) {
-    clustersContainer.appendChild(createDiscussionClusterUi(c))
+    clustersContainer.appendChild(createDiscussionClusterUi(c, texts))
   }
 
   document.querySelector('#discussion-action-text').onkeydown = function (e) {
@@ -559,7 +671,7 @@ function initDiscussion (initAction) {
   actionsContainer.appendChild(ul)
 }
 
-function createDiscussionClusterUi (cluster) {
+function createDiscussionClusterUi (cluster, texts) {
   const table = document.createElement('table')
   table.style.cssText = 'border: 2px solid black; margin: 5px; border-collapse: collapse; display: inline-block; vertical-align: top;'
 
@@ -574,10 +686,10 @@ function createDiscussionClusterUi (cluster) {
   tr.appendChild(voteCountView)
   table.appendChild(tr)
 
-  for (const t of cluster.topics) {
+  for (const topicId of cluster.topicIds) {
     const tr = document.createElement('tr')
     tr.style.cssText = 'border: 1px solid black'
-    const textEl = document.createTextNode(t)
+    const textEl = document.createTextNode(texts[topicId])
     tr.appendChild(textEl)
     table.appendChild(tr)
   }